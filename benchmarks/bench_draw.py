@@ -0,0 +1,397 @@
+"""
+御神签抽签链路基准测试
+
+模拟 N 个用户分布在若干群中并发抽签，走与 `/omikuji` 命令相同的路径：
+get_cached_omikuji → generate_omikuji → OmikujiCacheData.cache_omikuji → render_omikuji。
+LLM 调用由本地的假 tools_caller 代替（可配置延迟），数据库使用 SQLite。
+
+场景：
+    cold    空语料库，新用户抽签（大部分请求需要调用 LLM）
+    warm    语料库已由 cold 场景填充，另一批新用户抽签
+    repeat  cold 场景的用户再次抽签（命中每日抽签记录）
+
+用法：
+    python benchmarks/bench_draw.py --users 500 --groups 20 --llm-latency 0.5 \\
+        --output bench.json --compare last.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import atexit
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+ROOT = Path(__file__).resolve().parent.parent
+
+SCENARIOS = ("cold", "warm", "repeat")
+MEMORY_DB = "omikuji_bench"
+
+
+@dataclass
+class Counters:
+    llm_calls: int = 0
+    sql_statements: int = 0
+    sql_time: float = 0.0
+
+
+@dataclass
+class ScenarioResult:
+    draws: int
+    failures: int
+    wall_time: float
+    throughput: float  # 每秒完成的抽签数
+    latency_ms: dict[str, float]
+    llm_calls: int
+    llm_calls_per_draw: float
+    sql_statements: int
+    sql_statements_per_draw: float
+    sql_time_ms: float
+    extra: dict[str, Any] = field(default_factory=dict)
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize_latency(latencies: list[float]) -> dict[str, float]:
+    ms = [i * 1000 for i in latencies]
+    return {
+        "p50": round(percentile(ms, 0.5), 3),
+        "p90": round(percentile(ms, 0.9), 3),
+        "p99": round(percentile(ms, 0.99), 3),
+        "max": round(max(ms, default=0.0), 3),
+        "mean": round(statistics.fmean(ms), 3) if ms else 0.0,
+    }
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="御神签抽签链路基准测试")
+    parser.add_argument("--users", type=int, default=200, help="每个场景的用户数")
+    parser.add_argument("--groups", type=int, default=10, help="用户分布的群数量")
+    parser.add_argument(
+        "--private-ratio", type=float, default=0.2, help="私聊抽签的比例"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=50, help="同时进行的抽签请求数"
+    )
+    parser.add_argument(
+        "--llm-latency", type=float, default=0.2, help="假 LLM 调用的平均延迟（秒）"
+    )
+    parser.add_argument(
+        "--llm-jitter", type=float, default=0.1, help="假 LLM 延迟的随机浮动比例"
+    )
+    parser.add_argument(
+        "--sections", type=int, default=24, help="假 LLM 可能返回的板块名称数量"
+    )
+    parser.add_argument(
+        "--db",
+        default="",
+        help="SQLite 数据库文件路径，:memory: 表示内存数据库（默认：临时文件）",
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=SCENARIOS,
+        help="要运行的场景，可重复指定（默认：全部）",
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help='覆盖插件配置，值按 JSON 解析，例如 --set omikuji_draw_store=\\"memory\\"',
+    )
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--output", type=Path, help="将结果写入 JSON 文件")
+    parser.add_argument("--compare", type=Path, help="与之前保存的结果比较")
+    return parser.parse_args(argv)
+
+
+def parse_overrides(items: list[str]) -> dict[str, Any]:
+    overrides: dict[str, Any] = {}
+    for item in items:
+        key, _, value = item.partition("=")
+        try:
+            overrides[key.strip()] = json.loads(value)
+        except json.JSONDecodeError:
+            overrides[key.strip()] = value
+    return overrides
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def setup(args: argparse.Namespace, workdir: Path, counters: Counters) -> None:
+    """初始化 NoneBot、加载插件，并替换 LLM 调用与挂载 SQL 计数"""
+    sys.path.insert(0, str(ROOT))
+    db = args.db or str(workdir / "bench.sqlite3")
+    if db != ":memory:":
+        db = str(Path(db).resolve())
+    if db == ":memory:":
+        # 共享缓存的内存数据库在最后一个连接关闭时销毁，保持一个连接直到进程退出
+        keeper = sqlite3.connect(f"file:{MEMORY_DB}?mode=memory&cache=shared", uri=True)
+        atexit.register(keeper.close)
+    os.chdir(workdir)  # 避免读取当前目录下的 .env 以及写入 localstore 目录
+
+    import nonebot
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    nonebot.init(
+        driver="~none",
+        sqlalchemy_database_url=(
+            f"sqlite+aiosqlite:///file:{MEMORY_DB}?mode=memory&cache=shared&uri=true"
+            if db == ":memory:"
+            else f"sqlite+aiosqlite:///{db}"
+        ),
+        alembic_startup_check=False,  # 直接按模型同步表结构，不进行交互式迁移
+        localstore_use_cwd=True,
+        log_level="WARNING",
+        **parse_overrides(args.set),
+    )
+    from nonebot.adapters.onebot.v11 import Adapter
+
+    nonebot.get_driver().register_adapter(Adapter)
+    nonebot.load_plugin("nonebot_plugin_omikuji")
+
+    import nonebot_plugin_omikuji.utils as utils
+    from nonebot_plugin_omikuji.models import OMIKUJI_THEMES
+
+    rng = random.Random(args.seed)
+    section_names = [f"板块{i}" for i in range(args.sections)]
+
+    async def fake_tools_caller(messages, tools, tool_choice=None):
+        counters.llm_calls += 1
+        await asyncio.sleep(
+            args.llm_latency * (1 + rng.uniform(-args.llm_jitter, args.llm_jitter))
+        )
+        arguments = {
+            "theme": rng.choice(OMIKUJI_THEMES),
+            "sign_number": f"{rng.randint(1, 999)}号",
+            "divine_title": f"天启{rng.randint(1, 10**6)}",
+            "sections": [
+                {"name": name, "content": f"{name}的内容{rng.randint(1, 10**6)}"}
+                for name in rng.sample(section_names, 6)
+            ],
+            "maxim": f"真言{rng.randint(1, 10**6)}",
+            "intro": f"引言{rng.randint(1, 10**6)}",
+            "end": f"结语{rng.randint(1, 10**6)}",
+        }
+        return SimpleNamespace(
+            content=None,
+            usage=None,
+            tool_calls=[
+                SimpleNamespace(
+                    function=SimpleNamespace(
+                        arguments=json.dumps(arguments, ensure_ascii=False)
+                    )
+                )
+            ],
+        )
+
+    utils.tools_caller = fake_tools_caller  # pyright: ignore[reportAttributeAccessIssue]
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("bench_start", []).append(time.perf_counter())
+
+    @event.listens_for(Engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        counters.sql_statements += 1
+        counters.sql_time += time.perf_counter() - conn.info["bench_start"].pop()
+
+
+def make_event(user_id: int, args: argparse.Namespace, rng: random.Random):
+    from nonebot.adapters.onebot.v11 import (
+        GroupMessageEvent,
+        MessageEvent,
+        PrivateMessageEvent,
+    )
+
+    is_group = rng.random() >= args.private_ratio
+    # 只需要 user_id/group_id 以及事件类型，跳过 pydantic 校验
+    event_cls = GroupMessageEvent if is_group else PrivateMessageEvent
+    event: MessageEvent = event_cls.model_construct(user_id=user_id)
+    if is_group:
+        event.group_id = rng.randrange(args.groups)  # pyright: ignore[reportAttributeAccessIssue]
+    return event
+
+
+async def draw(event) -> None:
+    """与 commands.py 中的 /omikuji 处理流程一致（不发送消息）"""
+    from nonebot_plugin_omikuji.render import render_omikuji
+    from nonebot_plugin_omikuji.utils import draw_omikuji
+
+    render_omikuji(await draw_omikuji(event), event)
+
+
+async def run_scenario(
+    user_ids: range, args: argparse.Namespace, counters: Counters
+) -> ScenarioResult:
+    from nonebot_plugin_omikuji.draw_store import DatabaseDrawStore, get_draw_store
+    from nonebot_plugin_omikuji.utils import generation_flight
+    from nonebot_plugin_omikuji.write_behind import get_corpus_writer
+
+    rng = random.Random(f"{args.seed}-{user_ids.start}")
+    events = [make_event(uid, args, rng) for uid in user_ids]
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: list[float] = []
+    failures = 0
+
+    async def one(event) -> None:
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await draw(event)
+            except Exception:
+                failures += 1
+                return
+            latencies.append(time.perf_counter() - start)
+
+    before = Counters(**asdict(counters))
+    coalesced = generation_flight.coalesced
+    start = time.perf_counter()
+    await asyncio.gather(*(one(event) for event in events))
+    # 语料与每日抽签记录都是延迟写入的，计入本场景的开销
+    await get_corpus_writer().flush()
+    if isinstance(store := get_draw_store(), DatabaseDrawStore):
+        await store.flush()
+    wall_time = time.perf_counter() - start
+
+    draws = len(latencies)
+    llm_calls = counters.llm_calls - before.llm_calls
+    sql_statements = counters.sql_statements - before.sql_statements
+    return ScenarioResult(
+        draws=draws,
+        failures=failures,
+        wall_time=round(wall_time, 4),
+        throughput=round(draws / wall_time, 2) if wall_time else 0.0,
+        latency_ms=summarize_latency(latencies),
+        llm_calls=llm_calls,
+        llm_calls_per_draw=round(llm_calls / draws, 4) if draws else 0.0,
+        sql_statements=sql_statements,
+        sql_statements_per_draw=round(sql_statements / draws, 4) if draws else 0.0,
+        sql_time_ms=round((counters.sql_time - before.sql_time) * 1000, 3),
+        extra={"coalesced": generation_flight.coalesced - coalesced},
+    )
+
+
+async def run(args: argparse.Namespace, counters: Counters) -> dict[str, Any]:
+    import nonebot
+
+    driver = nonebot.get_driver()
+    await driver._lifespan.startup()
+    results: dict[str, ScenarioResult] = {}
+    try:
+        selected = args.scenario or list(SCENARIOS)
+        for name in SCENARIOS:
+            if name not in selected:
+                continue
+            users = (
+                range(args.users, args.users * 2)
+                if name == "warm"
+                else range(args.users)
+            )
+            results[name] = await run_scenario(users, args, counters)
+    finally:
+        await driver._lifespan.shutdown()
+    return {name: asdict(result) for name, result in results.items()}
+
+
+def print_results(
+    scenarios: dict[str, Any], previous: dict[str, Any] | None = None
+) -> None:
+    def delta(name: str, key: str, value: float, sub: str = "") -> str:
+        if not previous or name not in previous:
+            return ""
+        old = previous[name][key]
+        old = old[sub] if sub else old
+        if not old:
+            return ""
+        return f" ({(value - old) / old:+.1%})"
+
+    for name, result in scenarios.items():
+        lat = result["latency_ms"]
+        print(f"[{name}] {result['draws']} draws, {result['failures']} failures")
+        print(
+            f"  throughput  {result['throughput']:.2f}/s"
+            + delta(name, "throughput", result["throughput"])
+        )
+        for q in ("p50", "p99"):
+            print(
+                f"  latency {q} {lat[q]:.3f} ms" + delta(name, "latency_ms", lat[q], q)
+            )
+        print(
+            f"  llm/draw    {result['llm_calls_per_draw']:.4f}"
+            + delta(name, "llm_calls_per_draw", result["llm_calls_per_draw"])
+        )
+        print(
+            f"  sql/draw    {result['sql_statements_per_draw']:.4f}"
+            + delta(name, "sql_statements_per_draw", result["sql_statements_per_draw"])
+        )
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    random.seed(args.seed)
+    previous = None
+    if args.compare:
+        previous = json.loads(args.compare.read_text(encoding="utf-8"))["scenarios"]
+    counters = Counters()
+    with tempfile.TemporaryDirectory(prefix="omikuji-bench-") as workdir:
+        cwd = Path.cwd()
+        setup(args, Path(workdir), counters)
+        try:
+            scenarios = asyncio.run(run(args, counters))
+        finally:
+            os.chdir(cwd)
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "params": {
+            key: str(value) if isinstance(value, Path) else value
+            for key, value in vars(args).items()
+        },
+        "scenarios": scenarios,
+    }
+    print_results(scenarios, previous)
+    if args.output:
+        args.output.write_text(
+            json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8"
+        )
+        print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
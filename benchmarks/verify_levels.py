@@ -0,0 +1,143 @@
+"""
+运势权重抽样验证
+
+按插件配置（可用 --set 覆盖）构建运势抽样器，抽取大量样本，
+检查各运势出现的频率是否与配置的权重一致：
+
+    - 卡方检验（显著性水平由 --alpha 指定，自由度为权重大于 0 的运势数 - 1）
+    - 每个运势的偏差不超过 --max-sigma 个标准差
+    - 权重为 0 的运势不出现
+
+用法：
+    python benchmarks/verify_levels.py --samples 5000000 \\
+        --set 'omikuji_level_weights={"大吉": 3, "大凶": 0.5}' \\
+        --set 'omikuji_group_level_weights={"123": {"大凶": 0}}' --group 123
+"""
+
+from __future__ import annotations
+
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from statistics import NormalDist
+
+from bench_draw import ROOT, parse_overrides
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="运势权重抽样验证")
+    parser.add_argument("--samples", type=int, default=2_000_000, help="样本数")
+    parser.add_argument("--theme", default="", help="主题（用于按主题的权重）")
+    parser.add_argument("--group", default=None, help="群号（用于按群的权重）")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument(
+        "--alpha", type=float, default=0.001, help="卡方检验的显著性水平"
+    )
+    parser.add_argument(
+        "--max-sigma", type=float, default=5.0, help="单个运势允许的最大偏差（标准差）"
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="覆盖插件配置，值按 JSON 解析",
+    )
+    return parser.parse_args(argv)
+
+
+def chi2_critical(df: int, alpha: float) -> float:
+    """卡方分布的上侧临界值（Wilson-Hilferty 近似）"""
+    z = NormalDist().inv_cdf(1 - alpha)
+    k = 2 / (9 * df)
+    return df * (1 - k + z * math.sqrt(k)) ** 3
+
+
+def setup(args: argparse.Namespace, workdir: Path) -> None:
+    sys.path.insert(0, str(ROOT))
+    os.chdir(workdir)
+
+    import nonebot
+
+    nonebot.init(
+        driver="~none",
+        sqlalchemy_database_url="sqlite+aiosqlite://",
+        alembic_startup_check=False,
+        localstore_use_cwd=True,
+        log_level="WARNING",
+        **parse_overrides(args.set),
+    )
+    nonebot.load_plugin("nonebot_plugin_omikuji")
+
+
+def verify(args: argparse.Namespace) -> bool:
+    from nonebot_plugin_omikuji.config import get_config
+    from nonebot_plugin_omikuji.levels import get_level_sampler
+    from nonebot_plugin_omikuji.models import LEVEL, resolve_level_weights
+
+    sampler = get_level_sampler()
+    table = sampler.table(args.theme, args.group)
+    rng = random.Random(args.seed)
+    counts = [0] * len(LEVEL)
+    start = time.perf_counter()
+    for _ in range(args.samples):
+        counts[table.sample(rng)] += 1
+    elapsed = time.perf_counter() - start
+
+    config = get_config()
+    weights = resolve_level_weights(
+        config.omikuji_level_weights,
+        config.omikuji_theme_level_weights.get(args.theme),
+        config.omikuji_group_level_weights.get(args.group or ""),
+    )
+    total = sum(weights)
+    n = args.samples
+    ok = True
+    chi2 = 0.0
+    print(f"{'level':<6}{'weight':>10}{'expected':>12}{'observed':>12}{'sigma':>9}")
+    for level, weight, observed in zip(LEVEL, weights, counts):
+        p = weight / total
+        expected = n * p
+        if p == 0:
+            sigma = math.inf if observed else 0.0
+        else:
+            sigma = (observed - expected) / math.sqrt(expected * (1 - p) or 1)
+            chi2 += (observed - expected) ** 2 / expected
+        flag = "" if abs(sigma) <= args.max_sigma else "  <-- FAIL"
+        ok &= not flag
+        print(
+            f"{level:<6}{weight:>10.4g}{p:>12.4%}{observed / n:>12.4%}{sigma:>9.2f}{flag}"
+        )
+    df = sum(1 for w in weights if w > 0) - 1
+    if df > 0:
+        critical = chi2_critical(df, args.alpha)
+        passed = chi2 <= critical
+        ok &= passed
+        print(
+            f"chi2 = {chi2:.2f} (df={df}, critical={critical:.2f} at alpha={args.alpha})"
+            + ("" if passed else "  <-- FAIL")
+        )
+    print(f"{n} samples in {elapsed:.2f}s ({elapsed / n * 1e9:.0f} ns/sample)")
+    print("PASS" if ok else "FAIL")
+    return ok
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="omikuji-levels-") as workdir:
+        cwd = Path.cwd()
+        setup(args, Path(workdir))
+        try:
+            ok = verify(args)
+        finally:
+            os.chdir(cwd)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
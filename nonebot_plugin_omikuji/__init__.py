@@ -1,6 +1,6 @@
 import contextlib
 import os
-from datetime import datetime
+import time
 
 from nonebot import get_driver, logger
 from nonebot.plugin import PluginMetadata, require
@@ -12,10 +12,22 @@ from importlib import metadata
 
 from nonebot_plugin_suggarchat.API import Menu, ToolsManager
 
-from . import commands, llm_tool, sql_models
-from .cache import OmikujiCache
+from . import commands, llm_tool, metrics, sql_models
+from .cache import OmikujiCacheData
+from .card import card_available, get_card_renderer
 from .config import get_cache_dir, get_config
+from .corpus import get_corpus_index
+from .deterministic import purge_snapshots
+from .draw_store import get_draw_store, sweep_cache_dir
 from .llm_tool import TOOL_DATA
+from .prewarm import get_prewarm_scheduler
+from .ratelimit import get_rate_limiter
+from .tasks import (
+    cancel_background_tasks,
+    create_background_task,
+    create_periodic_task,
+)
+from .write_behind import get_corpus_writer
 
 __plugin_meta__ = PluginMetadata(
     name="御神签",
@@ -26,7 +38,7 @@ __plugin_meta__ = PluginMetadata(
     supported_adapters={"~onebot.v11"},
 )
 
-__all__ = ["commands", "llm_tool", "sql_models"]
+__all__ = ["commands", "llm_tool", "metrics", "sql_models"]
 
 
 @get_driver().on_startup
@@ -43,10 +55,70 @@ async def init():
         Menu().reg_menu("omikuji", "抽御神签", "[可选]主题")
     logger.info("正在初始化缓存数据......")
     os.makedirs(get_cache_dir(), exist_ok=True)
-    for cache in get_cache_dir().glob("*.json"):
-        if cache is not None:
-            with cache.open("r", encoding="utf-8") as f:
-                data = OmikujiCache.model_validate_json(f.read())
-            if not data.timestamp.date() == datetime.now().date():
-                os.remove(str(cache))
+    await get_draw_store().start()
+    if conf.omikuji_corpus_write_behind:
+        get_corpus_writer().start()
+    logger.info(f"已加载语料索引 {await get_corpus_index().load()} 个单元")
+    if conf.omikuji_render_mode == "card":
+        if card_available():
+            await get_card_renderer().start()
+        else:
+            logger.warning(
+                "图片卡片模式需要安装Pillow（pip install nonebot-plugin-omikuji[card]），将改为发送文本"
+            )
+    create_background_task(_sweep_cache(), name="omikuji_cache_sweep")
+    create_periodic_task(
+        conf.omikuji_cache_sweep_interval,
+        OmikujiCacheData.expire_cache,
+        name="omikuji_corpus_expire",
+    )
+    create_periodic_task(
+        conf.omikuji_corpus_refresh_interval,
+        get_corpus_index().refresh,
+        name="omikuji_corpus_refresh",
+    )
+    create_periodic_task(
+        conf.omikuji_rate_limit_compact_interval,
+        get_rate_limiter().compact,
+        name="omikuji_rate_limit_compact",
+    )
+    if conf.omikuji_metrics_dump_interval > 0:
+        create_periodic_task(
+            conf.omikuji_metrics_dump_interval,
+            lambda: metrics.dump(get_cache_dir() / "metrics.prom"),
+            name="omikuji_metrics_dump",
+        )
+    if conf.omikuji_use_cache and conf.omikuji_prewarm:
+        create_periodic_task(
+            conf.omikuji_prewarm_interval,
+            get_prewarm_scheduler().run_once,
+            name="omikuji_prewarm",
+        )
     logger.info("缓存数据初始化完成！")
+
+
+async def _sweep_cache():
+    start = time.perf_counter()
+    try:
+        scanned, removed, failed = await sweep_cache_dir(get_cache_dir())
+        purged = await get_draw_store().purge()
+        snapshots = await purge_snapshots()
+    except Exception as e:
+        logger.warning(f"清理过期缓存失败：{e}")
+        return
+    logger.info(
+        f"过期缓存清理完成：扫描 {scanned} 个缓存文件，删除 {removed} 个"
+        + (f"（{failed} 个处理失败）" if failed else "")
+        + f"，清除 {purged} 条过期抽签记录、{snapshots} 个过期语料快照，耗时 {time.perf_counter() - start:.2f}s"
+    )
+
+
+@get_driver().on_shutdown
+async def close():
+    await cancel_background_tasks()
+    await get_corpus_writer().close()
+    await get_draw_store().close()
+    await get_card_renderer().close()
+    if get_config().omikuji_metrics_dump_interval > 0:
+        with contextlib.suppress(Exception):
+            await metrics.dump(get_cache_dir() / "metrics.prom")
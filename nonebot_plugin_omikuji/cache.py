@@ -1,46 +1,46 @@
-import os
+import itertools
+import time
+from collections.abc import Iterable, Sequence
 from datetime import datetime, timedelta
-from typing import overload
+from typing import ClassVar
 
-import aiofiles
+from nonebot import logger
 from nonebot.adapters.onebot.v11 import MessageEvent
 from nonebot_plugin_orm import AsyncSession, get_session
-from pydantic import BaseModel, Field
-from sqlalchemy import delete, select
-from typing_extensions import Self
+from pydantic import BaseModel
+from sqlalchemy import and_, delete, func, or_, select, update
 
-from .config import get_cache_dir, get_config
-from .models import THEME_TYPE, OmikujiData
+from .config import get_config
+from .corpus import (
+    MAX_SECTIONS,
+    SECTION_FIELD,
+    CorpusCell,
+    get_corpus_index,
+    iter_entries,
+)
+from .draw_store import get_draw_store
+from .metrics import CORPUS_SQL_SECONDS, DRAW_CACHE
+from .models import LEVEL, OMIKUJI_THEMES, THEME_TYPE, OmikujiData
 from .sql_models import OmikujiCache as SQLOmikujiCache
-from .sql_models import db_lock
+from .sql_models import (
+    OmikujiCorpusEntry,
+    OmikujiCorpusSnapshot,
+    content_hash,
+    db_lock_many,
+    insert_ignore,
+    lock_cells,
+)
 
 
-class OmikujiCache(BaseModel):
-    data: OmikujiData
-    timestamp: datetime = Field(default_factory=datetime.now)
-
-
-async def cache_omikuji(event: MessageEvent, data: OmikujiData) -> None:
-    CACHE_DIR = get_cache_dir()
-    os.makedirs(CACHE_DIR, exist_ok=True)
-    cache_file = CACHE_DIR / f"{event.user_id!s}.json"
-    cache = OmikujiCache(data=data)
-    async with aiofiles.open(cache_file, "w", encoding="utf-8") as f:
-        await f.write(cache.model_dump_json())
+async def cache_omikuji(event: MessageEvent, data: OmikujiData) -> OmikujiData:
+    """保存用户今日的抽签结果，返回最终生效的结果（可能是并发抽签或其他进程先写入的结果）"""
+    return await get_draw_store().claim(str(event.user_id), data)
 
 
 async def get_cached_omikuji(event: MessageEvent) -> OmikujiData | None:
-    CACHE_DIR = get_cache_dir()
-    os.makedirs(CACHE_DIR, exist_ok=True)
-    cache_file = CACHE_DIR / f"{event.user_id!s}.json"
-    if not cache_file.exists():
-        return None
-    async with aiofiles.open(cache_file, encoding="utf-8") as f:
-        cache = OmikujiCache.model_validate_json(await f.read())
-    if cache.timestamp.date() == datetime.now().date():
-        return cache.data
-    else:
-        os.remove(str(cache_file))
+    data = await get_draw_store().fetch(str(event.user_id))
+    DRAW_CACHE.inc("miss" if data is None else "hit")
+    return data
 
 
 class OmikujiCacheContent(BaseModel):
@@ -59,136 +59,248 @@ class OmikujiCacheData(BaseModel):
     created_date: str
     updated_date: str
 
-    @overload
-    @classmethod
-    async def get(cls, level: str, theme: THEME_TYPE) -> Self | None: ...
+    last_expired_at: ClassVar[datetime | None] = None
 
-    @overload
     @classmethod
-    async def get(cls, level: str) -> dict[str, Self]: ...
+    async def cache_omikuji(cls, data: OmikujiData) -> None:
+        await cls.cache_omikuji_many([data])
 
     @classmethod
-    async def get(
-        cls, level: str, theme: THEME_TYPE | None = None
-    ) -> Self | dict[str, Self] | None:
-        async with db_lock(theme, level):
+    async def cache_omikuji_many(cls, datas: Iterable[OmikujiData]) -> None:
+        """在同一个事务中写入多张御神签的语料，每个单元的版本号只增加一次"""
+        groups: dict[tuple[str, str], list[OmikujiData]] = {}
+        for data in datas:
+            groups.setdefault((data.level, data.theme), []).append(data)
+        if not groups:
+            return
+        today = datetime.now().strftime("%Y-%m-%d")
+        async with db_lock_many((theme, level) for level, theme in groups):
+            start = time.perf_counter()
             async with get_session() as session:
-                await cls._expire_cache(session=session)
-                if theme:
-                    stmt = select(SQLOmikujiCache).where(
-                        SQLOmikujiCache.level == level,
-                        SQLOmikujiCache.theme == theme,
-                    )
-                    result = await session.execute(stmt)
-                    data = result.scalar_one_or_none()
-                    if not data:
-                        return None
-                    return cls.model_validate(data, from_attributes=True)
-                else:
-                    stmt = select(SQLOmikujiCache).where(
-                        SQLOmikujiCache.level == level,
+                await lock_cells(session, ((theme, level) for level, theme in groups))
+                written = {
+                    key: await cls._write_cell(session, *key, items, today)
+                    for key, items in groups.items()
+                }
+                await session.commit()
+            CORPUS_SQL_SECONDS.observe(time.perf_counter() - start, "write")
+
+        index = get_corpus_index()
+        for (level, theme), items in groups.items():
+            created_date, version = written[(level, theme)]
+            current = index.get(level, theme)
+            if current is None and version == 1:
+                index.put(
+                    CorpusCell.build(
+                        level,
+                        theme,
+                        itertools.chain.from_iterable(map(iter_entries, items)),
+                        created_date,
+                        today,
+                        version,
                     )
-                    result = await session.execute(stmt)
-                    data = result.scalars().all()
-                    return {
-                        model.theme: cls.model_validate(model, from_attributes=True)
-                        for model in data
-                    }
+                )
+            elif current is not None and current.version + 1 == version:
+                index.put(current.merged(items, today, version))
+            else:
+                # 期间有其他进程写入，直接重新加载该单元
+                await index.reload_cell(level, theme)
 
     @classmethod
-    async def cache_omikuji(cls, data: OmikujiData) -> None:
-        config = get_config()
+    async def _write_cell(
+        cls,
+        session: AsyncSession,
+        level: str,
+        theme: str,
+        datas: Sequence[OmikujiData],
+        today: str,
+    ) -> tuple[str, int]:
+        """
+        写入一个单元的语料，调用方需持有该单元的锁
+
+        Returns:
+            (单元创建日期, 写入后的版本号)
+        """
+        await session.execute(
+            insert_ignore(session, SQLOmikujiCache).values(
+                level=level,
+                theme=theme,
+                created_date=today,
+                updated_date=today,
+                version=0,
+            )
+        )
+        where = (SQLOmikujiCache.level == level, SQLOmikujiCache.theme == theme)
+        await session.execute(
+            update(SQLOmikujiCache)
+            .where(*where)
+            .values(version=SQLOmikujiCache.version + 1, updated_date=today)
+        )
+        await session.execute(
+            insert_ignore(session, OmikujiCorpusEntry),
+            [
+                {
+                    "level": level,
+                    "theme": theme,
+                    "field": field,
+                    "section_name": section_name,
+                    "content": content,
+                    "content_hash": content_hash(content),
+                }
+                # 同一批次内的重复内容在插入前去重
+                for field, section_name, content in dict.fromkeys(
+                    itertools.chain.from_iterable(map(iter_entries, datas))
+                )
+            ],
+        )
+        await cls.evict(session, level, theme)
+        created_date, version = (
+            await session.execute(
+                select(SQLOmikujiCache.created_date, SQLOmikujiCache.version).where(
+                    *where
+                )
+            )
+        ).one()
+        return created_date, version
 
-        def unique_append(ls: list[dict[str, str]], content: str):
-            d = OmikujiCacheContent(content=content).model_dump()
-            if d not in ls:
-                ls.append(d)
-            while len(d) > config.omikuji_long_cache_update_max_count:
-                ls.pop(0)
+    @staticmethod
+    async def evict(session: AsyncSession, level: str, theme: str) -> int:
+        """
+        按先进先出淘汰超出 omikuji_long_cache_update_max_count 的语料条目，
+        上限同时作用于每个字段、每个板块的内容数量以及板块数量（板块至少保留 MAX_SECTIONS 个）。
 
-        async with db_lock(data.theme, data.level):
-            async with get_session() as session:
-                await cls._expire_cache(session=session)
-                stmt = (
-                    select(SQLOmikujiCache)
-                    .where(
-                        SQLOmikujiCache.theme == data.theme,
-                        SQLOmikujiCache.level == data.level,
+        Returns:
+            删除的条目数
+        """
+        config = get_config()
+        if (
+            config.omikuji_deterministic
+            and (
+                await session.execute(
+                    select(OmikujiCorpusSnapshot.id).where(
+                        OmikujiCorpusSnapshot.level == level,
+                        OmikujiCorpusSnapshot.theme == theme,
+                        OmikujiCorpusSnapshot.snapshot_date
+                        == datetime.now().strftime("%Y-%m-%d"),
                     )
-                    .with_for_update()
                 )
-                if (
-                    cache := (await session.execute(stmt)).scalar_one_or_none()
-                ) is None:
-                    cache = SQLOmikujiCache(
-                        theme=data.theme,
-                        level=data.level,
-                        sections={i.name: [i.content] for i in data.sections},
-                        intro=[
-                            OmikujiCacheContent(content=data.sign_number).model_dump()
-                        ],
-                        maxim=[OmikujiCacheContent(content=data.maxim).model_dump()],
-                        end=[OmikujiCacheContent(content=data.end).model_dump()],
-                        divine_title=[
-                            OmikujiCacheContent(content=data.divine_title).model_dump()
-                        ],
-                        sign_number=[
-                            OmikujiCacheContent(content=data.sign_number).model_dump()
-                        ],
-                    )
-                    session.add(cache)
-                    await session.commit()
-                    await session.refresh(cache)
-
-                sections = cache.sections
-                intro = cache.intro
-                maxim = cache.maxim
-                end = cache.end
-                divine_title = cache.divine_title
-                sign_number = cache.sign_number
-
-                for i in data.sections:
-                    if i.name not in sections:
-                        sections[i.name] = []
-                    if i.content not in sections[i.name]:
-                        sections[i.name].append(i.content)
-
-                unique_append(intro, data.intro)
-                unique_append(maxim, data.maxim)
-                unique_append(end, data.end)
-                unique_append(divine_title, data.divine_title)
-                unique_append(sign_number, data.sign_number)
-
-                cache.intro = intro
-                cache.sections = sections
-                cache.maxim = maxim
-                cache.end = end
-                cache.divine_title = divine_title
-                cache.sign_number = sign_number
+            ).scalar()
+            is not None
+        ):
+            # 当天已固定快照的单元暂不淘汰，避免快照中的语料被删除，次日写入时再淘汰
+            return 0
+        cap = config.omikuji_long_cache_update_max_count
+        cell = (
+            OmikujiCorpusEntry.level == level,
+            OmikujiCorpusEntry.theme == theme,
+        )
+        groups = (
+            await session.execute(
+                select(
+                    OmikujiCorpusEntry.field,
+                    OmikujiCorpusEntry.section_name,
+                    func.count(OmikujiCorpusEntry.id),
+                    func.min(OmikujiCorpusEntry.id),
+                )
+                .where(*cell)
+                .group_by(OmikujiCorpusEntry.field, OmikujiCorpusEntry.section_name)
+            )
+        ).all()
+        conditions = []
+        for field, section_name, count, _ in groups:
+            if count <= cap:
+                continue
+            group = (
+                OmikujiCorpusEntry.field == field,
+                OmikujiCorpusEntry.section_name == section_name,
+            )
+            cutoff = (
+                await session.execute(
+                    select(OmikujiCorpusEntry.id)
+                    .where(*cell, *group)
+                    .order_by(OmikujiCorpusEntry.id.desc())
+                    .offset(cap)
+                    .limit(1)
+                )
+            ).scalar_one()
+            conditions.append(and_(*group, OmikujiCorpusEntry.id <= cutoff))
+        sections = sorted(
+            (first_id, section_name)
+            for field, section_name, _, first_id in groups
+            if field == SECTION_FIELD
+        )
+        if len(sections) > (section_cap := max(cap, MAX_SECTIONS)):
+            conditions.append(
+                and_(
+                    OmikujiCorpusEntry.field == SECTION_FIELD,
+                    OmikujiCorpusEntry.section_name.in_(
+                        [name for _, name in sections[: len(sections) - section_cap]]
+                    ),
+                )
+            )
+        if not conditions:
+            return 0
+        result = await session.execute(
+            delete(OmikujiCorpusEntry).where(*cell, or_(*conditions))
+        )
+        return result.rowcount  # pyright: ignore[reportAttributeAccessIssue]
 
-                await session.commit()
+    @classmethod
+    async def expire_cache(cls) -> int:
+        """
+        清除过期的语料单元及其语料条目，由后台任务按 omikuji_cache_sweep_interval 定期调用。
 
-    @staticmethod
-    async def _expire_cache(*, session: AsyncSession) -> None:
+        Returns:
+            删除的单元数
+        """
         config = get_config()
+        deleted = entries = 0
         if not config.omikuji_long_cache_mode:
+            conditions = []
             if config.omikuji_cache_expire_days > 0:
                 expire_time = datetime.now() - timedelta(
                     days=config.omikuji_cache_expire_days
                 )
-                await session.execute(
-                    delete(SQLOmikujiCache).where(
-                        SQLOmikujiCache.created_date < expire_time.strftime("%Y-%m-%d")
-                    )
+                conditions.append(
+                    SQLOmikujiCache.created_date < expire_time.strftime("%Y-%m-%d")
                 )
-                await session.commit()
             if config.omikuji_cache_update_expire_days > 0:
                 expire_time = datetime.now() - timedelta(
                     days=config.omikuji_cache_update_expire_days
                 )
-                await session.execute(
-                    delete(SQLOmikujiCache).where(
-                        SQLOmikujiCache.updated_date < expire_time.strftime("%Y-%m-%d")
-                    )
+                conditions.append(
+                    SQLOmikujiCache.updated_date < expire_time.strftime("%Y-%m-%d")
                 )
-                await session.commit()
+            if conditions:
+                # 需要删除的单元在查询前无法确定，锁定所有单元，
+                # 避免与本进程或其他进程对同一单元的写入交错
+                keys = list(itertools.product(OMIKUJI_THEMES, LEVEL))
+                expired: list[tuple[str, str]] = []
+                async with db_lock_many(keys):
+                    start = time.perf_counter()
+                    async with get_session() as session:
+                        await lock_cells(session, keys)
+                        stmt = select(SQLOmikujiCache).where(or_(*conditions))
+                        for cell in (await session.execute(stmt)).scalars().all():
+                            result = await session.execute(
+                                delete(OmikujiCorpusEntry).where(
+                                    OmikujiCorpusEntry.level == cell.level,
+                                    OmikujiCorpusEntry.theme == cell.theme,
+                                )
+                            )
+                            entries += result.rowcount  # pyright: ignore[reportAttributeAccessIssue]
+                            expired.append((cell.level, cell.theme))
+                            await session.delete(cell)
+                        await session.commit()
+                    CORPUS_SQL_SECONDS.observe(time.perf_counter() - start, "expire")
+                    # 立即从语料索引中移除，不必等到下次同步
+                    index = get_corpus_index()
+                    for level, theme in expired:
+                        index.remove(level, theme)
+                deleted = len(expired)
+        cls.last_expired_at = datetime.now()
+        if deleted:
+            logger.info(f"已清除 {deleted} 个过期语料单元（共 {entries} 条语料）")
+        else:
+            logger.debug("没有需要清除的过期语料缓存")
+        return deleted
@@ -0,0 +1,308 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import functools
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any
+
+from nonebot import logger
+
+from . import card_draw
+from .card_draw import draw_card
+from .config import get_cache_dir, get_config
+from .metrics import CARD_CACHE, FORMAT_SECONDS, REGISTRY, Gauge
+from .models import OmikujiData
+from .singleflight import SingleFlight
+
+# 修改卡片样式时递增，使旧的缓存失效
+CARD_VERSION = 1
+
+# 未配置 omikuji_card_font 时依次尝试的中文字体
+FONT_CANDIDATES = (
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
+    "/usr/share/fonts/wqy-microhei/wqy-microhei.ttc",
+    "/System/Library/Fonts/PingFang.ttc",
+    "/System/Library/Fonts/STHeiti Medium.ttc",
+    "C:/Windows/Fonts/msyh.ttc",
+    "C:/Windows/Fonts/simhei.ttf",
+)
+
+CARD_FIELDS = {
+    "intro",
+    "sign_number",
+    "divine_title",
+    "level",
+    "theme",
+    "sections",
+    "maxim",
+    "end",
+}
+
+
+def card_available() -> bool:
+    """是否安装了 Pillow（可选依赖 nonebot-plugin-omikuji[card]）"""
+    return importlib.util.find_spec("PIL") is not None
+
+
+@functools.cache
+def resolve_font(configured: str) -> str:
+    """卡片使用的字体文件，找不到时返回空字符串（使用 Pillow 自带的字体，无法显示中文）"""
+    if configured:
+        return configured
+    for path in FONT_CANDIDATES:
+        if os.path.isfile(path):
+            return path
+    logger.warning(
+        "没有找到可用的中文字体，图片卡片将无法显示中文，请设置 OMIKUJI_CARD_FONT"
+    )
+    return ""
+
+
+def card_key(payload: dict[str, Any], font_path: str, width: int) -> str:
+    """卡片内容的哈希，内容、字体、宽度或样式版本相同的卡片共用缓存"""
+    raw = json.dumps(
+        [CARD_VERSION, payload, font_path, width], ensure_ascii=False, sort_keys=True
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class CardCache:
+    """
+    以内容哈希为键的磁盘 LRU 缓存，保存在缓存目录的 cards 子目录中。
+
+    访问顺序记录在内存中（启动时按文件修改时间恢复，命中时更新修改时间），
+    总大小超过 omikuji_card_cache_max_mb 时淘汰最久未使用的卡片。
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self.size = 0
+        self._loaded = False
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.png"
+
+    def _scan(self) -> list[tuple[float, str, int]]:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with os.scandir(self.directory) as it:
+            files = [
+                (entry.stat().st_mtime, entry.name[:-4], entry.stat().st_size)
+                for entry in it
+                if entry.name.endswith(".png")
+            ]
+        return sorted(files)
+
+    async def load(self) -> int:
+        if not self._loaded:
+            self._loaded = True
+            scanned = await asyncio.to_thread(self._scan)
+            loaded = self._entries
+            # 扫描期间写入的卡片排在最后
+            self._entries = OrderedDict((key, size) for _, key, size in scanned)
+            for key, size in loaded.items():
+                self._entries.pop(key, None)
+                self._entries[key] = size
+            self.size = sum(self._entries.values())
+            await self._evict()
+        return len(self._entries)
+
+    def _read(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    async def get(self, key: str) -> bytes | None:
+        await self.load()
+        if key not in self._entries:
+            return None
+        if (data := await asyncio.to_thread(self._read, key)) is None:
+            # 被其他进程淘汰
+            self.size -= self._entries.pop(key)
+            return None
+        self._entries.move_to_end(key)
+        return data
+
+    def _write(self, key: str, data: bytes) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        tmp = path.with_name(f".{path.name}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    async def put(self, key: str, data: bytes) -> None:
+        await self.load()
+        await asyncio.to_thread(self._write, key, data)
+        self.size += len(data) - self._entries.pop(key, 0)
+        self._entries[key] = len(data)
+        await self._evict()
+
+    def _remove(self, keys: list[str]) -> None:
+        for key in keys:
+            self._path(key).unlink(missing_ok=True)
+
+    async def _evict(self) -> None:
+        limit = get_config().omikuji_card_cache_max_mb * 1024 * 1024
+        evicted: list[str] = []
+        while self._entries and self.size > limit:
+            key, size = self._entries.popitem(last=False)
+            self.size -= size
+            evicted.append(key)
+        if evicted:
+            await asyncio.to_thread(self._remove, evicted)
+            logger.debug(f"图片卡片缓存淘汰 {len(evicted)} 张")
+
+
+class CardWorkerPool:
+    """
+    绘制进程池：每个进程以脚本方式运行 card_draw.py，通过标准输入输出逐个处理请求。
+
+    运行中的机器人有多个线程，fork 出的子进程可能死锁；multiprocessing 的 spawn / forkserver
+    又会在子进程中重新执行机器人的入口脚本，因此直接启动独立的解释器。
+    进程异常退出或请求被取消时，下次使用前换一个新进程。
+    """
+
+    def __init__(self, size: int) -> None:
+        self._idle: asyncio.Queue[asyncio.subprocess.Process | None] = asyncio.Queue()
+        self._procs: set[asyncio.subprocess.Process] = set()
+        for _ in range(size):
+            self._idle.put_nowait(None)
+
+    async def _spawn(self) -> asyncio.subprocess.Process:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable,
+            card_draw.__file__,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        self._procs.add(proc)
+        return proc
+
+    async def draw(self, payload: dict[str, Any], font: str, width: int) -> bytes:
+        request = json.dumps([payload, font, width], ensure_ascii=False).encode()
+        proc = await self._idle.get()
+        try:
+            if proc is not None and proc.returncode is not None:
+                self._kill(proc)  # 进程已退出
+                proc = None
+            if proc is None:
+                proc = await self._spawn()
+            assert proc.stdin is not None
+            assert proc.stdout is not None
+            proc.stdin.write(len(request).to_bytes(4, "big") + request)
+            await proc.stdin.drain()
+            header = await proc.stdout.readexactly(5)
+            body = await proc.stdout.readexactly(int.from_bytes(header[1:], "big"))
+        except BaseException:
+            # 进程已退出，或请求被取消（之后的输出无法与请求对应），下次使用前换一个新进程
+            if proc is not None:
+                self._kill(proc)
+            self._idle.put_nowait(None)
+            raise
+        self._idle.put_nowait(proc)
+        if header[0]:
+            raise RuntimeError(body.decode(errors="replace"))
+        return body
+
+    def _kill(self, proc: asyncio.subprocess.Process) -> None:
+        self._procs.discard(proc)
+        if proc.returncode is None:
+            with contextlib.suppress(ProcessLookupError):
+                proc.kill()
+
+    async def _stop(self, proc: asyncio.subprocess.Process) -> None:
+        if proc.stdin is not None:
+            proc.stdin.close()  # 绘制进程读到输入结束后退出
+        try:
+            await asyncio.wait_for(proc.wait(), 5)
+        except asyncio.TimeoutError:
+            self._kill(proc)
+
+    async def close(self) -> None:
+        procs, self._procs = self._procs, set()
+        await asyncio.gather(*(self._stop(proc) for proc in procs))
+
+
+class CardRenderer:
+    """
+    图片卡片的渲染：在进程池中绘制，结果写入磁盘 LRU 缓存。
+
+    相同内容的并发渲染会被合并；绘制在 CardWorkerPool 的进程中进行，
+    omikuji_card_workers 为 0 时在线程中绘制。
+    """
+
+    def __init__(self) -> None:
+        self.cache = CardCache(get_cache_dir() / "cards")
+        self._flight: SingleFlight[str, bytes] = SingleFlight()
+        self._pool: CardWorkerPool | None = None
+
+    async def start(self) -> None:
+        await self.cache.load()
+        if self._pool is None and (workers := get_config().omikuji_card_workers) > 0:
+            self._pool = CardWorkerPool(workers)
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def render(self, data: OmikujiData) -> bytes:
+        config = get_config()
+        font = resolve_font(config.omikuji_card_font)
+        payload = data.model_dump(include=CARD_FIELDS)
+        key = card_key(payload, font, config.omikuji_card_width)
+        if (image := await self.cache.get(key)) is not None:
+            CARD_CACHE.inc("hit")
+            return image
+        image, shared = await self._flight.do(
+            key, lambda: self._draw(key, payload, font, config.omikuji_card_width)
+        )
+        CARD_CACHE.inc("coalesced" if shared else "miss")
+        return image
+
+    async def _draw(
+        self, key: str, payload: dict[str, Any], font: str, width: int
+    ) -> bytes:
+        with FORMAT_SECONDS.time("card"):
+            if self._pool is not None:
+                image = await self._pool.draw(payload, font, width)
+            else:
+                image = await asyncio.to_thread(draw_card, payload, font, width)
+        await self.cache.put(key, image)
+        return image
+
+
+_RENDERER = CardRenderer()
+
+
+def get_card_renderer() -> CardRenderer:
+    return _RENDERER
+
+
+def _collect_cache_stats() -> list[Gauge]:
+    size = Gauge("omikuji_card_cache_bytes", "图片卡片磁盘缓存的总大小")
+    entries = Gauge("omikuji_card_cache_entries", "图片卡片磁盘缓存的卡片数")
+    size.set(_RENDERER.cache.size)
+    entries.set(len(_RENDERER.cache))
+    return [size, entries]
+
+
+REGISTRY.add_collector(_collect_cache_stats)
@@ -0,0 +1,135 @@
+"""
+图片卡片的绘制。
+
+本模块只依赖 Pillow 与标准库，不能导入 nonebot 或插件的其他模块：
+绘制进程以脚本方式运行本文件（见 card.py 中的 CardWorkerPool），不导入插件包，
+也不会像 multiprocessing 的子进程那样重新执行机器人的入口脚本。
+
+绘制进程的协议：从标准输入逐个读取请求（4 字节长度 + JSON [payload, font_path, width]），
+向标准输出写入结果（1 字节状态 + 4 字节长度 + PNG 图片或错误信息，状态为 0 表示成功）。
+"""
+
+from __future__ import annotations
+
+import functools
+import io
+import json
+import os
+import sys
+from typing import Any, BinaryIO
+
+# 各运势的主题色
+LEVEL_COLORS = {
+    "大吉": (196, 30, 58),
+    "吉": (214, 76, 50),
+    "中吉": (222, 120, 40),
+    "小吉": (196, 150, 30),
+    "末吉": (110, 140, 70),
+    "凶": (80, 90, 120),
+    "大凶": (60, 50, 80),
+}
+_PAPER = (250, 245, 232)
+_INK = (50, 40, 35)
+_MUTED = (120, 105, 95)
+
+
+@functools.lru_cache(maxsize=16)
+def _font(path: str, size: int) -> Any:
+    from PIL import ImageFont
+
+    if not path:
+        return ImageFont.load_default(size)
+    return ImageFont.truetype(path, size)
+
+
+def _wrap(text: str, font: Any, width: float) -> list[str]:
+    """按字符折行（中文没有空格分词），保留原有的换行"""
+    lines: list[str] = []
+    for paragraph in text.splitlines() or [""]:
+        line, used = "", 0.0
+        for char in paragraph:
+            advance = font.getlength(char)
+            if line and used + advance > width:
+                lines.append(line)
+                line, used = "", 0.0
+                if char.isspace():
+                    continue
+            line += char
+            used += advance
+        lines.append(line)
+    return lines
+
+
+def draw_card(data: dict[str, Any], font_path: str, width: int) -> bytes:
+    """把一张御神签绘制为 PNG 图片"""
+    from PIL import Image, ImageDraw
+
+    accent = LEVEL_COLORS.get(data["level"], _INK)
+    pad = width // 14
+    inner = width - pad * 2
+    title, level, body, small = (
+        _font(font_path, width // size) for size in (18, 8, 26, 32)
+    )
+
+    # (文本, 字体, 颜色, 是否居中, 之后的间距)
+    blocks: list[tuple[str, Any, tuple[int, int, int], bool, int]] = [
+        (f"御神签 第{data['sign_number']}", title, _MUTED, True, pad // 3),
+        (data["level"], level, accent, True, pad // 6),
+        (data["theme"], small, _MUTED, True, pad // 2),
+        (f"天启：{data['divine_title']}", body, accent, False, pad // 3),
+        (data["intro"], body, _INK, False, pad // 2),
+    ]
+    for section in data["sections"]:
+        blocks.append((f"【{section['name']}】", body, accent, False, pad // 8))
+        blocks.append((section["content"], body, _INK, False, pad // 3))
+    blocks.append((f"真言偈：{data['maxim']}", body, accent, False, pad // 3))
+    blocks.append((data["end"], small, _MUTED, False, 0))
+
+    laid_out: list[tuple[list[str], Any, tuple[int, int, int], bool, int, int]] = []
+    height = pad * 2
+    for text, font, color, center, gap in blocks:
+        line_height = int(font.size * 1.45)
+        lines = _wrap(text, font, inner)
+        laid_out.append((lines, font, color, center, line_height, gap))
+        height += line_height * len(lines) + gap
+
+    image = Image.new("RGB", (width, height), _PAPER)
+    draw = ImageDraw.Draw(image)
+    border = max(2, width // 180)
+    draw.rectangle(
+        (border, border, width - border - 1, height - border - 1),
+        outline=accent,
+        width=border,
+    )
+    y = pad
+    for lines, font, color, center, line_height, gap in laid_out:
+        for line in lines:
+            x = (width - font.getlength(line)) / 2 if center else pad
+            draw.text((x, y), line, font=font, fill=color)
+            y += line_height
+        y += gap
+    buf = io.BytesIO()
+    image.save(buf, "PNG")
+    return buf.getvalue()
+
+
+def _handle(request: bytes) -> tuple[int, bytes]:
+    try:
+        return 0, draw_card(*json.loads(request))
+    except Exception as e:
+        return 1, repr(e).encode()
+
+
+def serve(stdin: BinaryIO, stdout: BinaryIO) -> None:
+    """绘制进程的主循环，标准输入关闭时退出"""
+    while header := stdin.read(4):
+        status, body = _handle(stdin.read(int.from_bytes(header, "big")))
+        stdout.write(bytes((status,)) + len(body).to_bytes(4, "big") + body)
+        stdout.flush()
+
+
+if __name__ == "__main__":
+    # 结果写入原来的标准输出，其余输出（如第三方库的打印）转到标准错误，避免破坏协议
+    out = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    serve(sys.stdin.buffer, out)
@@ -1,14 +1,20 @@
-import random
 import typing
+from datetime import date
+from pathlib import Path
 
 from nonebot import on_command
-from nonebot.adapters.onebot.v11 import Bot, GroupMessageEvent, Message, MessageEvent
+from nonebot.adapters.onebot.v11 import Bot, Message, MessageEvent
 from nonebot.params import CommandArg
+from nonebot.permission import SUPERUSER
 
-from .cache import cache_omikuji, get_cached_omikuji
-from .config import get_config
+from .concurrency import BUSY_MESSAGE, QueueFullError
+from .config import get_cache_dir, get_config
+from .corpus_transfer import export_corpus, import_corpus
+from .metrics import DRAW_SECONDS, summary
 from .models import OMIKUJI_THEMES, THEME_TYPE
-from .utils import format_omikuji, generate_omikuji
+from .ratelimit import get_rate_limiter, throttled_message
+from .render import HeaderStream
+from .utils import draw_omikuji
 
 omikuji = on_command(
     "omikuji",
@@ -21,18 +27,77 @@ omikuji = on_command(
 
 @omikuji.handle()
 async def _(bot: Bot, event: MessageEvent, args: Message = CommandArg()):
+    if wait := get_rate_limiter().check(event):
+        await omikuji.finish(throttled_message(wait))
+    theme: THEME_TYPE | None = None
     if args:
-        theme = args.extract_plain_text()
-        if theme not in OMIKUJI_THEMES:
+        text = args.extract_plain_text()
+        if text not in OMIKUJI_THEMES:
             await omikuji.finish(
                 f"当前可用御神签主题：{''.join(i + ',' for i in OMIKUJI_THEMES)}"
             )
-    else:
-        theme = random.choice(list(OMIKUJI_THEMES))
-    theme = typing.cast(THEME_TYPE, theme)
-    is_group = isinstance(event, GroupMessageEvent)
-    if (data := await get_cached_omikuji(event)) is None:
-        data = await generate_omikuji(theme, is_group)
-        await cache_omikuji(event, data)
-    msg = format_omikuji(data)
+        theme = typing.cast(THEME_TYPE, text)
+    header = HeaderStream(omikuji.send, "command", event)
+    try:
+        with DRAW_SECONDS.time("command"):
+            data = await draw_omikuji(event, theme, on_field=header)
+            msg = await header.rest(data)
+    except QueueFullError:
+        await omikuji.finish(BUSY_MESSAGE)
     await omikuji.finish(msg)
+
+
+omikuji_stats = on_command(
+    "omikuji_stats",
+    aliases={"御神签统计"},
+    permission=SUPERUSER,
+    priority=10,
+    block=True,
+)
+
+
+@omikuji_stats.handle()
+async def _():
+    await omikuji_stats.finish(summary())
+
+
+omikuji_export = on_command(
+    "omikuji_export",
+    aliases={"导出御神签语料"},
+    permission=SUPERUSER,
+    priority=10,
+    block=True,
+)
+
+
+@omikuji_export.handle()
+async def _(args: Message = CommandArg()):
+    path = Path(
+        args.extract_plain_text().strip()
+        or get_cache_dir() / f"omikuji-corpus-{date.today():%Y%m%d}.jsonl.gz"
+    )
+    try:
+        stats = await export_corpus(path)
+    except (OSError, RuntimeError) as e:
+        await omikuji_export.finish(f"导出失败：{e}")
+    await omikuji_export.finish(f"{stats.summary('导出')}\n文件：{path}")
+
+
+omikuji_import = on_command(
+    "omikuji_import",
+    aliases={"导入御神签语料"},
+    permission=SUPERUSER,
+    priority=10,
+    block=True,
+)
+
+
+@omikuji_import.handle()
+async def _(args: Message = CommandArg()):
+    if not (text := args.extract_plain_text().strip()):
+        await omikuji_import.finish("请指定要导入的语料文件路径")
+    try:
+        stats = await import_corpus(Path(text))
+    except (OSError, RuntimeError, ValueError) as e:
+        await omikuji_import.finish(f"导入失败：{e}")
+    await omikuji_import.finish(stats.summary("导入"))
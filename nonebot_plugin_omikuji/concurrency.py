@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import time
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Iterator
+from contextvars import ContextVar
+
+from .config import get_config
+from .metrics import QUEUE_WAIT_SECONDS, REGISTRY, Counter, Gauge
+
+# 当前生成请求的发起者 (分组, 用户)，为 None 时视为后台任务（预热、语料更新）
+_REQUESTER: ContextVar[tuple[str, str] | None] = ContextVar(
+    "omikuji_requester", default=None
+)
+
+# 为 True 时用户请求不受 omikuji_llm_max_queue 限制，只排队等待
+_UNBOUNDED: ContextVar[bool] = ContextVar("omikuji_unbounded_queue", default=False)
+
+
+BUSY_MESSAGE = "求签的人太多啦，签筒一时摇不过来... 请稍后再来抽签吧。"
+
+
+class QueueFullError(RuntimeError):
+    """等待生成的用户请求过多，新的请求未被接受"""
+
+
+def current_group() -> str | None:
+    """当前生成请求所在的分组（群号，私聊时为 private:用户），后台任务为 None"""
+    return requester[0] if (requester := _REQUESTER.get()) is not None else None
+
+
+@contextlib.contextmanager
+def requesting(group: str, user: str) -> Iterator[None]:
+    """在此范围内发起的 LLM 生成归属于 (group, user)，参与公平排队"""
+    token = _REQUESTER.set((group, user))
+    try:
+        yield
+    finally:
+        _REQUESTER.reset(token)
+
+
+@contextlib.contextmanager
+def unbounded_queue() -> Iterator[None]:
+    """在此范围内发起的用户请求在排队已满时继续排队，不抛出 QueueFullError"""
+    token = _UNBOUNDED.set(True)
+    try:
+        yield
+    finally:
+        _UNBOUNDED.reset(token)
+
+
+@contextlib.contextmanager
+def in_background() -> Iterator[None]:
+    """在此范围内发起的 LLM 生成视为后台任务（后台任务会继承创建时的发起者）"""
+    token = _REQUESTER.set(None)
+    try:
+        yield
+    finally:
+        _REQUESTER.reset(token)
+
+
+class GenerationLimiter:
+    """
+    LLM 生成的全局并发限制与公平排队。
+
+    同时进行的生成不超过 omikuji_llm_max_concurrency，其余请求排队：
+    用户请求先在分组（群聊，私聊时为用户本身）之间轮转，再在同一分组的用户之间轮转，
+    同一用户的请求按先后顺序；后台任务只在没有用户请求等待时执行。
+    排队的用户请求达到 omikuji_llm_max_queue 时，新的请求抛出 QueueFullError
+    （在 unbounded_queue 范围内发起的除外）。
+    """
+
+    def __init__(self) -> None:
+        self._groups: OrderedDict[
+            str, OrderedDict[str, deque[asyncio.Future[None]]]
+        ] = OrderedDict()
+        self._background: deque[asyncio.Future[None]] = deque()
+        self.in_flight: int = 0
+        self.waiting: int = 0  # 排队中的用户请求数
+        self.waiting_background: int = 0
+        self.admitted: int = 0
+        self.queued: int = 0
+        self.rejected: int = 0
+
+    def _enqueue(self, requester: tuple[str, str] | None) -> asyncio.Future[None]:
+        future = asyncio.get_running_loop().create_future()
+        if requester is None:
+            self._background.append(future)
+            self.waiting_background += 1
+            return future
+        group, user = requester
+        users = self._groups.setdefault(group, OrderedDict())
+        users.setdefault(user, deque()).append(future)
+        self.waiting += 1
+        return future
+
+    def _next(self) -> asyncio.Future[None] | None:
+        """按轮转顺序取出下一个仍在等待的请求（跳过已取消的）"""
+        while self._groups:
+            group, users = next(iter(self._groups.items()))
+            user, futures = next(iter(users.items()))
+            future = futures.popleft()
+            if futures:
+                users.move_to_end(user)
+            else:
+                del users[user]
+            if users:
+                self._groups.move_to_end(group)
+            else:
+                del self._groups[group]
+            if not future.done():
+                self.waiting -= 1
+                return future
+        while self._background:
+            future = self._background.popleft()
+            if not future.done():
+                self.waiting_background -= 1
+                return future
+        return None
+
+    def _dispatch(self) -> None:
+        limit = get_config().omikuji_llm_max_concurrency
+        while self.in_flight < limit and (future := self._next()) is not None:
+            self.in_flight += 1
+            future.set_result(None)
+
+    async def acquire(self) -> None:
+        requester = _REQUESTER.get()
+        if (
+            self.in_flight < get_config().omikuji_llm_max_concurrency
+            and not self.waiting
+            and (requester is not None or not self.waiting_background)
+        ):
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        if (
+            requester is not None
+            and not _UNBOUNDED.get()
+            and self.waiting >= get_config().omikuji_llm_max_queue
+        ):
+            self.rejected += 1
+            raise QueueFullError(f"等待生成的请求已达上限（{self.waiting}）")
+        self.queued += 1
+        future = self._enqueue(requester)
+        lane = "background" if requester is None else "user"
+        start = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已分配到名额后才被取消，交给下一个请求
+                self.release()
+            else:
+                future.cancel()
+                if requester is None:
+                    self.waiting_background -= 1
+                else:
+                    self.waiting -= 1
+            raise
+        finally:
+            QUEUE_WAIT_SECONDS.observe(time.perf_counter() - start, lane)
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+_LIMITER = GenerationLimiter()
+
+
+def get_generation_limiter() -> GenerationLimiter:
+    return _LIMITER
+
+
+def _collect_queue_stats() -> list[Counter | Gauge]:
+    depth = Gauge(
+        "omikuji_generation_queue_depth",
+        "等待LLM生成名额的请求数",
+        ("lane",),
+    )
+    depth.set(_LIMITER.waiting, "user")
+    depth.set(_LIMITER.waiting_background, "background")
+    running = Gauge("omikuji_generation_running", "占用LLM生成名额的请求数")
+    running.set(_LIMITER.in_flight)
+    admission = Counter(
+        "omikuji_generation_admission_total",
+        "LLM生成请求的准入结果（admitted为直接执行，queued为排队，rejected为队列已满被拒绝）",
+        ("result",),
+    )
+    admission.inc("admitted", amount=_LIMITER.admitted)
+    admission.inc("queued", amount=_LIMITER.queued)
+    admission.inc("rejected", amount=_LIMITER.rejected)
+    return [depth, running, admission]
+
+
+REGISTRY.add_collector(_collect_queue_stats)
@@ -1,11 +1,21 @@
 from __future__ import annotations
 
 from pathlib import Path
+from typing import Literal
 
 from nonebot import get_plugin_config
 from nonebot_plugin_localstore import get_plugin_cache_dir
 from pydantic import BaseModel, model_validator
 
+from .models import LEVEL, resolve_level_weights
+from .templates import (
+    DEFAULT_SECTION_TEMPLATE,
+    DEFAULT_TEMPLATE,
+    MESSAGE_FIELDS,
+    SECTION_FIELDS,
+    Template,
+)
+
 
 class Config(BaseModel):
     """
@@ -24,11 +34,110 @@ class Config(BaseModel):
     omikuji_cache_update_expire_days: int = (
         7  # 更新时间差大于这个数值就会清除缓存(-1表示不检查更新时间)
     )
+    omikuji_cache_sweep_interval: float = (
+        3600  # 过期语料缓存的后台清理间隔秒数(仅在非长期缓存模式下删除数据)
+    )
+    omikuji_corpus_refresh_interval: float = (
+        30  # 检查其他进程是否写入了语料库的间隔秒数(用于同步进程内的语料索引)
+    )
     omikuji_long_cache_mode: bool = True  # 启用长期缓存模式(不会清除缓存)
     omikuji_long_cache_update: bool = True  # 仅在语料库长期模式下生效，是否自动更新语料
     omikuji_long_cache_update_days: int = 3  # 仅在语料库长期模式下生效，同一个Level和主题添加缓存内容的间隔天数(0为不更新,即使命中内容过少也会命中)
-    omikuji_long_cache_update_max_count: int = (
-        100  # 仅在语料库长期模式下生效，添加缓存内容的最大数量
+    omikuji_long_cache_refresh_ratio: float = 0.2  # 仅在语料库长期模式下生效，语料超过更新间隔后，命中的请求中触发后台更新的比例
+    omikuji_long_cache_update_max_count: int = 100  # 语料库中每个字段/板块保留的内容数量上限(同时限制板块数量)，超过时淘汰最早加入的内容
+    omikuji_draw_store: Literal["memory", "database"] = (
+        "database"  # 用户每日抽签结果的存储方式(memory为仅内存，database为内存+数据库持久化)
+    )
+    omikuji_draw_flush_interval: float = 5.0  # 每日抽签结果写入数据库的间隔秒数
+    omikuji_coordination: Literal["local", "database"] = (
+        "local"  # 多进程协调方式(local为单进程，database为多进程/多节点共享数据库：每日抽签以数据库中先写入的结果为准，语料写入使用数据库锁，此时忽略omikuji_draw_store)
+    )
+    omikuji_corpus_write_behind: bool = (
+        True  # 生成结果是否先放入缓冲再批量写入语料库(用户无需等待数据库写入)
+    )
+    omikuji_corpus_flush_interval: float = 2.0  # 语料写入缓冲的写入间隔秒数
+    omikuji_corpus_flush_batch_size: int = 32  # 语料写入缓冲达到该数量时立即写入
+    omikuji_corpus_max_pending: int = 1000  # 语料写入缓冲的最大数量
+    omikuji_corpus_overflow_policy: Literal["block", "drop_oldest", "drop_newest"] = (
+        "block"  # 语料写入缓冲已满时的处理方式(block为等待写入，drop_oldest为丢弃最早的内容，drop_newest为丢弃新内容)
+    )
+    omikuji_corpus_block_timeout: float = (
+        5.0  # block时最多等待的秒数，超时后丢弃新内容(数据库不可用时不会一直等待)
+    )
+    omikuji_deterministic: bool = False  # 确定性抽签模式，运势与语料由(用户, 日期, 主题, 盐)决定，重复抽签直接重新计算，只保存LLM生成的结果
+    omikuji_deterministic_salt: str = (
+        ""  # 确定性抽签模式的盐，修改后所有用户当天的结果都会改变
+    )
+    omikuji_generation_share_policy: Literal["reuse", "resample"] = (
+        "reuse"  # 相同主题和运势的并发生成被合并时，其余请求的处理方式(reuse为直接复用结果，resample为从语料库/结果中重新抽取)
+    )
+    omikuji_level_weights: dict[
+        str, float
+    ] = {}  # 各运势的抽取权重，如{"大吉": 2, "大凶": 0.5}，未设置的运势权重为1
+    omikuji_theme_level_weights: dict[
+        str, dict[str, float]
+    ] = {}  # 按主题覆盖运势权重，如{"恋爱姻缘": {"大凶": 0}}
+    omikuji_group_level_weights: dict[
+        str, dict[str, float]
+    ] = {}  # 按群号覆盖运势权重(优先于主题，确定性抽签模式下不使用)，如节日活动时{"123456": {"大吉": 5}}
+    omikuji_user_rate_limit: float = 0  # 每个用户每分钟可抽签的次数(0为不限制)
+    omikuji_user_rate_burst: int = 3  # 每个用户最多可连续抽签的次数
+    omikuji_group_rate_limit: float = 0  # 每个群每分钟可抽签的次数(0为不限制)
+    omikuji_group_rate_burst: int = 10  # 每个群最多可连续抽签的次数
+    omikuji_rate_limit_compact_interval: float = (
+        300  # 清理频率限制中已空闲(令牌已补满)的记录的间隔秒数
+    )
+    omikuji_llm_max_concurrency: int = 4  # 同时进行的LLM生成数上限(包括预热与后台更新)
+    omikuji_llm_max_queue: int = (
+        32  # 排队等待生成的用户请求数上限，超过时按omikuji_queue_full_policy处理
+    )
+    omikuji_queue_full_policy: Literal["corpus", "reject"] = (
+        "corpus"  # 生成排队已满时的处理方式(corpus为改用语料库中最接近的单元，没有可用的语料时继续排队，reject为提示用户稍后再试)
+    )
+    omikuji_llm_timeout: float = 60  # 单次LLM调用的超时秒数
+    omikuji_llm_retries: int = 2  # LLM调用超时、失败或返回结果不可用时的重试次数
+    omikuji_llm_retry_backoff: float = (
+        1.0  # 重试的退避基准秒数，第n次重试前随机等待0至基准×2^(n-1)秒
+    )
+    omikuji_circuit_failure_threshold: int = (
+        5  # 同一上游(SuggarChat预设)连续失败该次数后熔断，期间不再调用
+    )
+    omikuji_circuit_reset_seconds: float = 30  # 熔断后经过该秒数放行一次探测调用
+    omikuji_llm_fallback: bool = True  # 生成最终失败时，是否改用语料库中最接近的单元(同主题的相邻运势，或同运势的其他主题)
+    omikuji_stream_generation: bool = (
+        True  # 抽签需要生成时，是否以流式方式生成并先发送签头(仅OpenAI协议的预设)
+    )
+    omikuji_render_mode: Literal["text", "rich", "card"] = (
+        "text"  # 御神签的发送方式(text为纯文本，rich为回复抽签消息，群聊中同时@抽签者，card为图片卡片，需要安装Pillow)
+    )
+    omikuji_card_font: str = (
+        ""  # 图片卡片使用的字体文件路径(为空时自动查找常见的中文字体)
+    )
+    omikuji_card_width: int = 720  # 图片卡片的宽度(像素)
+    omikuji_card_workers: int = 2  # 绘制图片卡片的进程数(0为在线程中绘制)
+    omikuji_card_cache_max_mb: float = (
+        64  # 图片卡片磁盘缓存的大小上限(MB)，超过时淘汰最久未使用的卡片
+    )
+    omikuji_template: str = DEFAULT_TEMPLATE  # 御神签的消息模板，可用字段见README
+    omikuji_section_template: str = (
+        DEFAULT_SECTION_TEMPLATE  # 每个板块的模板，可用字段为{name}与{content}
+    )
+    omikuji_metrics_dump_interval: float = 60  # 运行指标以Prometheus文本格式写入缓存目录下metrics.prom的间隔秒数(0为不写入)
+    omikuji_batch_size: int = (
+        4  # 语料预热与后台更新时，一次LLM调用生成的御神签数量上限(1为逐张生成)
+    )
+    omikuji_prewarm: bool = (
+        False  # 是否在后台预先生成语料，使每个运势和主题都有足够的缓存
+    )
+    omikuji_prewarm_interval: float = 600  # 语料预热的扫描间隔秒数
+    omikuji_prewarm_min_sections: int = 8  # 单元中板块种类少于该数量时视为语料不足
+    omikuji_prewarm_concurrency: int = 2  # 语料预热时同时进行的LLM请求数
+    omikuji_prewarm_token_budget: int = (
+        200000  # 语料预热每日可消耗的token数(估算值，-1表示不限制)
+    )
+    omikuji_prewarm_start_hour: int = 0  # 语料预热时间窗口的开始小时(包含)
+    omikuji_prewarm_end_hour: int = (
+        24  # 语料预热时间窗口的结束小时(不包含)，小于开始小时表示跨越零点
     )
 
     @model_validator(mode="after")
@@ -37,10 +146,93 @@ class Config(BaseModel):
             raise ValueError(
                 "omikuji_long_cache_update_max_count must be greater than 0"
             )
-        if self.omikuji_long_cache_update_days < 1:
-            raise ValueError("omikuji_long_cache_update_days must be greater than 0")
+        if self.omikuji_long_cache_update_days < 0:
+            raise ValueError("omikuji_long_cache_update_days must not be negative")
+        if not 0 <= self.omikuji_long_cache_refresh_ratio <= 1:
+            raise ValueError("omikuji_long_cache_refresh_ratio must be between 0 and 1")
+        if self.omikuji_cache_sweep_interval <= 0:
+            raise ValueError("omikuji_cache_sweep_interval must be greater than 0")
+        if self.omikuji_corpus_refresh_interval <= 0:
+            raise ValueError("omikuji_corpus_refresh_interval must be greater than 0")
+        if self.omikuji_draw_flush_interval <= 0:
+            raise ValueError("omikuji_draw_flush_interval must be greater than 0")
+        self._check_level_weights()
+        if self.omikuji_user_rate_limit < 0 or self.omikuji_group_rate_limit < 0:
+            raise ValueError("omikuji_user/group_rate_limit must not be negative")
+        if self.omikuji_user_rate_burst < 1 or self.omikuji_group_rate_burst < 1:
+            raise ValueError("omikuji_user/group_rate_burst must be greater than 0")
+        if self.omikuji_rate_limit_compact_interval <= 0:
+            raise ValueError(
+                "omikuji_rate_limit_compact_interval must be greater than 0"
+            )
+        if self.omikuji_llm_max_concurrency < 1:
+            raise ValueError("omikuji_llm_max_concurrency must be greater than 0")
+        if self.omikuji_llm_max_queue < 0:
+            raise ValueError("omikuji_llm_max_queue must not be negative")
+        if self.omikuji_llm_timeout <= 0:
+            raise ValueError("omikuji_llm_timeout must be greater than 0")
+        if self.omikuji_llm_retries < 0:
+            raise ValueError("omikuji_llm_retries must not be negative")
+        if self.omikuji_llm_retry_backoff < 0:
+            raise ValueError("omikuji_llm_retry_backoff must not be negative")
+        if self.omikuji_circuit_failure_threshold < 1:
+            raise ValueError("omikuji_circuit_failure_threshold must be greater than 0")
+        if self.omikuji_circuit_reset_seconds <= 0:
+            raise ValueError("omikuji_circuit_reset_seconds must be greater than 0")
+        if self.omikuji_metrics_dump_interval < 0:
+            raise ValueError("omikuji_metrics_dump_interval must not be negative")
+        if self.omikuji_corpus_flush_interval <= 0:
+            raise ValueError("omikuji_corpus_flush_interval must be greater than 0")
+        if self.omikuji_corpus_flush_batch_size < 1:
+            raise ValueError("omikuji_corpus_flush_batch_size must be greater than 0")
+        if self.omikuji_corpus_max_pending < self.omikuji_corpus_flush_batch_size:
+            raise ValueError(
+                "omikuji_corpus_max_pending must not be less than omikuji_corpus_flush_batch_size"
+            )
+        if self.omikuji_corpus_block_timeout <= 0:
+            raise ValueError("omikuji_corpus_block_timeout must be greater than 0")
+        if self.omikuji_card_width < 200:
+            raise ValueError("omikuji_card_width must be at least 200")
+        if self.omikuji_card_workers < 0:
+            raise ValueError("omikuji_card_workers must not be negative")
+        if self.omikuji_card_cache_max_mb <= 0:
+            raise ValueError("omikuji_card_cache_max_mb must be greater than 0")
+        Template.compile(self.omikuji_template, MESSAGE_FIELDS)
+        Template.compile(self.omikuji_section_template, SECTION_FIELDS)
+        if self.omikuji_batch_size < 1:
+            raise ValueError("omikuji_batch_size must be greater than 0")
+        if self.omikuji_prewarm_interval <= 0:
+            raise ValueError("omikuji_prewarm_interval must be greater than 0")
+        if self.omikuji_prewarm_min_sections < 4:
+            raise ValueError("omikuji_prewarm_min_sections must be at least 4")
+        if self.omikuji_prewarm_concurrency < 1:
+            raise ValueError("omikuji_prewarm_concurrency must be greater than 0")
+        if not (
+            0 <= self.omikuji_prewarm_start_hour <= 24
+            and 0 <= self.omikuji_prewarm_end_hour <= 24
+        ):
+            raise ValueError("omikuji_prewarm_start/end_hour must be between 0 and 24")
         return self
 
+    def _check_level_weights(self) -> None:
+        layers = [
+            self.omikuji_level_weights,
+            *self.omikuji_theme_level_weights.values(),
+            *self.omikuji_group_level_weights.values(),
+        ]
+        for weights in layers:
+            if unknown := set(weights) - set(LEVEL):
+                raise ValueError(f"unknown level in level weights: {unknown}")
+            if any(w < 0 for w in weights.values()):
+                raise ValueError("level weights must not be negative")
+        for group in (None, *self.omikuji_group_level_weights.values()):
+            for theme in (None, *self.omikuji_theme_level_weights.values()):
+                if (
+                    sum(resolve_level_weights(self.omikuji_level_weights, theme, group))
+                    <= 0
+                ):
+                    raise ValueError("level weights must not all be 0")
+
 
 CONFIG: Config = get_plugin_config(Config)
 CACHE_DIR: Path = get_plugin_cache_dir()
@@ -0,0 +1,303 @@
+from __future__ import annotations
+
+import itertools
+import random
+from collections import defaultdict
+from collections.abc import Iterable, Iterator, Sequence
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from nonebot import logger
+from nonebot_plugin_orm import AsyncSession, get_session
+from sqlalchemy import and_, or_, select
+
+from .config import get_config
+from .models import OmikujiData, OmikujiSections
+from .sql_models import OmikujiCache as SQLOmikujiCache
+from .sql_models import OmikujiCorpusEntry
+
+_rng = random.Random()
+
+
+def is_expired(created_date: str, updated_date: str) -> bool:
+    """语料是否已满足过期条件（后台清理任务尚未删除时，读取方据此跳过）"""
+    config = get_config()
+    if config.omikuji_long_cache_mode:
+        return False
+    now = datetime.now()
+    if config.omikuji_cache_expire_days > 0 and created_date < (
+        now - timedelta(days=config.omikuji_cache_expire_days)
+    ).strftime("%Y-%m-%d"):
+        return True
+    return config.omikuji_cache_update_expire_days > 0 and updated_date < (
+        now - timedelta(days=config.omikuji_cache_update_expire_days)
+    ).strftime("%Y-%m-%d")
+
+
+CORPUS_FIELDS = ("intro", "maxim", "end", "divine_title", "sign_number")
+SECTION_FIELD = "section"
+MAX_SECTIONS = 8  # 一张签最多包含的板块数量
+
+
+def iter_entries(data: OmikujiData) -> Iterator[tuple[str, str, str]]:
+    """将一张御神签展开为 (field, section_name, content) 语料条目"""
+    for section in data.sections:
+        yield SECTION_FIELD, section.name, section.content
+    for field in CORPUS_FIELDS:
+        yield field, "", getattr(data, field)
+
+
+@dataclass(slots=True)
+class CorpusCell:
+    """单个 (level, theme) 的语料，内容均已展开为元组以便直接抽样"""
+
+    level: str
+    theme: str
+    sections: dict[str, tuple[str, ...]]
+    section_names: tuple[str, ...]
+    intro: tuple[str, ...]
+    maxim: tuple[str, ...]
+    end: tuple[str, ...]
+    divine_title: tuple[str, ...]
+    sign_number: tuple[str, ...]
+    created_date: str
+    updated_date: str
+    version: int
+
+    @classmethod
+    def build(
+        cls,
+        level: str,
+        theme: str,
+        entries: Iterable[tuple[str, str, str]],
+        created_date: str,
+        updated_date: str,
+        version: int,
+    ) -> CorpusCell:
+        """
+        由按写入顺序排列的 (field, section_name, content) 条目构建。
+
+        重复内容只保留一份；每个字段、每个板块的内容以及板块数量
+        超过 omikuji_long_cache_update_max_count 时淘汰最早加入的部分
+        （板块数量至少保留 MAX_SECTIONS 个，保证可以凑满一张签）。
+        """
+        cap = get_config().omikuji_long_cache_update_max_count
+        # dict 作为有序集合，O(1) 去重且保持写入顺序
+        sections: dict[str, dict[str, None]] = {}
+        fields: dict[str, dict[str, None]] = {field: {} for field in CORPUS_FIELDS}
+        for field, section_name, content in entries:
+            if field == SECTION_FIELD:
+                sections.setdefault(section_name, {})[content] = None
+            elif field in fields:
+                fields[field][content] = None
+        section_names = tuple(sections)[-max(cap, MAX_SECTIONS) :]
+        return cls(
+            level=level,
+            theme=theme,
+            sections={k: tuple(sections[k])[-cap:] for k in section_names},
+            section_names=section_names,
+            intro=tuple(fields["intro"])[-cap:],
+            maxim=tuple(fields["maxim"])[-cap:],
+            end=tuple(fields["end"])[-cap:],
+            divine_title=tuple(fields["divine_title"])[-cap:],
+            sign_number=tuple(fields["sign_number"])[-cap:],
+            created_date=created_date,
+            updated_date=updated_date,
+            version=version,
+        )
+
+    @classmethod
+    def from_rows(
+        cls, cell: SQLOmikujiCache, entries: Iterable[OmikujiCorpusEntry]
+    ) -> CorpusCell:
+        return cls.build(
+            cell.level,
+            cell.theme,
+            ((e.field, e.section_name, e.content) for e in entries),
+            cell.created_date,
+            cell.updated_date,
+            cell.version,
+        )
+
+    def iter_entries(self) -> Iterator[tuple[str, str, str]]:
+        for name, contents in self.sections.items():
+            for content in contents:
+                yield SECTION_FIELD, name, content
+        for field in CORPUS_FIELDS:
+            for content in getattr(self, field):
+                yield field, "", content
+
+    def merged(
+        self, datas: Iterable[OmikujiData], updated_date: str, version: int
+    ) -> CorpusCell:
+        """返回按顺序追加了 datas 中语料的新单元"""
+        return CorpusCell.build(
+            self.level,
+            self.theme,
+            itertools.chain(
+                self.iter_entries(), *(iter_entries(data) for data in datas)
+            ),
+            self.created_date,
+            updated_date,
+            version,
+        )
+
+    @property
+    def samplable(self) -> bool:
+        """语料是否足以组合出一张御神签（至少 4 个板块且各字段均有内容）"""
+        return len(self.section_names) >= 4 and bool(
+            self.intro
+            and self.maxim
+            and self.end
+            and self.divine_title
+            and self.sign_number
+        )
+
+    def sample(self, rng: random.Random | None = None) -> OmikujiData | None:
+        """从语料中随机组合一张御神签，语料不足时返回 None"""
+        rng = rng or _rng
+        if not self.samplable:
+            return None
+        names = rng.sample(
+            self.section_names, min(MAX_SECTIONS, len(self.section_names))
+        )
+        return OmikujiData.model_construct(
+            level=self.level,
+            theme=self.theme,
+            sections=[
+                OmikujiSections.model_construct(
+                    name=name, content=rng.choice(self.sections[name])
+                )
+                for name in names
+            ],
+            sign_number=rng.choice(self.sign_number),
+            intro=rng.choice(self.intro),
+            divine_title=rng.choice(self.divine_title),
+            maxim=rng.choice(self.maxim),
+            end=rng.choice(self.end),
+        )
+
+
+async def load_cells(
+    session: AsyncSession, cells: Sequence[SQLOmikujiCache] | None = None
+) -> list[CorpusCell]:
+    """读取单元的全部语料条目，cells 为 None 时读取所有单元"""
+    if cells is None:
+        cells = (await session.execute(select(SQLOmikujiCache))).scalars().all()
+    if not cells:
+        return []
+    stmt = select(OmikujiCorpusEntry).order_by(OmikujiCorpusEntry.id)
+    if len(cells) < 16:
+        stmt = stmt.where(
+            or_(
+                *(
+                    and_(
+                        OmikujiCorpusEntry.level == cell.level,
+                        OmikujiCorpusEntry.theme == cell.theme,
+                    )
+                    for cell in cells
+                )
+            )
+        )
+    entries: defaultdict[tuple[str, str], list[OmikujiCorpusEntry]] = defaultdict(list)
+    for entry in (await session.execute(stmt)).scalars():
+        entries[(entry.level, entry.theme)].append(entry)
+    return [
+        CorpusCell.from_rows(cell, entries[(cell.level, cell.theme)]) for cell in cells
+    ]
+
+
+class CorpusIndex:
+    """
+    进程内的语料索引。
+
+    启动时从数据库全量加载；本进程写入时原地更新；
+    其他进程的写入通过比对每个单元的 version 定期发现并重新加载该单元。
+    """
+
+    def __init__(self) -> None:
+        self._cells: dict[tuple[str, str], CorpusCell] = {}
+
+    def get(self, level: str, theme: str) -> CorpusCell | None:
+        return self._cells.get((level, theme))
+
+    def put(self, cell: CorpusCell) -> None:
+        current = self._cells.get((cell.level, cell.theme))
+        if current is None or current.version <= cell.version:
+            self._cells[(cell.level, cell.theme)] = cell
+
+    def remove(self, level: str, theme: str) -> None:
+        self._cells.pop((level, theme), None)
+
+    def stage(self, data: OmikujiData) -> None:
+        """
+        将尚未写入数据库的语料先合并进索引，使其立即可被抽取。
+
+        版本号保持不变，写入完成后按正常流程再次合并（重复内容会被去重）。
+        """
+        today = datetime.now().strftime("%Y-%m-%d")
+        if (current := self._cells.get((data.level, data.theme))) is None:
+            cell = CorpusCell.build(
+                data.level, data.theme, iter_entries(data), today, today, 0
+            )
+        else:
+            cell = current.merged([data], current.updated_date, current.version)
+        self._cells[(data.level, data.theme)] = cell
+
+    def cells(self) -> list[CorpusCell]:
+        return list(self._cells.values())
+
+    def __len__(self) -> int:
+        return len(self._cells)
+
+    async def load(self) -> int:
+        async with get_session() as session:
+            cells = await load_cells(session)
+        self._cells = {(cell.level, cell.theme): cell for cell in cells}
+        return len(self._cells)
+
+    async def reload_cell(self, level: str, theme: str) -> CorpusCell | None:
+        async with get_session() as session:
+            stmt = select(SQLOmikujiCache).where(
+                SQLOmikujiCache.level == level, SQLOmikujiCache.theme == theme
+            )
+            if (row := (await session.execute(stmt)).scalar_one_or_none()) is None:
+                self._cells.pop((level, theme), None)
+                return None
+            cell = (await load_cells(session, [row]))[0]
+        self.put(cell)
+        return cell
+
+    async def refresh(self) -> int:
+        """
+        比对数据库中各单元的版本号，重新加载发生变化的单元并移除已删除的单元。
+
+        Returns:
+            发生变化的单元数量
+        """
+        async with get_session() as session:
+            rows = (await session.execute(select(SQLOmikujiCache))).scalars().all()
+            versions = {(row.level, row.theme) for row in rows}
+            stale = [
+                row
+                for row in rows
+                if (cell := self._cells.get((row.level, row.theme))) is None
+                or cell.version != row.version
+            ]
+            for cell in await load_cells(session, stale):
+                self.put(cell)
+        removed = [key for key in self._cells if key not in versions]
+        for key in removed:
+            del self._cells[key]
+        if stale or removed:
+            logger.debug(
+                f"语料索引已更新：重新加载 {len(stale)} 个单元，移除 {len(removed)} 个单元"
+            )
+        return len(stale) + len(removed)
+
+
+_INDEX = CorpusIndex()
+
+
+def get_corpus_index() -> CorpusIndex:
+    return _INDEX
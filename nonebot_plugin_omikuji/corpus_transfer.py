@@ -0,0 +1,346 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gzip
+import importlib
+import io
+import itertools
+import json
+import os
+import time
+import typing
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, BinaryIO
+
+from nonebot import logger
+from nonebot_plugin_orm import AsyncSession, get_session, init_orm
+from sqlalchemy import func, select, update
+
+from .cache import OmikujiCacheData
+from .corpus import CORPUS_FIELDS, SECTION_FIELD, get_corpus_index
+from .models import LEVEL, OMIKUJI_THEMES
+from .sql_models import OmikujiCache as SQLOmikujiCache
+from .sql_models import (
+    OmikujiCorpusEntry,
+    content_hash,
+    db_lock,
+    insert_ignore,
+    lock_cells,
+)
+from .write_behind import get_corpus_writer
+
+FORMAT = "omikuji-corpus"
+FORMAT_VERSION = 1
+
+_FIELDS = frozenset((SECTION_FIELD, *CORPUS_FIELDS))
+
+
+@dataclass
+class TransferStats:
+    cells: int = 0
+    entries: int = 0  # 导出或读取的语料条数
+    inserted: int = 0  # 导入时新增的语料条数（其余为已有的重复内容）
+    skipped: int = 0  # 导入时格式错误或主题、运势、字段未知而跳过的行数
+    seconds: float = 0.0
+
+    def summary(self, action: str) -> str:
+        text = f"{action}完成：{self.cells} 个单元，{self.entries} 条语料"
+        if action == "导入":
+            text += f"，新增 {self.inserted} 条，重复 {self.entries - self.inserted} 条"
+            if self.skipped:
+                text += f"，跳过 {self.skipped} 行无效内容"
+        return text + f"，耗时 {self.seconds:.2f}s"
+
+
+def open_corpus_file(path: Path, mode: str) -> BinaryIO:
+    """
+    按扩展名打开语料文件：.gz 为 gzip，.zst / .zstd 为 zstd（需要安装 zstandard），其余为不压缩
+
+    Args:
+        mode: "rb" 或 "wb"
+    """
+    suffix = path.suffix.lower()
+    if suffix == ".gz":
+        return typing.cast(BinaryIO, gzip.open(path, mode, compresslevel=6))
+    if suffix in (".zst", ".zstd"):
+        try:
+            zstandard = importlib.import_module("zstandard")
+        except ImportError as e:
+            raise RuntimeError(
+                "读写 zstd 文件需要安装 zstandard（pip install nonebot-plugin-omikuji[zstd]）"
+            ) from e
+        if mode == "wb":
+            return zstandard.open(path, "wb", cctx=zstandard.ZstdCompressor(level=10))
+        # 解压读取器不支持按行迭代
+        return io.BufferedReader(zstandard.open(path, "rb"))
+    return typing.cast(BinaryIO, open(path, mode))
+
+
+def _line(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+
+
+def _decode(raw: bytes) -> Any:
+    """解析一行，格式错误时返回 None"""
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return None
+
+
+def _read_lines(fp: BinaryIO, count: int) -> list[bytes]:
+    return list(itertools.islice(fp, count))
+
+
+async def export_corpus(path: Path, batch_size: int = 1000) -> TransferStats:
+    """
+    以流式方式导出语料库。
+
+    文件每行一个 JSON：第一行为文件头，之后每个单元先写一行单元信息（对象），
+    再逐行写入其语料 [field, section_name, content]（数组）。
+    语料按 id 分页读取，内存占用与语料库大小无关；先写入临时文件，完成后再替换目标文件。
+    """
+    start = time.perf_counter()
+    stats = TransferStats()
+    await get_corpus_writer().flush()
+    tmp = path.with_name(
+        f".{path.stem}.tmp{path.suffix}"
+    )  # 保留扩展名以使用相同的压缩方式
+    fp = await asyncio.to_thread(open_corpus_file, tmp, "wb")
+    try:
+        header = {
+            "format": FORMAT,
+            "version": FORMAT_VERSION,
+            "exported_at": datetime.now().isoformat(timespec="seconds"),
+        }
+        await asyncio.to_thread(fp.write, _line(header))
+        async with get_session() as session:
+            cells = (
+                (
+                    await session.execute(
+                        select(SQLOmikujiCache).order_by(
+                            SQLOmikujiCache.level, SQLOmikujiCache.theme
+                        )
+                    )
+                )
+                .scalars()
+                .all()
+            )
+            for cell in cells:
+                stats.entries += await _export_cell(session, fp, cell, batch_size)
+                stats.cells += 1
+    except BaseException:
+        await asyncio.to_thread(fp.close)
+        tmp.unlink(missing_ok=True)
+        raise
+    await asyncio.to_thread(fp.close)
+    os.replace(tmp, path)
+    stats.seconds = time.perf_counter() - start
+    logger.info(stats.summary("导出"))
+    return stats
+
+
+async def _export_cell(
+    session: AsyncSession, fp: BinaryIO, cell: SQLOmikujiCache, batch_size: int
+) -> int:
+    lines = [
+        _line(
+            {
+                "level": cell.level,
+                "theme": cell.theme,
+                "created_date": cell.created_date,
+                "updated_date": cell.updated_date,
+            }
+        )
+    ]
+    exported = last_id = 0
+    async with db_lock(cell.theme, cell.level, shared=True):
+        while True:
+            rows = (
+                await session.execute(
+                    select(
+                        OmikujiCorpusEntry.id,
+                        OmikujiCorpusEntry.field,
+                        OmikujiCorpusEntry.section_name,
+                        OmikujiCorpusEntry.content,
+                    )
+                    .where(
+                        OmikujiCorpusEntry.level == cell.level,
+                        OmikujiCorpusEntry.theme == cell.theme,
+                        OmikujiCorpusEntry.id > last_id,
+                    )
+                    .order_by(OmikujiCorpusEntry.id)
+                    .limit(batch_size)
+                )
+            ).all()
+            lines.extend(
+                _line([field, name, content]) for _, field, name, content in rows
+            )
+            await asyncio.to_thread(fp.write, b"".join(lines))
+            lines.clear()
+            exported += len(rows)
+            if len(rows) < batch_size:
+                return exported
+            last_id = rows[-1][0]
+
+
+async def import_corpus(path: Path, batch_size: int = 1000) -> TransferStats:
+    """
+    导入 export_corpus 导出的语料。
+
+    逐批读取文件，每个单元每 batch_size 条语料在一个事务中写入，
+    已有的内容由唯一约束去重；内存占用只与 batch_size 有关。
+    导入后按 omikuji_long_cache_update_max_count 淘汰超出上限的旧语料，并重新加载语料索引。
+
+    Raises:
+        ValueError: 文件头不是御神签语料格式，或版本高于当前支持的版本
+    """
+    start = time.perf_counter()
+    stats = TransferStats()
+    fp = await asyncio.to_thread(open_corpus_file, path, "rb")
+    try:
+        header = _decode(await asyncio.to_thread(fp.readline))
+        if not isinstance(header, dict) or header.get("format") != FORMAT:
+            raise ValueError(f"{path} 不是御神签语料文件")
+        if header.get("version", 0) > FORMAT_VERSION:
+            raise ValueError(f"不支持的语料文件版本：{header.get('version')}")
+        cell: dict[str, str] | None = None
+        batch: list[tuple[str, str, str]] = []
+        touched: list[tuple[str, str]] = []
+        while lines := await asyncio.to_thread(_read_lines, fp, batch_size):
+            for raw in lines:
+                item = _decode(raw)
+                if isinstance(item, dict):
+                    if cell is not None and batch:
+                        stats.inserted += await _import_batch(cell, batch)
+                        batch = []
+                    cell = _valid_cell(item)
+                    if cell is None:
+                        stats.skipped += 1
+                        continue
+                    stats.cells += 1
+                    touched.append((cell["level"], cell["theme"]))
+                elif cell is not None and _valid_entry(item):
+                    batch.append(tuple(item))
+                    stats.entries += 1
+                    if len(batch) >= batch_size:
+                        stats.inserted += await _import_batch(cell, batch)
+                        batch = []
+                elif raw.strip():
+                    stats.skipped += 1
+        if cell is not None and batch:
+            stats.inserted += await _import_batch(cell, batch)
+    finally:
+        await asyncio.to_thread(fp.close)
+    index = get_corpus_index()
+    for level, theme in dict.fromkeys(touched):
+        await index.reload_cell(level, theme)
+    stats.seconds = time.perf_counter() - start
+    logger.info(stats.summary("导入"))
+    return stats
+
+
+def _valid_cell(item: dict[str, Any]) -> dict[str, str] | None:
+    if item.get("level") not in LEVEL or item.get("theme") not in OMIKUJI_THEMES:
+        return None
+    today = datetime.now().strftime("%Y-%m-%d")
+    return {
+        "level": item["level"],
+        "theme": item["theme"],
+        "created_date": str(item.get("created_date") or today),
+        "updated_date": str(item.get("updated_date") or today),
+    }
+
+
+def _valid_entry(item: Any) -> bool:
+    return (
+        isinstance(item, list)
+        and len(item) == 3
+        and all(isinstance(value, str) for value in item)
+        and item[0] in _FIELDS
+        and bool(item[2])
+    )
+
+
+async def _import_batch(cell: dict[str, str], batch: list[tuple[str, str, str]]) -> int:
+    """在一个事务中写入一个单元的一批语料，返回新增的条数"""
+    level, theme = cell["level"], cell["theme"]
+    where = (OmikujiCorpusEntry.level == level, OmikujiCorpusEntry.theme == theme)
+    count = select(func.count(OmikujiCorpusEntry.id)).where(*where)
+    async with db_lock(theme, level), get_session() as session:
+        await lock_cells(session, [(theme, level)])
+        await session.execute(
+            insert_ignore(session, SQLOmikujiCache).values(
+                level=level,
+                theme=theme,
+                created_date=cell["created_date"],
+                updated_date=cell["updated_date"],
+                version=0,
+            )
+        )
+        # 版本号自增使其他进程重新加载该单元，更新日期保持不变
+        await session.execute(
+            update(SQLOmikujiCache)
+            .where(SQLOmikujiCache.level == level, SQLOmikujiCache.theme == theme)
+            .values(
+                version=SQLOmikujiCache.version + 1,
+                updated_date=SQLOmikujiCache.updated_date,
+            )
+        )
+        before = (await session.execute(count)).scalar_one()
+        await session.execute(
+            insert_ignore(session, OmikujiCorpusEntry),
+            [
+                {
+                    "level": level,
+                    "theme": theme,
+                    "field": field,
+                    "section_name": section_name if field == SECTION_FIELD else "",
+                    "content": content,
+                    "content_hash": content_hash(content),
+                }
+                for field, section_name, content in dict.fromkeys(batch)
+            ],
+        )
+        inserted = (await session.execute(count)).scalar_one() - before
+        await OmikujiCacheData.evict(session, level, theme)
+        await session.commit()
+    return inserted
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="nb omikuji-corpus", description="御神签语料导入导出"
+    )
+    parser.add_argument("action", choices=("export", "import"), help="导出或导入")
+    parser.add_argument("path", type=Path, help="语料文件路径")
+    parser.add_argument(
+        "--batch-size", type=int, default=1000, help="每次读取或写入的语料条数"
+    )
+    return parser.parse_args(argv)
+
+
+async def _run(args: argparse.Namespace) -> str:
+    # 与机器人启动时相同：检查数据库是否已更新到最新迁移
+    await init_orm()
+    if args.action == "export":
+        stats = await export_corpus(args.path, args.batch_size)
+        return stats.summary("导出")
+    stats = await import_corpus(args.path, args.batch_size)
+    return stats.summary("导入")
+
+
+def main(argv: list[str] | None = None) -> None:
+    """
+    nb-cli 脚本入口，在机器人的项目目录下执行：
+
+        nb omikuji-corpus export omikuji-corpus.jsonl.zst
+        nb omikuji-corpus import omikuji-corpus.jsonl.zst
+
+    nb-cli 按项目的 .env 与 pyproject.toml 初始化 NoneBot 并加载插件后调用本函数，不启动驱动器；
+    正在运行的机器人会在下次同步语料索引时读取导入的语料。
+    """
+    print(asyncio.run(_run(parse_args(argv))))
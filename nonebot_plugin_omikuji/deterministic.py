@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import hashlib
+import random
+import typing
+from collections.abc import Callable
+
+from nonebot_plugin_orm import AsyncSession, get_session
+from sqlalchemy import delete, func, select
+
+from .config import get_config
+from .corpus import CorpusCell
+from .draw_store import today
+from .levels import get_level_sampler
+from .models import OMIKUJI_THEMES, THEME_TYPE, OmikujiData
+from .sql_models import OmikujiCache as SQLOmikujiCache
+from .sql_models import OmikujiCorpusEntry, OmikujiCorpusSnapshot, insert_ignore
+
+
+def draw_rng(user_id: str, theme: str, date: str | None = None) -> random.Random:
+    """由 (user_id, 日期, 主题, omikuji_deterministic_salt) 派生的随机数生成器"""
+    key = "\x1f".join(
+        (user_id, date or today(), theme, get_config().omikuji_deterministic_salt)
+    )
+    seed = int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "big")
+    return random.Random(seed)
+
+
+def daily_theme(user_id: str) -> THEME_TYPE:
+    """未指定主题时，用户当天固定的主题"""
+    return typing.cast(THEME_TYPE, draw_rng(user_id, "").choice(OMIKUJI_THEMES))
+
+
+def store_key(user_id: str, theme: str) -> str:
+    """确定性模式下每日抽签记录的 key，每个主题各有一张签"""
+    return f"{user_id}:{theme}"
+
+
+class DailySnapshot:
+    """
+    当天固定的语料快照。
+
+    每个单元在当天第一次被确定性抽签使用时，以当时最大的语料条目 id 为水位固定，
+    之后只从 id 不超过水位的条目中抽取，新增的语料从次日开始生效。
+    水位保存在数据库中（先写入的进程生效），进程重启或多个进程时当天的结果保持一致；
+    已固定快照的单元当天不会淘汰旧语料（见 OmikujiCacheData.evict）。
+    """
+
+    def __init__(self) -> None:
+        self._date: str = ""
+        self._cells: dict[tuple[str, str], CorpusCell] = {}
+
+    async def get(self, level: str, theme: str) -> CorpusCell | None:
+        if (date := today()) != self._date:
+            self._date = date
+            self._cells = {}
+        if (cell := self._cells.get((level, theme))) is not None:
+            return cell
+        if (cell := await _load_snapshot(level, theme, date)) is not None:
+            self._cells[(level, theme)] = cell
+        return cell
+
+    def __len__(self) -> int:
+        return len(self._cells)
+
+
+async def _build(
+    session: AsyncSession,
+    level: str,
+    theme: str,
+    watermark: int,
+    created_date: str,
+    updated_date: str,
+) -> CorpusCell:
+    rows = await session.execute(
+        select(
+            OmikujiCorpusEntry.field,
+            OmikujiCorpusEntry.section_name,
+            OmikujiCorpusEntry.content,
+        )
+        .where(
+            OmikujiCorpusEntry.level == level,
+            OmikujiCorpusEntry.theme == theme,
+            OmikujiCorpusEntry.id <= watermark,
+        )
+        .order_by(OmikujiCorpusEntry.id)
+    )
+    return CorpusCell.build(
+        level, theme, rows.tuples(), created_date, updated_date, watermark
+    )
+
+
+async def _load_snapshot(level: str, theme: str, date: str) -> CorpusCell | None:
+    """读取单元当天的快照，尚未固定时以当前的语料固定；语料不足时不固定并返回 None"""
+    stmt = select(OmikujiCorpusSnapshot).where(
+        OmikujiCorpusSnapshot.level == level,
+        OmikujiCorpusSnapshot.theme == theme,
+        OmikujiCorpusSnapshot.snapshot_date == date,
+    )
+    async with get_session() as session:
+        if (snapshot := (await session.execute(stmt)).scalar_one_or_none()) is None:
+            row = (
+                await session.execute(
+                    select(SQLOmikujiCache).where(
+                        SQLOmikujiCache.level == level, SQLOmikujiCache.theme == theme
+                    )
+                )
+            ).scalar_one_or_none()
+            watermark = (
+                await session.execute(
+                    select(func.max(OmikujiCorpusEntry.id)).where(
+                        OmikujiCorpusEntry.level == level,
+                        OmikujiCorpusEntry.theme == theme,
+                    )
+                )
+            ).scalar()
+            if row is None or watermark is None:
+                return None
+            cell = await _build(
+                session, level, theme, watermark, row.created_date, row.updated_date
+            )
+            if not cell.samplable:
+                # 语料不足时不固定，之后补充的语料当天仍然可以使用
+                return None
+            await session.execute(
+                insert_ignore(session, OmikujiCorpusSnapshot).values(
+                    level=level,
+                    theme=theme,
+                    snapshot_date=date,
+                    watermark=watermark,
+                    created_date=row.created_date,
+                    updated_date=row.updated_date,
+                )
+            )
+            await session.commit()
+            snapshot = (await session.execute(stmt)).scalar_one()
+            if snapshot.watermark == watermark:
+                return cell
+        # 其他进程（或重启前）已经固定了快照
+        return await _build(
+            session,
+            level,
+            theme,
+            snapshot.watermark,
+            snapshot.created_date,
+            snapshot.updated_date,
+        )
+
+
+async def purge_snapshots() -> int:
+    """清除今天以前的语料快照，返回清除的数量"""
+    async with get_session() as session:
+        result = await session.execute(
+            delete(OmikujiCorpusSnapshot).where(
+                OmikujiCorpusSnapshot.snapshot_date < today()
+            )
+        )
+        await session.commit()
+    return result.rowcount  # pyright: ignore[reportAttributeAccessIssue]
+
+
+_SNAPSHOT = DailySnapshot()
+
+
+def get_daily_snapshot() -> DailySnapshot:
+    return _SNAPSHOT
+
+
+async def deterministic_sample(
+    user_id: str, theme: str, is_usable: Callable[[CorpusCell], bool]
+) -> tuple[str, OmikujiData | None]:
+    """
+    按种子确定运势（按全局与主题的运势权重），并从当天的语料快照中抽取。
+
+    不使用按群覆盖的权重，同一用户同一天同一主题在各个群与私聊中得到相同的结果。
+
+    Returns:
+        (运势, 抽取结果)，语料不足时结果为 None，需要以该运势调用 LLM 生成
+    """
+    rng = draw_rng(user_id, theme)
+    level = get_level_sampler().sample(theme, None, rng)
+    cell = await _SNAPSHOT.get(level, theme)
+    if cell is None or not is_usable(cell):
+        return level, None
+    return level, cell.sample(rng)
@@ -0,0 +1,301 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import os
+from abc import ABC, abstractmethod
+from datetime import date as date_
+from datetime import datetime, time
+from pathlib import Path
+
+from nonebot import logger
+from nonebot_plugin_orm import get_session
+from sqlalchemy import delete, select
+
+from .config import get_config
+from .models import OmikujiData
+from .sql_models import OmikujiDailyDraw, insert_ignore
+
+_BATCH_SIZE = 500
+
+
+def today() -> str:
+    return datetime.now().strftime("%Y-%m-%d")
+
+
+def _list_json_files(cache_dir: Path) -> list[str]:
+    if not cache_dir.is_dir():
+        return []
+    with os.scandir(cache_dir) as it:
+        return [entry.path for entry in it if entry.name.endswith(".json")]
+
+
+def _remove_if_stale(path: str, before: float) -> bool | None:
+    try:
+        if os.stat(path).st_mtime < before:
+            os.remove(path)
+            return True
+        return False
+    except OSError:
+        return None
+
+
+def _remove_stale_files(paths: list[str], before: float) -> tuple[int, int]:
+    results = [_remove_if_stale(path, before) for path in paths]
+    return results.count(True), results.count(None)
+
+
+async def sweep_cache_dir(
+    cache_dir: Path, batch_size: int = _BATCH_SIZE
+) -> tuple[int, int, int]:
+    """
+    清理旧版本遗留的 `<user_id>.json` 抽签缓存文件。
+
+    仅根据文件修改时间判断是否过期，不解析文件内容；文件操作按批次在线程中执行。
+
+    Returns:
+        (扫描文件数, 删除文件数, 处理失败数)
+    """
+    before = datetime.combine(date_.today(), time.min).timestamp()
+    paths = await asyncio.to_thread(_list_json_files, cache_dir)
+    removed = failed = 0
+    for i in range(0, len(paths), batch_size):
+        r, f = await asyncio.to_thread(
+            _remove_stale_files, paths[i : i + batch_size], before
+        )
+        removed += r
+        failed += f
+    return len(paths), removed, failed
+
+
+class DailyDrawStore(ABC):
+    """
+    用户每日抽签结果存储，按 (user_id, 日期) 索引。
+
+    内存中只保留当天的数据，跨天时整体丢弃。
+    """
+
+    def __init__(self) -> None:
+        self._date: str = today()
+        self._draws: dict[str, OmikujiData] = {}
+
+    def _rollover(self) -> str:
+        date = today()
+        if date != self._date:
+            self._date = date
+            self._draws = {}
+        return date
+
+    def get(self, user_id: str) -> OmikujiData | None:
+        self._rollover()
+        return self._draws.get(user_id)
+
+    def put(self, user_id: str, data: OmikujiData) -> None:
+        date = self._rollover()
+        self._draws[user_id] = data
+        self._persist(user_id, date, data)
+
+    def __len__(self) -> int:
+        return len(self._draws)
+
+    async def fetch(self, user_id: str) -> OmikujiData | None:
+        """读取用户今日的抽签结果（共享存储会查询其他进程写入的结果）"""
+        return self.get(user_id)
+
+    async def claim(self, user_id: str, data: OmikujiData) -> OmikujiData:
+        """
+        保存用户今日的抽签结果，返回最终生效的结果：
+        已有结果时（并发抽签或其他进程先写入）保留已有的结果
+        """
+        if (existing := self.get(user_id)) is not None:
+            return existing
+        self.put(user_id, data)
+        return data
+
+    @abstractmethod
+    def _persist(self, user_id: str, date: str, data: OmikujiData) -> None: ...
+
+    async def purge(self) -> int:
+        """清除持久化存储中今天以前的记录，返回清除的数量"""
+        return 0
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryDrawStore(DailyDrawStore):
+    """仅内存存储，重启后当天结果丢失"""
+
+    def _persist(self, user_id: str, date: str, data: OmikujiData) -> None:
+        pass
+
+
+class DatabaseDrawStore(DailyDrawStore):
+    """内存存储 + 定时批量写回数据库，启动时仅加载当天的记录"""
+
+    def __init__(self, flush_interval: float) -> None:
+        super().__init__()
+        self._flush_interval = flush_interval
+        self._pending: dict[tuple[str, str], OmikujiData] = {}
+        self._task: asyncio.Task | None = None
+        self._stop = asyncio.Event()
+
+    def _persist(self, user_id: str, date: str, data: OmikujiData) -> None:
+        self._pending[(user_id, date)] = data
+
+    async def load(self) -> int:
+        date = self._rollover()
+        async with get_session() as session:
+            stmt = select(OmikujiDailyDraw).where(OmikujiDailyDraw.draw_date == date)
+            rows = (await session.execute(stmt)).scalars().all()
+            for row in rows:
+                self._draws.setdefault(
+                    row.user_id, OmikujiData.model_validate(row.data)
+                )
+        return len(rows)
+
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        by_date: dict[str, dict[str, OmikujiData]] = {}
+        for (user_id, date), data in pending.items():
+            by_date.setdefault(date, {})[user_id] = data
+        try:
+            async with get_session() as session:
+                for date, draws in by_date.items():
+                    user_ids = list(draws)
+                    for i in range(0, len(user_ids), _BATCH_SIZE):
+                        batch = user_ids[i : i + _BATCH_SIZE]
+                        stmt = select(OmikujiDailyDraw).where(
+                            OmikujiDailyDraw.draw_date == date,
+                            OmikujiDailyDraw.user_id.in_(batch),
+                        )
+                        existing = {
+                            row.user_id: row
+                            for row in (await session.execute(stmt)).scalars()
+                        }
+                        for user_id in batch:
+                            data = draws[user_id].model_dump()
+                            if (row := existing.get(user_id)) is not None:
+                                row.data = data
+                            else:
+                                session.add(
+                                    OmikujiDailyDraw(
+                                        user_id=user_id, draw_date=date, data=data
+                                    )
+                                )
+                await session.commit()
+        except Exception:
+            # 写入失败时放回队列，等待下一次写回（期间的新数据优先）
+            for key, data in pending.items():
+                self._pending.setdefault(key, data)
+            raise
+        return len(pending)
+
+    async def purge(self) -> int:
+        return await _purge_database()
+
+    async def _flush_loop(self) -> None:
+        while not self._stop.is_set():
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._stop.wait(), self._flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning(f"每日抽签结果写入数据库失败：{e}")
+
+    async def start(self) -> None:
+        count = await self.load()
+        logger.info(f"已加载今日抽签记录 {count} 条")
+        self._stop.clear()
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            # 不取消写回循环，避免正在写入的记录被中断而丢失
+            self._stop.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+
+class SharedDrawStore(DailyDrawStore):
+    """
+    多进程 / 多节点共享的存储（omikuji_coordination 为 database 时使用）。
+
+    抽签结果直接写入数据库，由 (user_id, 日期) 的唯一约束保证只有第一个写入的结果生效，
+    其他进程写入失败后读取并返回已有的结果；内存中只缓存已经确定的结果。
+    """
+
+    def _persist(self, user_id: str, date: str, data: OmikujiData) -> None:
+        pass
+
+    @staticmethod
+    def _select(user_id: str, date: str):
+        return select(OmikujiDailyDraw.data).where(
+            OmikujiDailyDraw.user_id == user_id, OmikujiDailyDraw.draw_date == date
+        )
+
+    def _remember(self, user_id: str, date: str, data: OmikujiData) -> None:
+        if self._rollover() == date:
+            self._draws[user_id] = data
+
+    async def fetch(self, user_id: str) -> OmikujiData | None:
+        if (data := self.get(user_id)) is not None:
+            return data
+        date = self._date
+        async with get_session() as session:
+            stored = (await session.execute(self._select(user_id, date))).scalar()
+        if stored is None:
+            return None
+        data = OmikujiData.model_validate(stored)
+        self._remember(user_id, date, data)
+        return data
+
+    async def claim(self, user_id: str, data: OmikujiData) -> OmikujiData:
+        if (existing := self.get(user_id)) is not None:
+            return existing
+        date = self._date
+        async with get_session() as session:
+            await session.execute(
+                insert_ignore(session, OmikujiDailyDraw).values(
+                    user_id=user_id, draw_date=date, data=data.model_dump()
+                )
+            )
+            await session.commit()
+            stored = (await session.execute(self._select(user_id, date))).scalar_one()
+        winner = OmikujiData.model_validate(stored)
+        self._remember(user_id, date, winner)
+        return winner
+
+    async def purge(self) -> int:
+        return await _purge_database()
+
+
+async def _purge_database() -> int:
+    async with get_session() as session:
+        result = await session.execute(
+            delete(OmikujiDailyDraw).where(OmikujiDailyDraw.draw_date < today())
+        )
+        await session.commit()
+    return result.rowcount  # pyright: ignore[reportAttributeAccessIssue]
+
+
+_STORE: DailyDrawStore | None = None
+
+
+def get_draw_store() -> DailyDrawStore:
+    global _STORE
+    if _STORE is None:
+        config = get_config()
+        if config.omikuji_coordination == "database":
+            _STORE = SharedDrawStore()
+        elif config.omikuji_draw_store == "database":
+            _STORE = DatabaseDrawStore(config.omikuji_draw_flush_interval)
+        else:
+            _STORE = MemoryDrawStore()
+    return _STORE
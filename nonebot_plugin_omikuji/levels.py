@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import random
+from collections.abc import Sequence
+
+from .concurrency import current_group
+from .config import get_config
+from .models import LEVEL, resolve_level_weights
+
+
+class AliasTable:
+    """Walker 别名表：预处理 O(n)，之后按权重抽取下标为 O(1)"""
+
+    __slots__ = ("_alias", "_prob", "size")
+
+    def __init__(self, weights: Sequence[float]) -> None:
+        total = sum(weights)
+        if total <= 0 or any(w < 0 for w in weights):
+            raise ValueError("weights must be non-negative with a positive sum")
+        self.size = n = len(weights)
+        scaled = [w * n / total for w in weights]
+        self._prob = [1.0] * n
+        self._alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s, g = small.pop(), large.pop()
+            self._prob[s] = scaled[s]
+            self._alias[s] = g
+            scaled[g] -= 1 - scaled[s]
+            (small if scaled[g] < 1 else large).append(g)
+        # 剩余的项由浮点误差造成，概率视为 1
+
+    def sample(self, rng: random.Random | None = None) -> int:
+        u = (rng or random).random() * self.size
+        i = int(u)
+        return i if u - i < self._prob[i] else self._alias[i]
+
+
+class LevelSampler:
+    """
+    按权重抽取运势。
+
+    权重由 omikuji_level_weights（全局）、omikuji_theme_level_weights（按主题）、
+    omikuji_group_level_weights（按群）逐个运势覆盖；每种组合的别名表只构建一次，
+    配置对象被替换时重新构建。没有单独设置权重的主题与群共用同一张表。
+    """
+
+    def __init__(self) -> None:
+        self._source: tuple[object, ...] = ()
+        self._tables: dict[tuple[str, str], AliasTable] = {}
+
+    def table(self, theme: str = "", group: str | None = None) -> AliasTable:
+        config = get_config()
+        source = (
+            config.omikuji_level_weights,
+            config.omikuji_theme_level_weights,
+            config.omikuji_group_level_weights,
+        )
+        if len(source) != len(self._source) or any(
+            a is not b for a, b in zip(source, self._source)
+        ):
+            self._source = source
+            self._tables = {}
+        key = (
+            theme if theme in config.omikuji_theme_level_weights else "",
+            group if group in config.omikuji_group_level_weights else "",
+        )
+        if (table := self._tables.get(key)) is None:
+            table = self._tables[key] = AliasTable(
+                resolve_level_weights(
+                    config.omikuji_level_weights,
+                    config.omikuji_theme_level_weights.get(key[0]),
+                    config.omikuji_group_level_weights.get(key[1]),
+                )
+            )
+        return table
+
+    def sample(
+        self,
+        theme: str = "",
+        group: str | None = None,
+        rng: random.Random | None = None,
+    ) -> str:
+        return LEVEL[self.table(theme, group).sample(rng)]
+
+
+_SAMPLER = LevelSampler()
+
+
+def get_level_sampler() -> LevelSampler:
+    return _SAMPLER
+
+
+def sample_level(theme: str = "", rng: random.Random | None = None) -> str:
+    """按当前请求所在的群与主题的权重抽取运势"""
+    return _SAMPLER.sample(theme, current_group(), rng)
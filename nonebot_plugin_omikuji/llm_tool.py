@@ -1,3 +1,4 @@
+import time
 import typing
 
 from nonebot import get_bot, logger
@@ -7,50 +8,52 @@ from nonebot_plugin_suggarchat.API import (
     ToolData,
 )
 
-from nonebot_plugin_omikuji.cache import cache_omikuji, get_cached_omikuji
-
+from .concurrency import BUSY_MESSAGE, QueueFullError
 from .config import get_config
-from .models import FUNC_META, OmikujiData
-from .utils import generate_omikuji
-
-LEVEL = ["大吉", "吉", "中吉", "小吉", "末吉", "凶", "大凶"]
-
-
-def format_omikuji(data: OmikujiData, user_name: str | None = ""):
-    ln = "\n"
-    msg = f"""{data.intro}
-{(user_name + "，" if user_name else "")}你的签上刻了什么？
-
-＝＝＝ 御神签 第{data.sign_number} ＝＝＝
-✨ 天启：{data.divine_title}
-🌸 运势：{data.level} - {data.theme}
-
-{"".join(f"▫ {section.name}{ln}{section.content}{ln}" for section in data.sections)}
-
-⚖ 真言偈：{data.maxim}
-
-{data.end}
-"""
-    return msg
+from .metrics import DRAW_SECONDS
+from .models import FUNC_META
+from .ratelimit import get_rate_limiter, throttled_message
+from .render import HeaderStream
+from .utils import draw_omikuji
 
 
 async def omikuji(ctx: ToolContext):
     logger.info("获取御神签")
     nb_event: MessageEvent = typing.cast(MessageEvent, ctx.event.get_nonebot_event())
-    is_group = hasattr(nb_event, "group_id")
     bot = get_bot(str(ctx.event._nbevent.self_id))
-
-    if (data := await get_cached_omikuji(nb_event)) is None:
-        await bot.send(
-            ctx.event._nbevent,
-            "轻轻摇动古老的签筒，竹签哗啦作响... 心中默念所求之事... 一支签缓缓落下。",
+    if wait := get_rate_limiter().check(nb_event):
+        if get_config().omikuji_send_by_chat:
+            return throttled_message(wait)
+        await bot.send(nb_event, throttled_message(wait))
+        ctx.matcher.cancel_nonebot_process()
+        return
+
+    start = time.perf_counter()
+    header = HeaderStream(lambda msg: bot.send(nb_event, msg), "tool", nb_event)
+    try:
+        data = await draw_omikuji(
+            nb_event,
+            ctx.data["theme"],
+            on_generate=lambda: bot.send(
+                ctx.event._nbevent,
+                "轻轻摇动古老的签筒，竹签哗啦作响... 心中默念所求之事... 一支签缓缓落下。",
+            ),
+            # 结果以 JSON 交给聊天模型时不提前发送签头
+            on_field=None if get_config().omikuji_send_by_chat else header,
         )
-        data = await generate_omikuji(ctx.data["theme"], is_group)
-        await cache_omikuji(nb_event, data)
+    except QueueFullError:
+        if get_config().omikuji_send_by_chat:
+            return BUSY_MESSAGE
+        await bot.send(nb_event, BUSY_MESSAGE)
+        ctx.matcher.cancel_nonebot_process()
+        return
     if get_config().omikuji_send_by_chat:
+        DRAW_SECONDS.observe(time.perf_counter() - start, "tool")
         return data.model_dump_json()
-    msg = format_omikuji(data)
-    await bot.send(nb_event, msg)
+    msg = await header.rest(data)
+    DRAW_SECONDS.observe(time.perf_counter() - start, "tool")
+    if msg is not None:
+        await bot.send(nb_event, msg)
     ctx.matcher.cancel_nonebot_process()
 
 
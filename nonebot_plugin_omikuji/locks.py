@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Hashable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+
+@dataclass(slots=True)
+class LockStats:
+    acquisitions: int = 0  # 获取次数
+    contended: int = 0  # 需要等待的次数
+    wait_time: float = 0.0  # 累计等待秒数
+    max_wait_time: float = 0.0  # 最长等待秒数
+
+    def record(self, waited: float, contended: bool) -> None:
+        self.acquisitions += 1
+        if contended:
+            self.contended += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+
+
+class _LockEntry:
+    __slots__ = ("readers", "refs", "waiters", "writer")
+
+    def __init__(self) -> None:
+        self.readers = 0
+        self.writer = False
+        self.waiters: deque[tuple[asyncio.Future[None], bool]] = deque()
+        self.refs = 0  # 持有或等待该锁的协程数，为 0 时释放该条目
+
+    def grantable(self, shared: bool) -> bool:
+        return not self.writer and (shared or not self.readers)
+
+    def grant(self, shared: bool) -> None:
+        if shared:
+            self.readers += 1
+        else:
+            self.writer = True
+
+    def release(self, shared: bool) -> None:
+        if shared:
+            self.readers -= 1
+        else:
+            self.writer = False
+        self.wake()
+
+    def wake(self) -> None:
+        # 按先来先到唤醒：连续的读者一起放行，遇到无法放行的等待者即停止
+        while self.waiters:
+            fut, shared = self.waiters[0]
+            if fut.done():
+                self.waiters.popleft()
+                continue
+            if not self.grantable(shared):
+                break
+            self.waiters.popleft()
+            self.grant(shared)
+            fut.set_result(None)
+
+
+class KeyedRWLock:
+    """
+    按 key 划分的异步读写锁，共享模式下多个读者可以同时持有。
+
+    条目按引用计数管理，不再被持有或等待时立即释放，
+    因此不会出现仍被持有的锁被淘汰、同一个 key 得到两把不同锁的情况。
+    """
+
+    def __init__(self) -> None:
+        self._entries: dict[Hashable, _LockEntry] = {}
+        self._stats: dict[Hashable, LockStats] = {}
+
+    @asynccontextmanager
+    async def acquire(
+        self, key: Hashable, *, shared: bool = False
+    ) -> AsyncIterator[None]:
+        if (entry := self._entries.get(key)) is None:
+            entry = self._entries[key] = _LockEntry()
+        entry.refs += 1
+        try:
+            start = time.perf_counter()
+            contended = bool(entry.waiters) or not entry.grantable(shared)
+            if contended:
+                fut = asyncio.get_running_loop().create_future()
+                entry.waiters.append((fut, shared))
+                try:
+                    await fut
+                except BaseException:
+                    if fut.done() and not fut.cancelled():
+                        # 已被放行但随即被取消，交还给后续等待者
+                        entry.release(shared)
+                    else:
+                        fut.cancel()
+                        entry.wake()
+                    raise
+            else:
+                entry.grant(shared)
+            self._stats.setdefault(key, LockStats()).record(
+                time.perf_counter() - start, contended
+            )
+            try:
+                yield
+            finally:
+                entry.release(shared)
+        finally:
+            entry.refs -= 1
+            if not entry.refs and self._entries.get(key) is entry:
+                del self._entries[key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[Hashable, LockStats]:
+        return dict(self._stats)
@@ -0,0 +1,382 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import os
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import ClassVar
+
+DEFAULT_BUCKETS: tuple[float, ...] = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+Sample = tuple[str, tuple[tuple[str, str], ...], float]
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric(ABC):
+    type: ClassVar[str]
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        registry: Registry | None = None,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        if registry is not None:
+            registry.register(self)
+
+    def _labels(self, values: tuple[str, ...]) -> tuple[tuple[str, str], ...]:
+        return tuple(zip(self.labelnames, values))
+
+    @abstractmethod
+    def samples(self) -> Iterator[Sample]: ...
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+        for name, labels, value in self.samples():
+            if labels:
+                name += "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+            yield f"{name} {_format_value(value)}"
+
+
+class Counter(Metric):
+    """单调递增的计数器"""
+
+    type = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        registry: Registry | None = None,
+    ) -> None:
+        super().__init__(name, documentation, labelnames, registry)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def total(self, **match: str) -> float:
+        """按部分标签求和"""
+        idx = [(self.labelnames.index(k), v) for k, v in match.items()]
+        return sum(
+            value
+            for labels, value in self._values.items()
+            if all(labels[i] == v for i, v in idx)
+        )
+
+    def samples(self) -> Iterator[Sample]:
+        for labels, value in self._values.items():
+            yield self.name, self._labels(labels), value
+
+
+class Gauge(Metric):
+    """可增可减的瞬时值"""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        registry: Registry | None = None,
+    ) -> None:
+        super().__init__(name, documentation, labelnames, registry)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+    def samples(self) -> Iterator[Sample]:
+        for labels, value in self._values.items():
+            yield self.name, self._labels(labels), value
+
+
+class _HistogramSeries:
+    __slots__ = ("buckets", "count", "max", "sum")
+
+    def __init__(self, size: int) -> None:
+        self.buckets = [0] * size  # 每个区间内的数量（非累积），最后一个为 +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class Histogram(Metric):
+    """固定分桶的直方图，分位数由分桶线性插值估算"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        registry: Registry | None = None,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames, registry)
+        self.bounds = buckets
+        self._series: dict[tuple[str, ...], _HistogramSeries] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        if (series := self._series.get(labels)) is None:
+            series = self._series[labels] = _HistogramSeries(len(self.bounds) + 1)
+        series.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        series.count += 1
+        series.sum += value
+        series.max = max(series.max, value)
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels: str) -> int:
+        return series.count if (series := self._series.get(labels)) else 0
+
+    def quantile(self, q: float, *labels: str) -> float:
+        if not (series := self._series.get(labels)) or not series.count:
+            return 0.0
+        rank = q * series.count
+        seen = 0
+        for i, n in enumerate(series.buckets):
+            if n and seen + n >= rank:
+                lower = self.bounds[i - 1] if i else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else series.max
+                upper = min(upper, series.max)
+                return lower + max(upper - lower, 0) * (rank - seen) / n
+            seen += n
+        return series.max
+
+    def samples(self) -> Iterator[Sample]:
+        for labels, series in self._series.items():
+            label_pairs = self._labels(labels)
+            cumulative = 0
+            for bound, n in zip((*self.bounds, float("inf")), series.buckets):
+                cumulative += n
+                yield (
+                    f"{self.name}_bucket",
+                    (*label_pairs, ("le", _format_value(bound))),
+                    cumulative,
+                )
+            yield f"{self.name}_sum", label_pairs, series.sum
+            yield f"{self.name}_count", label_pairs, series.count
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: list[Metric] = []
+        self._collectors: list[Callable[[], Iterable[Metric]]] = []
+
+    def register(self, metric: Metric) -> None:
+        self._metrics.append(metric)
+
+    def add_collector(self, collector: Callable[[], Iterable[Metric]]) -> None:
+        """注册在导出时才生成指标的收集函数（用于已有统计数据的模块）"""
+        self._collectors.append(collector)
+
+    def collect(self) -> list[Metric]:
+        metrics = list(self._metrics)
+        for collector in self._collectors:
+            metrics.extend(collector())
+        return metrics
+
+    def render(self) -> str:
+        """导出为 Prometheus 文本格式"""
+        return "".join(
+            f"{line}\n" for metric in self.collect() for line in metric.render()
+        )
+
+
+REGISTRY = Registry()
+
+DRAW_CACHE = Counter(
+    "omikuji_draw_cache_total",
+    "用户每日抽签记录的命中次数（computed为确定性模式下重新计算得到）",
+    ("result",),
+    REGISTRY,
+)
+CORPUS_LOOKUPS = Counter(
+    "omikuji_corpus_lookups_total",
+    "语料库抽取的命中次数",
+    ("level", "theme", "result"),
+    REGISTRY,
+)
+LLM_SECONDS = Histogram(
+    "omikuji_llm_seconds",
+    "生成御神签的LLM调用耗时",
+    (),
+    REGISTRY,
+)
+LLM_FAILURES = Counter(
+    "omikuji_llm_failures_total",
+    "生成御神签失败的次数",
+    ("reason",),
+    REGISTRY,
+)
+LLM_FALLBACKS = Counter(
+    "omikuji_llm_fallback_total",
+    "生成失败后改用语料库的次数（served为已改用，unavailable为没有可用的语料）",
+    ("result",),
+    REGISTRY,
+)
+CORPUS_WRITES = Counter(
+    "omikuji_corpus_writes_total",
+    "写入语料库的御神签数量（written为已写入，dropped为缓冲溢出丢弃，failed为写入失败）",
+    ("result",),
+    REGISTRY,
+)
+RATE_LIMITED = Counter(
+    "omikuji_rate_limited_total",
+    "因抽签过于频繁被拒绝的次数",
+    ("scope",),
+    REGISTRY,
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "omikuji_generation_queue_wait_seconds",
+    "LLM生成排队等待名额的时间（user为用户请求，background为后台任务）",
+    ("lane",),
+    REGISTRY,
+)
+DB_LOCK_WAIT_SECONDS = Histogram(
+    "omikuji_db_lock_wait_seconds",
+    "获取语料单元锁的等待时间",
+    ("mode",),
+    REGISTRY,
+)
+CORPUS_SQL_SECONDS = Histogram(
+    "omikuji_corpus_sql_seconds",
+    "语料库数据库操作耗时（不含锁等待）",
+    ("operation",),
+    REGISTRY,
+)
+FORMAT_SECONDS = Histogram(
+    "omikuji_format_seconds",
+    "御神签渲染耗时",
+    ("mode",),
+    REGISTRY,
+)
+STREAM_HEADER_SECONDS = Histogram(
+    "omikuji_stream_header_seconds",
+    "流式生成时，抽签从开始处理到发送签头的耗时",
+    ("source",),
+    REGISTRY,
+)
+CARD_CACHE = Counter(
+    "omikuji_card_cache_total",
+    "图片卡片磁盘缓存的命中次数（coalesced为与相同内容的绘制合并）",
+    ("result",),
+    REGISTRY,
+)
+DRAW_SECONDS = Histogram(
+    "omikuji_draw_seconds",
+    "抽签从开始处理到发送结果之前的耗时",
+    ("source",),
+    REGISTRY,
+)
+
+
+def _ratio(hit: float, miss: float) -> str:
+    return f"{hit / (hit + miss):.1%}" if hit + miss else "-"
+
+
+def _latency(histogram: Histogram, *labels: str) -> str:
+    if not histogram.count(*labels):
+        return "无数据"
+    return (
+        f"{histogram.count(*labels)} 次，"
+        f"p50 {histogram.quantile(0.5, *labels) * 1000:.2f}ms，"
+        f"p99 {histogram.quantile(0.99, *labels) * 1000:.2f}ms"
+    )
+
+
+def summary() -> str:
+    """供超级用户命令查看的统计摘要"""
+    draw_hit, draw_miss = DRAW_CACHE.value("hit"), DRAW_CACHE.value("miss")
+    computed = DRAW_CACHE.value("computed")
+    corpus_hit = CORPUS_LOOKUPS.total(result="hit")
+    corpus_miss = CORPUS_LOOKUPS.total() - corpus_hit
+    lines = [
+        "御神签运行统计",
+        f"每日抽签记录：命中 {draw_hit:.0f}"
+        + (f" / 重新计算 {computed:.0f}" if computed else "")
+        + f" / 未命中 {draw_miss:.0f}"
+        f"（命中率 {_ratio(draw_hit + computed, draw_miss)}）",
+        f"语料库：命中 {corpus_hit:.0f} / 未命中 {corpus_miss:.0f}"
+        f"（命中率 {_ratio(corpus_hit, corpus_miss)}）",
+        f"LLM调用：{_latency(LLM_SECONDS)}，失败 {LLM_FAILURES.total():.0f} 次，"
+        f"改用语料库 {LLM_FALLBACKS.value('served'):.0f} 次",
+        f"生成排队：{_latency(QUEUE_WAIT_SECONDS, 'user')}",
+        f"锁等待(共享)：{_latency(DB_LOCK_WAIT_SECONDS, 'shared')}",
+        f"锁等待(独占)：{_latency(DB_LOCK_WAIT_SECONDS, 'exclusive')}",
+        *(
+            f"SQL({operation})：{_latency(CORPUS_SQL_SECONDS, operation)}"
+            for operation in ("write", "expire")
+        ),
+        f"渲染(文本)：{_latency(FORMAT_SECONDS, 'text')}",
+        f"渲染(图片)：{_latency(FORMAT_SECONDS, 'card')}，"
+        f"缓存命中率 {_ratio(CARD_CACHE.value('hit'), CARD_CACHE.value('miss'))}",
+        *(
+            f"抽签总耗时({source})：{_latency(DRAW_SECONDS, source)}"
+            for source in ("command", "tool")
+        ),
+        *(
+            f"签头发送({source})：{_latency(STREAM_HEADER_SECONDS, source)}"
+            for source in ("command", "tool")
+        ),
+    ]
+    return "\n".join(lines)
+
+
+def _write(path: Path, text: str) -> None:
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, path)
+
+
+async def dump(path: Path) -> None:
+    """将指标以 Prometheus 文本格式写入文件（先写临时文件再替换，读取方不会读到半个文件）"""
+    await asyncio.to_thread(_write, path, REGISTRY.render())
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import random
+from collections.abc import Mapping
 from typing import Literal
 
 from nonebot_plugin_suggarchat.API import (
@@ -42,6 +43,16 @@ def random_level() -> str:
     return random.choice(LEVEL)
 
 
+def resolve_level_weights(
+    global_weights: Mapping[str, float],
+    theme_weights: Mapping[str, float] | None = None,
+    group_weights: Mapping[str, float] | None = None,
+) -> list[float]:
+    """按 群 > 主题 > 全局 的优先级确定每个运势（按 LEVEL 的顺序）的权重，均未设置时为 1"""
+    layers = [m for m in (group_weights, theme_weights, global_weights) if m]
+    return [next((m[level] for m in layers if level in m), 1.0) for level in LEVEL]
+
+
 class OmikujiSections(BaseModel):
     name: str
     content: str
@@ -72,6 +83,11 @@ OMIKUJI_SCHEMA_META = ToolFunctionSchema(
                     description="御神签主题，必须严格遵守给出的枚举值",
                     enum=OMIKUJI_THEMES,
                 ),
+                # 签头字段（主题、引入、编号、天启）排在最前，流式生成时可以尽早发送签头
+                "intro": FunctionPropertySchema(
+                    type="string",
+                    description="主题引入(不包含引号)：e.g. '「欢迎来到古树根下的祠堂。异界之风正为你捎来命运的启示…」\n'",
+                ),
                 "sign_number": FunctionPropertySchema(
                     type="string",
                     description="御神签编号(随机中文大写数字)",
@@ -103,10 +119,6 @@ OMIKUJI_SCHEMA_META = ToolFunctionSchema(
                 "maxim": FunctionPropertySchema(
                     type="string", description="一句箴言/和歌（结尾注明出处）"
                 ),
-                "intro": FunctionPropertySchema(
-                    type="string",
-                    description="主题引入(不包含引号)：e.g. '「欢迎来到古树根下的祠堂。异界之风正为你捎来命运的启示…」\n'",
-                ),
                 "end": FunctionPropertySchema(
                     type="string",
                     description="主题总结(不包含引号)",
@@ -114,16 +126,54 @@ OMIKUJI_SCHEMA_META = ToolFunctionSchema(
             },
             required=[
                 "theme",
+                "intro",
                 "sign_number",
                 "divine_title",
                 "sections",
                 "maxim",
-                "intro",
             ],
         ),
     ),
 )
 
+OMIKUJI_BATCH_SCHEMA_META = ToolFunctionSchema(
+    strict=True,
+    type="function",
+    function=FunctionDefinitionSchema(
+        name="omikuji_batch_content",
+        description="一次获取多张御神签签文",
+        parameters=FunctionParametersSchema(
+            type="object",
+            properties={
+                "omikuji": FunctionPropertySchema(
+                    type="array",
+                    items=FunctionPropertySchema(
+                        type="object",
+                        properties={
+                            "level": FunctionPropertySchema(
+                                type="string",
+                                description="这张御神签的运势，必须严格遵守给出的枚举值",
+                                enum=LEVEL,
+                            ),
+                            **(
+                                OMIKUJI_SCHEMA_META.function.parameters.properties or {}
+                            ),
+                        },
+                        description="一张御神签",
+                        required=[
+                            "level",
+                            *OMIKUJI_SCHEMA_META.function.parameters.required,
+                        ],
+                    ),
+                    description="按要求的运势顺序排列的御神签",
+                    minItems=1,
+                ),
+            },
+            required=["omikuji"],
+        ),
+    ),
+)
+
 FUNC_META = ToolFunctionSchema(
     strict=True,
     function=FunctionDefinitionSchema(
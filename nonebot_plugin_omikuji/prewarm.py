@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import asyncio
+import typing
+from datetime import datetime
+
+from nonebot import logger
+from nonebot_plugin_suggarchat.API import hybrid_token_count
+
+from .config import get_config
+from .corpus import CORPUS_FIELDS, get_corpus_index, is_expired
+from .models import LEVEL, OMIKUJI_THEMES, THEME_TYPE, OmikujiData
+from .prompts import get_prompt_cache
+from .utils import generate_omikuji_batch, generation_flight
+
+
+def in_window(hour: int, start: int, end: int) -> bool:
+    """hour 是否处于 [start, end) 时段内，start 大于 end 时表示跨越零点"""
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def underfilled_cells(min_sections: int) -> list[tuple[str, THEME_TYPE]]:
+    """找出语料不足以稳定命中的 (level, theme) 单元"""
+    index = get_corpus_index()
+    cells: list[tuple[str, THEME_TYPE]] = []
+    for level in LEVEL:
+        for theme in OMIKUJI_THEMES:
+            cell = index.get(level, theme)
+            if (
+                cell is None
+                or len(cell.section_names) < min_sections
+                or not all(getattr(cell, field) for field in CORPUS_FIELDS)
+                or is_expired(cell.created_date, cell.updated_date)
+            ):
+                cells.append((level, typing.cast(THEME_TYPE, theme)))
+    return cells
+
+
+class PrewarmScheduler:
+    """
+    在空闲时段后台生成语料，使每个 (level, theme) 单元保持可命中的最低规模。
+
+    同一主题下语料不足的运势按 omikuji_batch_size 合并到一次 LLM 调用中生成。
+    受并发数、每日 token 预算与时间窗口限制；有用户请求正在等待生成时跳过。
+    """
+
+    def __init__(self) -> None:
+        self._budget_date: str = ""
+        self._spent: int = 0
+        self.generated: int = 0
+        self.failed: int = 0
+
+    @property
+    def spent(self) -> int:
+        """今日已消耗的 token（估算值）"""
+        if self._budget_date != datetime.now().strftime("%Y-%m-%d"):
+            return 0
+        return self._spent
+
+    def _spend(self, tokens: int) -> None:
+        today = datetime.now().strftime("%Y-%m-%d")
+        if self._budget_date != today:
+            self._budget_date = today
+            self._spent = 0
+        self._spent += tokens
+
+    def _can_run(self) -> bool:
+        config = get_config()
+        budget = config.omikuji_prewarm_token_budget
+        return (
+            in_window(
+                datetime.now().hour,
+                config.omikuji_prewarm_start_hour,
+                config.omikuji_prewarm_end_hour,
+            )
+            and (budget < 0 or self.spent < budget)
+            # 预热的批量生成不经过 generation_flight，存在进行中的生成说明有用户正在等待
+            and generation_flight.in_flight == 0
+        )
+
+    @staticmethod
+    def _estimate_tokens(datas: list[OmikujiData]) -> int:
+        # 一次批量生成只发送一份提示词
+        prompt = get_prompt_cache().text(False)
+        return hybrid_token_count(
+            prompt + "".join(data.model_dump_json() for data in datas)
+        )
+
+    async def run_once(self) -> int:
+        """
+        扫描一遍语料库并补充不足的单元
+
+        Returns:
+            本次补充的单元数量
+        """
+        config = get_config()
+        if not self._can_run():
+            return 0
+        cells = underfilled_cells(config.omikuji_prewarm_min_sections)
+        if not cells:
+            return 0
+        by_theme: dict[THEME_TYPE, list[str]] = {}
+        for level, theme in cells:
+            by_theme.setdefault(theme, []).append(level)
+        size = config.omikuji_batch_size
+        batches: list[tuple[THEME_TYPE, list[str]]] = [
+            (theme, levels[i : i + size])
+            for theme, levels in by_theme.items()
+            for i in range(0, len(levels), size)
+        ]
+        semaphore = asyncio.Semaphore(config.omikuji_prewarm_concurrency)
+
+        async def fill(theme: THEME_TYPE, levels: list[str]) -> int:
+            async with semaphore:
+                if not self._can_run():
+                    return 0
+                try:
+                    datas = await generate_omikuji_batch(theme, levels)
+                except Exception as e:
+                    self.failed += len(levels)
+                    logger.warning(f"预热语料 {theme}/{'、'.join(levels)} 失败：{e}")
+                    return 0
+                self.failed += len(levels) - len(datas)
+                if datas:
+                    self._spend(self._estimate_tokens(datas))
+                self.generated += len(datas)
+                return len(datas)
+
+        results = await asyncio.gather(
+            *(fill(theme, levels) for theme, levels in batches)
+        )
+        if count := sum(results):
+            logger.info(
+                f"语料预热完成：{len(batches)} 次调用补充 {count}/{len(cells)} 个单元，"
+                f"今日已消耗约 {self.spent} tokens"
+            )
+        return count
+
+
+_SCHEDULER = PrewarmScheduler()
+
+
+def get_prewarm_scheduler() -> PrewarmScheduler:
+    return _SCHEDULER
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+from nonebot_plugin_suggarchat.API import config_manager
+from nonebot_plugin_suggarchat.utils.models import Message
+
+from .config import get_config
+from .metrics import REGISTRY, Counter
+
+GENERATE_INSTRUCTION = "\n你现在需要结合你的角色设定生成御神签。"
+SHORT_SYSTEM_PROMPT = "你是神社中负责撰写御神签的巫女，请按照要求生成御神签签文。"
+
+
+class PromptCache:
+    """
+    生成御神签时使用的系统提示缓存。
+
+    按 (是否群聊, omikuji_add_system_prompt) 缓存构建好的消息。每次使用时通过 SuggarChat 的
+    group_train / private_train 读取当前的角色提示，与缓存时的文本不同（重载了配置或提示词）才重新构建。
+    缓存的消息在多次调用间共享，使用方不能修改。
+    """
+
+    def __init__(self) -> None:
+        self._entries: dict[tuple[bool, bool], tuple[str, tuple[Message, ...]]] = {}
+        self.hits: int = 0
+        self.builds: int = 0
+
+    @staticmethod
+    def _content(is_group: bool, add_system_prompt: bool) -> str:
+        if not add_system_prompt:
+            return SHORT_SYSTEM_PROMPT
+        train = config_manager.group_train if is_group else config_manager.private_train
+        return str(train.get("content", "")) + GENERATE_INSTRUCTION
+
+    def _entry(self, is_group: bool) -> tuple[str, tuple[Message, ...]]:
+        key = (is_group, get_config().omikuji_add_system_prompt)
+        content = self._content(*key)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == content:
+            self.hits += 1
+            return entry
+        entry = (content, (Message(role="system", content=content),))
+        self._entries[key] = entry
+        self.builds += 1
+        return entry
+
+    def messages(self, is_group: bool) -> tuple[Message, ...]:
+        """生成请求中位于用户提示之前的消息"""
+        return self._entry(is_group)[1]
+
+    def text(self, is_group: bool) -> str:
+        """系统提示的文本（用于估算 token）"""
+        return self._entry(is_group)[0]
+
+
+_CACHE = PromptCache()
+
+
+def get_prompt_cache() -> PromptCache:
+    return _CACHE
+
+
+def _collect_prompt_stats() -> list[Counter]:
+    total = Counter(
+        "omikuji_prompt_cache_total",
+        "系统提示缓存的使用次数（hit为命中，build为重新构建）",
+        ("result",),
+    )
+    total.inc("hit", amount=_CACHE.hits)
+    total.inc("build", amount=_CACHE.builds)
+    return [total]
+
+
+REGISTRY.add_collector(_collect_prompt_stats)
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import math
+import time
+
+from nonebot.adapters.onebot.v11 import GroupMessageEvent, MessageEvent
+
+from .config import get_config
+from .metrics import RATE_LIMITED, REGISTRY, Gauge
+
+
+class TokenBuckets:
+    """
+    一组按 key 区分的令牌桶：每秒补充 rate 个令牌，最多积累 burst 个，每次请求消耗一个。
+
+    每个桶只保存 (令牌数, 更新时间)，补充在读取时按经过的时间计算；
+    已补满的桶与不存在的桶等价，由 compact 删除，空闲的用户不占用内存。
+    """
+
+    def __init__(self) -> None:
+        self._buckets: dict[str, tuple[float, float]] = {}
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def tokens(self, key: str, now: float, rate: float, burst: float) -> float:
+        if (bucket := self._buckets.get(key)) is None:
+            return burst
+        tokens, updated = bucket
+        return min(burst, tokens + (now - updated) * rate)
+
+    def take(self, key: str, now: float, rate: float, burst: float) -> None:
+        self._buckets[key] = (self.tokens(key, now, rate, burst) - 1, now)
+
+    def compact(self, now: float, rate: float, burst: float) -> int:
+        """删除已补满的桶，返回删除的数量"""
+        full = [
+            key
+            for key, (tokens, updated) in self._buckets.items()
+            if rate <= 0 or tokens + (now - updated) * rate >= burst
+        ]
+        for key in full:
+            del self._buckets[key]
+        return len(full)
+
+
+class RateLimiter:
+    """
+    抽签请求的频率限制，按用户与群分别计算。
+
+    用户每分钟可抽签 omikuji_user_rate_limit 次，最多连续 omikuji_user_rate_burst 次；
+    群同理（omikuji_group_rate_limit / omikuji_group_rate_burst），限制为 0 时不检查。
+    被限制的请求不消耗令牌。
+    """
+
+    def __init__(self) -> None:
+        self.users = TokenBuckets()
+        self.groups = TokenBuckets()
+
+    def _rules(
+        self, event: MessageEvent
+    ) -> list[tuple[TokenBuckets, str, float, float, str]]:
+        config = get_config()
+        rules = [
+            (
+                self.users,
+                str(event.user_id),
+                config.omikuji_user_rate_limit / 60,
+                config.omikuji_user_rate_burst,
+                "user",
+            )
+        ]
+        if isinstance(event, GroupMessageEvent):
+            rules.append(
+                (
+                    self.groups,
+                    str(event.group_id),
+                    config.omikuji_group_rate_limit / 60,
+                    config.omikuji_group_rate_burst,
+                    "group",
+                )
+            )
+        return [rule for rule in rules if rule[2] > 0]
+
+    def check(self, event: MessageEvent) -> float:
+        """
+        检查一次抽签请求，允许时消耗令牌
+
+        Returns:
+            需要等待的秒数，0 表示允许
+        """
+        now = time.monotonic()
+        rules = self._rules(event)
+        wait = 0.0
+        for buckets, key, rate, burst, scope in rules:
+            if (tokens := buckets.tokens(key, now, rate, burst)) < 1:
+                RATE_LIMITED.inc(scope)
+                wait = max(wait, (1 - tokens) / rate)
+        if wait:
+            return wait
+        for buckets, key, rate, burst, _ in rules:
+            buckets.take(key, now, rate, burst)
+        return 0.0
+
+    async def compact(self) -> int:
+        """删除已补满的桶"""
+        config = get_config()
+        now = time.monotonic()
+        return self.users.compact(
+            now, config.omikuji_user_rate_limit / 60, config.omikuji_user_rate_burst
+        ) + self.groups.compact(
+            now, config.omikuji_group_rate_limit / 60, config.omikuji_group_rate_burst
+        )
+
+
+_LIMITER = RateLimiter()
+
+
+def get_rate_limiter() -> RateLimiter:
+    return _LIMITER
+
+
+def throttled_message(wait: float) -> str:
+    return f"抽签太频繁啦，签筒需要歇一歇... 请 {math.ceil(wait)} 秒后再来吧。"
+
+
+def _collect_buckets() -> list[Gauge]:
+    buckets = Gauge(
+        "omikuji_rate_limit_buckets",
+        "频率限制中未补满的令牌桶数量",
+        ("scope",),
+    )
+    buckets.set(len(_LIMITER.users), "user")
+    buckets.set(len(_LIMITER.groups), "group")
+    return [buckets]
+
+
+REGISTRY.add_collector(_collect_buckets)
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import random
+from collections.abc import Awaitable, Callable
+from datetime import date
+from typing import Any
+
+from nonebot import logger
+
+from .config import get_config
+from .corpus import CorpusCell
+from .tasks import create_background_task
+
+
+class RefreshScheduler:
+    """
+    长期缓存模式下的语料更新调度（stale-while-revalidate）。
+
+    记录每个 (level, theme) 最近一次生成的日期，超过 omikuji_long_cache_update_days 后，
+    命中的请求按 omikuji_long_cache_refresh_ratio 的比例在后台触发一次生成，
+    用户仍立即得到缓存中的结果；同一单元同时只会有一个更新任务。
+    """
+
+    def __init__(self) -> None:
+        self._last_generated: dict[tuple[str, str], str] = {}
+        self._refreshing: set[tuple[str, str]] = set()
+        self.dispatched: int = 0
+        self.failed: int = 0
+
+    def last_generated(self, cell: CorpusCell) -> str:
+        return max(
+            self._last_generated.get((cell.level, cell.theme), ""), cell.updated_date
+        )
+
+    def is_due(self, cell: CorpusCell) -> bool:
+        config = get_config()
+        if not (
+            config.omikuji_long_cache_mode
+            and config.omikuji_long_cache_update
+            and config.omikuji_long_cache_update_days > 0
+        ):
+            return False
+        last = date.fromisoformat(self.last_generated(cell))
+        return (date.today() - last).days >= config.omikuji_long_cache_update_days
+
+    def maybe_refresh(
+        self, cell: CorpusCell, regenerate: Callable[[], Awaitable[Any]]
+    ) -> bool:
+        """
+        对一次命中判断是否需要在后台更新该单元
+
+        Returns:
+            是否发起了更新
+        """
+        key = (cell.level, cell.theme)
+        if key in self._refreshing or not self.is_due(cell):
+            return False
+        if random.random() >= get_config().omikuji_long_cache_refresh_ratio:
+            return False
+        self._refreshing.add(key)
+        self.dispatched += 1
+        create_background_task(
+            self._refresh(key, regenerate), name=f"omikuji_refresh_{key}"
+        )
+        return True
+
+    async def _refresh(
+        self, key: tuple[str, str], regenerate: Callable[[], Awaitable[Any]]
+    ) -> None:
+        try:
+            await regenerate()
+            self._last_generated[key] = date.today().isoformat()
+            logger.debug(f"{key[1]}/{key[0]} corpus refreshed")
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"更新语料 {key[1]}/{key[0]} 失败：{e}")
+        finally:
+            self._refreshing.discard(key)
+
+
+_SCHEDULER = RefreshScheduler()
+
+
+def get_refresh_scheduler() -> RefreshScheduler:
+    return _SCHEDULER
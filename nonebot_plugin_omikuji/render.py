@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import time
+from collections.abc import Awaitable, Callable, Mapping
+from typing import Any
+
+from nonebot import logger
+from nonebot.adapters.onebot.v11 import (
+    GroupMessageEvent,
+    Message,
+    MessageEvent,
+    MessageSegment,
+)
+
+from .card import card_available, get_card_renderer
+from .config import get_config
+from .metrics import FORMAT_SECONDS, STREAM_HEADER_SECONDS
+from .models import OmikujiData
+from .templates import (
+    HEADER_FIELDS,
+    MESSAGE_FIELDS,
+    SECTION_FIELDS,
+    Template,
+)
+
+
+class Renderer:
+    """
+    御神签的渲染（命令与聊天工具共用）。
+
+    消息模板 omikuji_template 与板块模板 omikuji_section_template 在配置变化时重新编译；
+    每个 (运势, 主题) 的签框（代入运势与主题后的模板，按签头拆分为两部分）只构建一次，
+    渲染时只需代入语料字段并拼接。
+    """
+
+    def __init__(self) -> None:
+        self._source: tuple[str, str] | None = None
+        self._message = Template(())
+        self._section = Template(())
+        self._frames: dict[tuple[str, str], tuple[Template, Template]] = {}
+
+    def _compile(self) -> None:
+        config = get_config()
+        source = (config.omikuji_template, config.omikuji_section_template)
+        if source == self._source:
+            return
+        self._message = Template.compile(source[0], MESSAGE_FIELDS)
+        self._section = Template.compile(source[1], SECTION_FIELDS)
+        self._frames = {}
+        self._source = source
+
+    def _frame(self, level: str, theme: str) -> tuple[Template, Template]:
+        self._compile()
+        if (frame := self._frames.get((level, theme))) is None:
+            frame = self._frames[(level, theme)] = self._message.bind(
+                {"level": level, "theme": theme}
+            ).split((*HEADER_FIELDS, "user_prefix"))
+        return frame
+
+    def header(self, fields: Mapping[str, Any], user_name: str | None = "") -> str:
+        """签头：模板中第一个非签头字段之前的部分（fields 需包含 HEADER_FIELDS）"""
+        head, _ = self._frame(fields["level"], fields["theme"])
+        return head.render(
+            {
+                "intro": str(fields["intro"]),
+                "user_prefix": f"{user_name}，" if user_name else "",
+                "sign_number": str(fields["sign_number"]),
+                "divine_title": str(fields["divine_title"]),
+            }
+        ).rstrip()
+
+    def text(self, data: OmikujiData, user_name: str | None = "") -> str:
+        with FORMAT_SECONDS.time("text"):
+            head, tail = self._frame(data.level, data.theme)
+            section_format = self._section.format
+            values = {
+                "intro": data.intro,
+                "user_prefix": f"{user_name}，" if user_name else "",
+                "sign_number": data.sign_number,
+                "divine_title": data.divine_title,
+                "sections": "".join(
+                    [
+                        section_format(name=section.name, content=section.content)
+                        for section in data.sections
+                    ]
+                ),
+                "maxim": data.maxim,
+                "end": data.end,
+            }
+            return head.render(values) + tail.render(values)
+
+    def message(self, text: str, event: MessageEvent) -> str | Message:
+        """按 omikuji_render_mode 包装为要发送的消息（card 模式下为纯文本）"""
+        if get_config().omikuji_render_mode != "rich":
+            return text
+        msg = MessageSegment.reply(event.message_id)
+        if isinstance(event, GroupMessageEvent):
+            msg += MessageSegment.at(event.user_id) + "\n"
+        return msg + text
+
+
+_RENDERER = Renderer()
+
+
+def get_renderer() -> Renderer:
+    return _RENDERER
+
+
+def render_omikuji(
+    data: OmikujiData, event: MessageEvent, user_name: str | None = ""
+) -> str | Message:
+    """渲染要发送给用户的御神签"""
+    return _RENDERER.message(_RENDERER.text(data, user_name), event)
+
+
+async def render_reply(
+    data: OmikujiData, event: MessageEvent, user_name: str | None = ""
+) -> str | Message:
+    """
+    渲染要发送给用户的御神签，card 模式下为图片卡片；
+    未安装 Pillow 或绘制失败时改为文本
+    """
+    if get_config().omikuji_render_mode == "card" and card_available():
+        try:
+            return Message(MessageSegment.image(await get_card_renderer().render(data)))
+        except Exception as e:
+            logger.warning(f"绘制图片卡片失败，改为发送文本：{e!r}")
+    return render_omikuji(data, event, user_name)
+
+
+class HeaderStream:
+    """
+    作为 draw_omikuji 的 on_field：签头字段齐全后立即发送一次签头（签头为空时不发送）。
+
+    传出字段后失败的生成在重试时不再流式传出字段，但重试（或改用语料库）的结果可能带有不同的签头，
+    此时只发送最终结果中签头之后的部分，不再重复发送一张完整的御神签。
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str | Message], Awaitable[Any]],
+        source: str,
+        event: MessageEvent,
+        user_name: str | None = "",
+    ) -> None:
+        self._send = send
+        self._source = source
+        self._event = event
+        self._user_name = user_name
+        self._start = time.perf_counter()
+        self._fields: dict[str, Any] = {}
+        self._done = False
+        self.sent: str | None = None
+
+    async def __call__(self, key: str, value: Any) -> None:
+        if (
+            self._done
+            or key not in HEADER_FIELDS
+            or get_config().omikuji_render_mode == "card"  # 图片卡片只发送一次
+        ):
+            return
+        self._fields[key] = value
+        if not all(field in self._fields for field in HEADER_FIELDS):
+            return
+        self._done = True
+        if not (header := _RENDERER.header(self._fields, self._user_name)).strip():
+            return  # 模板以板块开头时没有签头，直接发送完整的御神签
+        try:
+            await self._send(_RENDERER.message(header, self._event))
+        except Exception as e:
+            logger.warning(f"提前发送签头失败：{e!r}")
+            return
+        self.sent = header
+        STREAM_HEADER_SECONDS.observe(time.perf_counter() - self._start, self._source)
+
+    async def rest(self, data: OmikujiData) -> str | Message | None:
+        """
+        已发送签头时返回余下的部分（没有余下部分时为 None），否则返回完整的御神签
+        """
+        if self.sent is None:
+            return await render_reply(data, self._event, self._user_name)
+        text = _RENDERER.text(data, self._user_name)
+        head = self.sent
+        if not text.startswith(head):
+            head = _RENDERER.header(data.model_dump(), self._user_name)
+            logger.warning(
+                f"已发送的签头与最终结果不一致（重试或改用了语料库），只发送余下部分：{self.sent!r} -> {head!r}"
+            )
+        return text[len(head) :].lstrip() or None
@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import random
+import time
+from collections.abc import Awaitable, Callable
+from typing import Generic, Literal, TypeVar
+
+from nonebot import logger
+
+from .config import get_config
+from .metrics import LLM_FAILURES, REGISTRY, Gauge
+
+T = TypeVar("T")
+
+CircuitState = Literal["closed", "open", "half_open"]
+
+
+class CircuitOpenError(RuntimeError):
+    """上游的熔断器处于打开状态，调用被直接拒绝"""
+
+
+class InvalidResponseError(ValueError):
+    """上游返回了无法使用的结果（没有工具调用、参数不是合法的 JSON 等）"""
+
+
+class CircuitBreaker:
+    """
+    单个上游的熔断器。
+
+    连续失败 omikuji_circuit_failure_threshold 次后打开，期间的调用直接失败；
+    经过 omikuji_circuit_reset_seconds 秒后进入半开状态，只放行一个探测调用，
+    探测成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.state: CircuitState = "closed"
+        self.failures: int = 0
+        self._opened_at: float = 0.0
+        self._probing: bool = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if (
+                time.monotonic() - self._opened_at
+                < get_config().omikuji_circuit_reset_seconds
+            ):
+                return False
+            self.state = "half_open"
+            self._probing = False
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            logger.info(f"上游 {self.name} 已恢复，熔断器关闭")
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def abandon(self) -> None:
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if (
+            self.state == "half_open"
+            or self.failures >= get_config().omikuji_circuit_failure_threshold
+        ):
+            if self.state != "open":
+                logger.warning(
+                    f"上游 {self.name} 连续失败 {self.failures} 次，熔断器打开"
+                )
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+
+_BREAKERS: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(upstream: str) -> CircuitBreaker:
+    if (breaker := _BREAKERS.get(upstream)) is None:
+        breaker = _BREAKERS[upstream] = CircuitBreaker(upstream)
+    return breaker
+
+
+class _Failure(Generic[T]):
+    __slots__ = ("error",)
+
+    def __init__(self, error: Exception) -> None:
+        self.error = error
+
+
+async def _attempt(
+    func: Callable[[], Awaitable[T]], breaker: CircuitBreaker, timeout: float
+) -> T | _Failure[T]:
+    try:
+        result = await asyncio.wait_for(func(), timeout)
+    except asyncio.TimeoutError as e:
+        LLM_FAILURES.inc("timeout")
+        breaker.record_failure()
+        return _Failure(e)
+    except InvalidResponseError as e:
+        # 上游可以连通，只是这次的结果不可用：重试，但不计入熔断
+        LLM_FAILURES.inc("invalid")
+        breaker.record_success()
+        return _Failure(e)
+    except Exception as e:
+        LLM_FAILURES.inc("error")
+        breaker.record_failure()
+        return _Failure(e)
+    except BaseException:
+        # 被取消时没有结论，释放半开状态下的探测名额
+        breaker.abandon()
+        raise
+    breaker.record_success()
+    return result
+
+
+async def call_with_retry(
+    func: Callable[[], Awaitable[T]],
+    upstream: str,
+    slot: Callable[
+        [], contextlib.AbstractAsyncContextManager[object]
+    ] = contextlib.nullcontext,
+) -> T:
+    """
+    以超时、重试与熔断保护一次上游调用
+
+    每次尝试的时限为 omikuji_llm_timeout 秒，失败后最多重试 omikuji_llm_retries 次，
+    重试间隔为带随机抖动的指数退避
+
+    Args:
+        slot: 每次尝试期间持有的名额（如生成并发限制），退避等待时不持有，排队时间不计入时限
+
+    Raises:
+        CircuitOpenError: 熔断器打开
+        Exception: 最后一次尝试的错误
+    """
+    config = get_config()
+    breaker = get_breaker(upstream)
+    error: Exception = CircuitOpenError(upstream)
+    for attempt in range(config.omikuji_llm_retries + 1):
+        if attempt:
+            backoff = config.omikuji_llm_retry_backoff * 2 ** (attempt - 1)
+            await asyncio.sleep(random.uniform(0, backoff))
+        if not breaker.allow():
+            LLM_FAILURES.inc("circuit_open")
+            raise CircuitOpenError(f"上游 {upstream} 已熔断")
+        async with slot():
+            outcome = await _attempt(func, breaker, config.omikuji_llm_timeout)
+        if not isinstance(outcome, _Failure):
+            return outcome
+        error = outcome.error
+        logger.debug(f"上游 {upstream} 第 {attempt + 1} 次调用失败：{error!r}")
+    raise error
+
+
+_STATE_VALUES: dict[CircuitState, int] = {"closed": 0, "open": 1, "half_open": 2}
+
+
+def _collect_circuit_state() -> list[Gauge]:
+    state = Gauge(
+        "omikuji_circuit_state",
+        "上游熔断器状态（0为关闭，1为打开，2为半开）",
+        ("upstream",),
+    )
+    for name, breaker in _BREAKERS.items():
+        state.set(_STATE_VALUES[breaker.state], name)
+    return [state]
+
+
+REGISTRY.add_collector(_collect_circuit_state)
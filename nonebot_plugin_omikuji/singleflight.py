@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import asyncio
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Generic, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class SingleFlight(Generic[K, V]):
+    """
+    合并同一个 key 上并发的异步调用，同一时刻只有一个调用真正执行，其余调用共享其结果。
+
+    实际调用运行在独立的任务中，发起者被取消不会影响其他等待者。
+    """
+
+    def __init__(self) -> None:
+        self._calls: dict[K, asyncio.Future[V]] = {}
+        self.executed: int = 0  # 实际执行的次数
+        self.coalesced: int = 0  # 被合并(共享结果)的次数
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: K, func: Callable[[], Awaitable[V]]) -> tuple[V, bool]:
+        """
+        执行或加入 key 对应的调用
+
+        Returns:
+            (结果, 是否为共享的结果)
+        """
+        if (task := self._calls.get(key)) is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task), True
+
+        task = asyncio.ensure_future(func())
+        self._calls[key] = task
+        self.executed += 1
+
+        def _done(t: asyncio.Future[V]) -> None:
+            if self._calls.get(key) is t:
+                del self._calls[key]
+            if not t.cancelled():
+                t.exception()  # 标记异常已被获取，避免无人等待时输出警告
+
+        task.add_done_callback(_done)
+        return await asyncio.shield(task), False
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "in_flight": self.in_flight,
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+        }
@@ -1,56 +1,108 @@
 from __future__ import annotations
 
-import asyncio
+import hashlib
+import time
+import typing
+from collections.abc import AsyncIterator, Hashable, Iterable
+from contextlib import AsyncExitStack, asynccontextmanager
 from datetime import datetime
-from functools import lru_cache
 
-from nonebot_plugin_orm import Model
-from sqlalchemy import JSON, Index, String, UniqueConstraint
+from nonebot_plugin_orm import AsyncSession, Model
+from sqlalchemy import (
+    JSON,
+    Index,
+    Insert,
+    Integer,
+    String,
+    Text,
+    UniqueConstraint,
+    false,
+    func,
+    insert,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Mapped, mapped_column
 
-from .models import THEME_TYPE
+from .config import get_config
+from .locks import KeyedRWLock, LockStats
+from .metrics import DB_LOCK_WAIT_SECONDS, REGISTRY, Counter
+from .models import OMIKUJI_THEMES, THEME_TYPE
 
+_db_locks = KeyedRWLock()
 
-@lru_cache(1024)
-def db_lock(*args, **kwargs):
-    return asyncio.Lock()
+
+def _lock_order(key: tuple[str, str]) -> tuple[str, int, str]:
+    theme, level = key
+    index = OMIKUJI_THEMES.index(theme) if theme in OMIKUJI_THEMES else -1
+    return level, index, theme
+
+
+@asynccontextmanager
+async def db_lock(
+    theme: str | None, level: str, *, shared: bool = False
+) -> AsyncIterator[None]:
+    """
+    语料单元锁，读取使用共享模式，写入使用独占模式。
+
+    theme 为 None 时锁定该 level 下的所有主题。
+    """
+    keys = [(theme, level)] if theme else [(t, level) for t in OMIKUJI_THEMES]
+    async with db_lock_many(keys, shared=shared):
+        yield
+
+
+@asynccontextmanager
+async def db_lock_many(
+    keys: Iterable[tuple[str, str]], *, shared: bool = False
+) -> AsyncIterator[None]:
+    """同时锁定多个 (theme, level) 单元，按固定顺序加锁以避免死锁"""
+    async with AsyncExitStack() as stack:
+        start = time.perf_counter()
+        for key in sorted(set(keys), key=_lock_order):
+            await stack.enter_async_context(_db_locks.acquire(key, shared=shared))
+        DB_LOCK_WAIT_SECONDS.observe(
+            time.perf_counter() - start, "shared" if shared else "exclusive"
+        )
+        yield
+
+
+def db_lock_stats() -> dict[Hashable, LockStats]:
+    return _db_locks.stats()
+
+
+def _collect_lock_stats() -> list[Counter]:
+    labels = ("theme", "level")
+    acquisitions = Counter(
+        "omikuji_db_lock_acquisitions_total", "各语料单元锁的获取次数", labels
+    )
+    contended = Counter(
+        "omikuji_db_lock_contended_total", "各语料单元锁需要等待的次数", labels
+    )
+    wait = Counter(
+        "omikuji_db_lock_key_wait_seconds_total", "各语料单元锁的累计等待时间", labels
+    )
+    for key, stats in db_lock_stats().items():
+        theme, level = typing.cast(tuple[str, str], key)
+        acquisitions.inc(theme, level, amount=stats.acquisitions)
+        contended.inc(theme, level, amount=stats.contended)
+        wait.inc(theme, level, amount=stats.wait_time)
+    return [acquisitions, contended, wait]
+
+
+REGISTRY.add_collector(_collect_lock_stats)
 
 
 class OmikujiCache(Model):
+    """语料单元，每个 (level, theme) 一行，具体语料见 OmikujiCorpusEntry"""
+
     __tablename__ = "omikuji_cache"
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     level: Mapped[str] = mapped_column(String(64), nullable=False)
     theme: Mapped[THEME_TYPE] = mapped_column(String(64), nullable=False)
-    sections: Mapped[dict[str, list[str]]] = mapped_column(
-        JSON,
-        default={},
-        nullable=False,
-    )  # {"板块":["板块内容"]}
-    intro: Mapped[list[dict[str, str]]] = mapped_column(
-        JSON,
-        default=[],
-        nullable=False,
-    )  # [{"content":"内容"}]
-    maxim: Mapped[list[dict[str, str]]] = mapped_column(
-        JSON,
-        default=[],
-        nullable=False,
-    )
-    end: Mapped[list[dict[str, str]]] = mapped_column(
-        JSON,
-        default=[],
-        nullable=False,
-    )
-    divine_title: Mapped[list[dict[str, str]]] = mapped_column(
-        JSON,
-        default=[],
-        nullable=False,
-    )
-    sign_number: Mapped[list[dict[str, str]]] = mapped_column(
-        JSON,
-        default=[],
-        nullable=False,
-    )
     created_date: Mapped[str] = mapped_column(
         String(30), default=lambda: datetime.now().strftime("%Y-%m-%d"), nullable=False
     )
@@ -60,7 +112,140 @@ class OmikujiCache(Model):
         onupdate=lambda: datetime.now().strftime("%Y-%m-%d"),
         nullable=False,
     )
+    version: Mapped[int] = mapped_column(
+        Integer, default=0, server_default="0", nullable=False
+    )  # 每次写入自增，用于其他进程发现语料变化
     __table_args__ = (
         Index("ix_omikuji_cache_level_theme", "level", "theme"),
         UniqueConstraint("level", "theme", name="uq_omikuji_cache_level_theme"),
     )
+
+
+class OmikujiCorpusEntry(Model):
+    __tablename__ = "omikuji_corpus_entry"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    level: Mapped[str] = mapped_column(String(64), nullable=False)
+    theme: Mapped[THEME_TYPE] = mapped_column(String(64), nullable=False)
+    field: Mapped[str] = mapped_column(
+        String(32), nullable=False
+    )  # section/intro/maxim/end/divine_title/sign_number
+    section_name: Mapped[str] = mapped_column(
+        String(64), default="", server_default="", nullable=False
+    )  # 仅 field 为 section 时有值
+    content: Mapped[str] = mapped_column(Text, nullable=False)
+    content_hash: Mapped[str] = mapped_column(String(64), nullable=False)
+    __table_args__ = (
+        Index("ix_omikuji_corpus_entry_level_theme_field", "level", "theme", "field"),
+        UniqueConstraint(
+            "level",
+            "theme",
+            "field",
+            "section_name",
+            "content_hash",
+            name="uq_omikuji_corpus_entry_content",
+        ),
+    )
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def insert_ignore(session: AsyncSession, model: type[Model]) -> Insert:
+    """构造遇到唯一约束冲突时忽略该行的 INSERT 语句"""
+    dialect = session.get_bind(model).dialect.name
+    if dialect == "sqlite":
+        return sqlite_insert(model).on_conflict_do_nothing()
+    if dialect == "postgresql":
+        return postgresql_insert(model).on_conflict_do_nothing()
+    return insert(model).prefix_with("IGNORE", dialect="mysql")
+
+
+class OmikujiDailyDraw(Model):
+    __tablename__ = "omikuji_daily_draw"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    user_id: Mapped[str] = mapped_column(String(64), nullable=False)
+    draw_date: Mapped[str] = mapped_column(String(30), nullable=False)
+    data: Mapped[dict] = mapped_column(JSON, nullable=False)  # OmikujiData
+    __table_args__ = (
+        Index("ix_omikuji_daily_draw_draw_date", "draw_date"),
+        UniqueConstraint(
+            "user_id", "draw_date", name="uq_omikuji_daily_draw_user_id_draw_date"
+        ),
+    )
+
+
+class OmikujiCorpusSnapshot(Model):
+    """
+    确定性抽签模式下各单元当天固定的语料快照：只使用 id 不超过 watermark 的语料条目，
+    进程重启或多个进程时当天的抽签结果保持一致
+    """
+
+    __tablename__ = "omikuji_corpus_snapshot"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    level: Mapped[str] = mapped_column(String(64), nullable=False)
+    theme: Mapped[THEME_TYPE] = mapped_column(String(64), nullable=False)
+    snapshot_date: Mapped[str] = mapped_column(String(30), nullable=False)
+    watermark: Mapped[int] = mapped_column(
+        Integer, nullable=False
+    )  # 固定快照时该单元最大的语料条目 id
+    created_date: Mapped[str] = mapped_column(
+        String(30), nullable=False
+    )  # 固定快照时单元的创建日期与更新日期（用于判断是否过期）
+    updated_date: Mapped[str] = mapped_column(String(30), nullable=False)
+    __table_args__ = (
+        Index("ix_omikuji_corpus_snapshot_snapshot_date", "snapshot_date"),
+        UniqueConstraint(
+            "level",
+            "theme",
+            "snapshot_date",
+            name="uq_omikuji_corpus_snapshot_level_theme_snapshot_date",
+        ),
+    )
+
+
+def _advisory_key(theme: str, level: str) -> int:
+    """语料单元在 PostgreSQL 咨询锁中使用的 64 位键"""
+    digest = hashlib.sha256(f"omikuji:{theme}:{level}".encode()).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
+async def lock_cells(session: AsyncSession, keys: Iterable[tuple[str, str]]) -> None:
+    """
+    omikuji_coordination 为 database 时，在当前事务中锁定 (theme, level) 语料单元直到事务结束，
+    使多个进程对同一单元的写入依次进行；进程内仍需持有 db_lock。
+
+    PostgreSQL 使用事务级咨询锁，SQLite 提前获取数据库写锁，其他数据库对单元所在的行加锁。
+    需在事务中的第一条语句之前调用。
+    """
+    if get_config().omikuji_coordination != "database":
+        return
+    keys = sorted(set(keys), key=_lock_order)
+    if not keys:
+        return
+    dialect = session.get_bind(OmikujiCache).dialect.name
+    if dialect == "postgresql":
+        for theme, level in keys:
+            await session.execute(
+                select(func.pg_advisory_xact_lock(_advisory_key(theme, level)))
+            )
+    elif dialect == "sqlite":
+        # SQLite 只有库级的写锁；写语句（即使没有匹配的行）会获取写锁并持有到事务结束，
+        # 避免事务先读后写时升级写锁失败
+        await session.execute(
+            update(OmikujiCache).where(false()).values(version=OmikujiCache.version)
+        )
+    else:
+        await session.execute(
+            select(OmikujiCache.id)
+            .where(
+                or_(
+                    *(
+                        (OmikujiCache.theme == theme) & (OmikujiCache.level == level)
+                        for theme, level in keys
+                    )
+                )
+            )
+            .order_by(OmikujiCache.level, OmikujiCache.theme)
+            .with_for_update()
+        )
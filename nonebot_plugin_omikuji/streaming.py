@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import contextlib
+import functools
+import importlib.util
+import json
+import typing
+from collections.abc import Awaitable, Callable, Iterable, Iterator
+from contextvars import ContextVar
+from typing import Any
+
+from nonebot import logger
+from nonebot_plugin_suggarchat.API import ToolFunctionSchema, config_manager
+from nonebot_plugin_suggarchat.utils.models import Message
+
+if typing.TYPE_CHECKING:
+    import openai
+    from nonebot_plugin_suggarchat.config import ModelPreset
+    from openai.types.chat import ChatCompletionMessageParam, ChatCompletionToolParam
+
+# 收到一个完整的字段时调用：(字段名, 值)，sections 中的每一项以 ("sections[]", 项) 传入
+FieldListener = Callable[[str, Any], Awaitable[Any]]
+
+_LISTENER: ContextVar[FieldListener | None] = ContextVar(
+    "omikuji_field_listener", default=None
+)
+
+STREAM_PROTOCOLS = ("openai", "__main__")
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\r\n"
+
+
+class PartialArguments:
+    """
+    增量解析流式返回的工具调用参数（一个 JSON 对象）。
+
+    每次 feed 后返回新完成的顶层字段；array_fields 中的数组按元素逐个返回，字段名后加 []。
+    只用于提前展示，格式错误时不抛出异常（等待更多内容），完整结果仍以最终的 json.loads 为准。
+    """
+
+    def __init__(self, array_fields: Iterable[str] = ("sections",)) -> None:
+        self._array_fields = frozenset(array_fields)
+        self._buf = ""
+        self._pos = 0
+        self._state = "start"
+        self._key = ""
+
+    def _skip(self) -> str | None:
+        while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+            self._pos += 1
+        return self._buf[self._pos] if self._pos < len(self._buf) else None
+
+    def _decode(self) -> tuple[Any, bool]:
+        """从当前位置解析一个完整的值，内容不完整时返回 (None, False)"""
+        try:
+            value, end = _decoder.raw_decode(self._buf, self._pos)
+        except ValueError:
+            return None, False
+        if end == len(self._buf) and not isinstance(value, str | list | dict):
+            return None, False  # 数字等可能还没有结束
+        self._pos = end
+        return value, True
+
+    def feed(self, chunk: str) -> list[tuple[str, Any]]:
+        self._buf += chunk
+        events: list[tuple[str, Any]] = []
+        while (char := self._skip()) is not None and self._state != "done":
+            if self._state == "start":
+                if char != "{":
+                    self._state = "done"
+                    break
+                self._pos += 1
+                self._state = "key"
+            elif self._state in ("key", "array") and char in ",}]":
+                self._pos += 1
+                if char == "}" and self._state == "key":
+                    self._state = "done"
+                elif char == "]":
+                    self._state = "key"
+            elif self._state == "key":
+                key, complete = self._decode()
+                if not complete:
+                    break
+                self._key, self._state = str(key), "colon"
+            elif self._state == "colon":
+                self._pos += 1  # ':'
+                self._state = "value"
+            elif (
+                self._state == "value"
+                and char == "["
+                and self._key in self._array_fields
+            ):
+                self._pos += 1
+                self._state = "array"
+            else:
+                value, complete = self._decode()
+                if not complete:
+                    break
+                if self._state == "array":
+                    events.append((f"{self._key}[]", value))
+                else:
+                    events.append((self._key, value))
+                    self._state = "key"
+        return events
+
+
+@contextlib.contextmanager
+def listening(listener: FieldListener | None) -> Iterator[None]:
+    """在此范围内发起的单张生成会把已完成的字段传给 listener（预设支持流式调用时）"""
+    token = _LISTENER.set(listener)
+    try:
+        yield
+    finally:
+        _LISTENER.reset(token)
+
+
+def current_listener() -> FieldListener | None:
+    return _LISTENER.get()
+
+
+_CLIENTS: dict[tuple[str, str], openai.AsyncOpenAI] = {}
+
+
+@functools.cache
+def stream_available() -> bool:
+    """是否安装了 openai（由 SuggarChat 的 OpenAI 协议间接提供，未安装时改用普通调用）"""
+    return importlib.util.find_spec("openai") is not None
+
+
+def _client(base_url: str, api_key: str) -> openai.AsyncOpenAI:
+    import openai
+
+    if (client := _CLIENTS.get((base_url, api_key))) is None:
+        # 超时与重试由调用方控制
+        client = _CLIENTS[(base_url, api_key)] = openai.AsyncOpenAI(
+            base_url=base_url, api_key=api_key, max_retries=0
+        )
+    return client
+
+
+async def _stream_with_preset(
+    preset: ModelPreset,
+    messages: list[Message],
+    tool: ToolFunctionSchema,
+    listener: FieldListener,
+) -> str | None:
+    """
+    用单个预设流式调用工具
+
+    Returns:
+        完整的工具调用参数；在传出任何字段之前失败时返回 None，传出字段之后失败则直接抛出
+    """
+    parser = PartialArguments()
+    arguments: list[str] = []
+    emitted = False
+    try:
+        client = _client(preset.base_url, preset.api_key)
+        stream = await client.chat.completions.create(
+            model=preset.model,
+            messages=typing.cast(
+                "list[ChatCompletionMessageParam]",
+                [message.model_dump() for message in messages],
+            ),
+            tools=[
+                typing.cast(
+                    "ChatCompletionToolParam", tool.model_dump(exclude_none=True)
+                )
+            ],
+            tool_choice={"type": "function", "function": {"name": tool.function.name}},
+            stream=True,
+        )
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            for call in chunk.choices[0].delta.tool_calls or ():
+                if call.index != 0 or not call.function or not call.function.arguments:
+                    continue
+                arguments.append(call.function.arguments)
+                for key, value in parser.feed(call.function.arguments):
+                    emitted = True
+                    await listener(key, value)
+    except Exception as e:
+        if emitted:
+            raise
+        logger.debug(f"预设 {preset.name} 流式生成失败：{e!r}")
+        return None
+    return "".join(arguments) if arguments else None
+
+
+async def stream_tool_arguments(
+    messages: list[Message], tool: ToolFunctionSchema, listener: FieldListener
+) -> str | None:
+    """
+    以流式方式调用工具，边接收边把完成的字段传给 listener
+
+    与 SuggarChat 的 OpenAI 适配器一样依次尝试主预设与备用预设（跳过非 OpenAI 协议的预设），
+    某个预设在传出任何字段之前失败时换下一个
+
+    Returns:
+        完整的工具调用参数；未安装 openai、没有支持流式调用的预设，或所有预设都在传出任何字段之前失败时
+        返回 None，由调用方改用普通调用
+    """
+    if not stream_available():
+        return None
+    config = config_manager.ins_config
+    for name in (config.preset, *config.preset_extension.backup_preset_list):
+        preset = await config_manager.get_preset(name)
+        if preset.protocol not in STREAM_PROTOCOLS:
+            continue
+        arguments = await _stream_with_preset(preset, messages, tool, listener)
+        if arguments is not None:
+            return arguments
+    logger.debug("流式生成不可用，改用普通调用")
+    return None
@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+import asyncio
+from collections.abc import Awaitable, Callable, Coroutine
+from typing import Any
+
+from nonebot import logger
+
+_TASKS: set[asyncio.Task] = set()
+
+
+def create_background_task(
+    coro: Coroutine[Any, Any, Any], name: str | None = None
+) -> asyncio.Task:
+    """创建后台任务并持有其引用，避免任务在运行中被回收"""
+    task = asyncio.create_task(coro, name=name)
+    _TASKS.add(task)
+    task.add_done_callback(_TASKS.discard)
+    return task
+
+
+async def cancel_background_tasks() -> None:
+    tasks = list(_TASKS)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _run_periodically(
+    interval: float, func: Callable[[], Awaitable[Any]], name: str
+) -> None:
+    while True:
+        try:
+            await func()
+        except Exception as e:
+            logger.warning(f"后台任务 {name} 执行失败：{e}")
+        await asyncio.sleep(interval)
+
+
+def create_periodic_task(
+    interval: float, func: Callable[[], Awaitable[Any]], name: str
+) -> asyncio.Task:
+    """创建立即执行一次、之后每隔 interval 秒执行一次的后台任务"""
+    return create_background_task(_run_periodically(interval, func, name), name=name)
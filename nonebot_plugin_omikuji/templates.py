@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import string
+from collections.abc import Iterable, Mapping
+
+DEFAULT_TEMPLATE = """{intro}
+{user_prefix}你的签上刻了什么？
+
+＝＝＝ 御神签 第{sign_number} ＝＝＝
+✨ 天启：{divine_title}
+🌸 运势：{level} - {theme}
+
+{sections}
+
+⚖ 真言偈：{maxim}
+
+{end}
+"""
+DEFAULT_SECTION_TEMPLATE = """▫ {name}
+{content}
+"""
+
+# 消息模板可用的字段，user_prefix 为 "用户名，"（没有用户名时为空），sections 为按板块模板渲染后拼接的各板块
+MESSAGE_FIELDS = (
+    "intro",
+    "user_prefix",
+    "sign_number",
+    "divine_title",
+    "level",
+    "theme",
+    "sections",
+    "maxim",
+    "end",
+)
+SECTION_FIELDS = ("name", "content")
+
+# 签头所需的字段，流式生成时这些字段齐全即可先发送签头
+HEADER_FIELDS = ("intro", "sign_number", "divine_title", "level", "theme")
+
+_formatter = string.Formatter()
+
+
+class Template:
+    """
+    预编译的消息模板。
+
+    语法与 str.format 相同，但只支持 {字段名}（不支持格式说明、转换与下标），
+    用 {{ 与 }} 表示花括号本身。模板只校验与解析一次，之后保存为规范化的格式字符串，
+    渲染交给 str.format（C 实现）完成。
+    """
+
+    __slots__ = ("fields", "format", "parts")
+
+    def __init__(self, parts: Iterable[tuple[str, str | None]]) -> None:
+        merged: list[tuple[str, str | None]] = []
+        for literal, field in parts:
+            if merged and merged[-1][1] is None:
+                literal = merged.pop()[0] + literal
+            merged.append((literal, field))
+        self.parts = tuple(merged)
+        self.fields = frozenset(field for _, field in self.parts if field is not None)
+        # 以关键字参数渲染，如 template.format(name=..., content=...)
+        self.format = "".join(
+            literal.replace("{", "{{").replace("}", "}}")
+            + (f"{{{field}}}" if field is not None else "")
+            for literal, field in self.parts
+        ).format
+
+    @classmethod
+    def compile(cls, source: str, fields: Iterable[str]) -> Template:
+        allowed = frozenset(fields)
+        parts: list[tuple[str, str | None]] = []
+        try:
+            parsed = list(_formatter.parse(source))
+        except ValueError as e:
+            raise ValueError(f"invalid template: {e}") from e
+        for literal, field, spec, conversion in parsed:
+            if field is not None and field not in allowed:
+                raise ValueError(
+                    f"unknown field {{{field}}} in template, "
+                    f"expected one of: {', '.join(sorted(allowed))}"
+                )
+            if spec or conversion:
+                raise ValueError(
+                    f"format spec and conversion are not supported: {{{field}}}"
+                )
+            parts.append((literal, field))
+        return cls(parts)
+
+    def bind(self, values: Mapping[str, str]) -> Template:
+        """代入部分字段，返回只含其余字段的模板"""
+        return Template(
+            part
+            for literal, field in self.parts
+            for part in (
+                ((literal, None), (values[field], None))
+                if field is not None and field in values
+                else ((literal, field),)
+            )
+        )
+
+    def split(self, fields: Iterable[str]) -> tuple[Template, Template]:
+        """在第一个不属于 fields 的字段处拆分，前一部分只包含 fields 中的字段"""
+        known = frozenset(fields)
+        for i, (literal, field) in enumerate(self.parts):
+            if field is not None and field not in known:
+                return (
+                    Template((*self.parts[:i], (literal, None))),
+                    Template((("", field), *self.parts[i + 1 :])),
+                )
+        return self, Template(())
+
+    def render(self, values: Mapping[str, str]) -> str:
+        return self.format(**values)
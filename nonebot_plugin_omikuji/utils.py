@@ -1,112 +1,439 @@
 import json
 import random
-from copy import deepcopy
-from datetime import datetime, timedelta
+import time
+import typing
+from collections.abc import Awaitable, Callable, Sequence
+from typing import Any, TypeVar
 
 from nonebot import logger
+from nonebot.adapters.onebot.v11 import GroupMessageEvent, MessageEvent
 from nonebot_plugin_suggarchat.API import (
+    ToolFunctionSchema,
     config_manager,
     tools_caller,
 )
 from nonebot_plugin_suggarchat.utils.models import Message
 
-from .cache import OmikujiCacheData
+from .cache import cache_omikuji, get_cached_omikuji
+from .concurrency import (
+    QueueFullError,
+    get_generation_limiter,
+    in_background,
+    requesting,
+    unbounded_queue,
+)
 from .config import get_config
+from .corpus import CorpusCell, get_corpus_index, is_expired
+from .deterministic import daily_theme, deterministic_sample, store_key
+from .draw_store import get_draw_store
+from .levels import sample_level
+from .metrics import (
+    CORPUS_LOOKUPS,
+    DRAW_CACHE,
+    LLM_FAILURES,
+    LLM_FALLBACKS,
+    LLM_SECONDS,
+    REGISTRY,
+    Counter,
+    Gauge,
+)
 from .models import (
+    LEVEL,
+    OMIKUJI_BATCH_SCHEMA_META,
     OMIKUJI_SCHEMA_META,
+    OMIKUJI_THEMES,
     THEME_TYPE,
     OmikujiData,
-    OmikujiSections,
-    random_level,
 )
+from .prompts import get_prompt_cache
+from .refresh import get_refresh_scheduler
+from .resilience import InvalidResponseError, call_with_retry
+from .singleflight import SingleFlight
+from .streaming import (
+    FieldListener,
+    current_listener,
+    listening,
+    stream_tool_arguments,
+)
+from .write_behind import get_corpus_writer
+
+T = TypeVar("T")
+
+
+def _cell_expired(cell: CorpusCell) -> bool:
+    return is_expired(cell.created_date, cell.updated_date)
 
 
 async def _hit_cache_omikuji(
     theme: THEME_TYPE,
     level: str = "",
 ) -> OmikujiData | None:
-    if cache := await OmikujiCacheData.get(level, theme):
-        if cache.updated_date < (
-            datetime.now() - timedelta(days=get_config().omikuji_cache_expire_days)
-        ).strftime("%Y-%m-%d"):
-            logger.debug(f"{theme}/{level} cache expired!")
-            return
-        logger.debug(f"{theme}/{level} cache hit!")
-        keys = list(cache.sections.keys())
-        random.shuffle(keys)
-        sections = [
-            OmikujiSections(name=k, content=random.choice(cache.sections[k]))
-            for k in keys
-        ]
-        if len(sections) < 4:
-            return
-        while len(sections) > 8:
-            sections.pop()
-
-        model = OmikujiData(
-            level=level,
-            theme=theme,
-            sections=sections,
-            sign_number=random.choice([i.content for i in cache.sign_number]),
-            intro=random.choice([i.content for i in cache.intro]),
-            divine_title=random.choice([i.content for i in cache.divine_title]),
-            maxim=random.choice([i.content for i in cache.maxim]),
-            end=random.choice([i.content for i in cache.end]),
+    if not (cell := get_corpus_index().get(level, theme)):
+        CORPUS_LOOKUPS.inc(level, theme, "miss")
+        return
+    if _cell_expired(cell):
+        logger.debug(f"{theme}/{level} cache expired!")
+        CORPUS_LOOKUPS.inc(level, theme, "expired")
+        return
+    if (model := cell.sample()) is None:
+        CORPUS_LOOKUPS.inc(level, theme, "insufficient")
+        return
+    logger.debug(f"{theme}/{level} cache hit!")
+    CORPUS_LOOKUPS.inc(level, theme, "hit")
+    # 长期缓存模式下语料过旧时，先返回缓存结果，再在后台补充新语料
+    get_refresh_scheduler().maybe_refresh(cell, lambda: _regenerate(theme, level))
+    return model
+
+
+async def _regenerate(theme: THEME_TYPE, level: str) -> list[OmikujiData]:
+    """后台更新语料：一次生成同一运势的多张签"""
+    with in_background():
+        return await generate_omikuji_batch(
+            theme, [level] * get_config().omikuji_batch_size
+        )
+
+
+generation_flight: SingleFlight[tuple[str, str, bool], OmikujiData] = SingleFlight()
+
+
+def _collect_generation_stats() -> list[Counter | Gauge]:
+    total = Counter(
+        "omikuji_generation_total",
+        "LLM生成请求数（executed为实际调用，coalesced为合并到进行中的调用）",
+        ("result",),
+    )
+    total.inc("executed", amount=generation_flight.executed)
+    total.inc("coalesced", amount=generation_flight.coalesced)
+    in_flight = Gauge("omikuji_generation_in_flight", "进行中的LLM生成数")
+    in_flight.set(generation_flight.in_flight)
+    return [total, in_flight]
+
+
+REGISTRY.add_collector(_collect_generation_stats)
+
+
+def _resample(data: OmikujiData) -> OmikujiData:
+    sections = random.sample(
+        data.sections, random.randint(min(4, len(data.sections)), len(data.sections))
+    )
+    return data.model_copy(update={"sections": sections})
+
+
+def _fallback_omikuji(theme: THEME_TYPE, level: str) -> OmikujiData | None:
+    """
+    LLM 不可用时从最接近的语料单元中抽取（不检查是否过期）：
+    依次尝试同一主题下相邻的运势，再尝试同一运势的其他主题
+    """
+    index = get_corpus_index()
+    position = LEVEL.index(level) if level in LEVEL else 0
+    levels = sorted(LEVEL, key=lambda lv: abs(LEVEL.index(lv) - position))
+    candidates = [(lv, theme) for lv in levels] + [
+        (level, other) for other in OMIKUJI_THEMES if other != theme
+    ]
+    for cell_level, cell_theme in candidates:
+        if (cell := index.get(cell_level, cell_theme)) is not None and (
+            model := cell.sample()
+        ) is not None:
+            return model
+    return None
+
+
+async def _generate_shared(
+    theme: THEME_TYPE, is_group: bool, level: str
+) -> tuple[OmikujiData, bool]:
+    """
+    调用 LLM 生成（与同一单元进行中的生成合并）
+
+    排队已满且策略为 corpus 时，若语料库中没有可以改用的签（如刚安装时语料库为空），
+    继续排队等待生成，而不是提示用户稍后再试
+    """
+    key = (theme, level, is_group)
+    try:
+        return await generation_flight.do(
+            key, lambda: _generate_omikuji(theme, is_group, level)
+        )
+    except QueueFullError:
+        if (
+            get_config().omikuji_queue_full_policy != "corpus"
+            or _fallback_omikuji(theme, level) is not None
+        ):
+            raise
+    with unbounded_queue():
+        return await generation_flight.do(
+            key, lambda: _generate_omikuji(theme, is_group, level)
         )
-        return model
 
 
 async def generate_omikuji(
     theme: THEME_TYPE,
     is_group: bool = False,
     level: str = "",
+    *,
+    force: bool = False,
 ) -> OmikujiData:
+    """
+    获取一张御神签，优先从语料库中抽取
+
+    Args:
+        force: 跳过语料库，总是调用 LLM 生成（生成结果仍会写入语料库）
+
+    LLM 调用最终失败时（超时、熔断、结果不可用），若启用了 omikuji_llm_fallback，
+    改为从最接近的语料单元中抽取；生成排队已满时按 omikuji_queue_full_policy 处理
+
+    Raises:
+        QueueFullError: 生成排队已满，且没有改用语料库
+    """
     config = get_config()
-    level = level or random_level()
-    if config.omikuji_use_cache:
+    level = level or sample_level(theme)
+    if config.omikuji_use_cache and not force:
         if cache := await _hit_cache_omikuji(theme, level):
             return cache
     logger.debug(f"theme: {theme}, level: {level} Cache miss")
-    system_prompt = Message.model_validate(
-        deepcopy(
-            config_manager.group_train if is_group else config_manager.private_train
+    try:
+        model, shared = await _generate_shared(theme, is_group, level)
+    except Exception as e:
+        if isinstance(e, QueueFullError):
+            # 排队已满时按准入策略处理：corpus 为改用语料库，reject 为提示用户稍后再试
+            allowed = config.omikuji_queue_full_policy == "corpus"
+        else:
+            allowed = config.omikuji_llm_fallback
+        if not allowed or (fallback := _fallback_omikuji(theme, level)) is None:
+            LLM_FALLBACKS.inc("unavailable")
+            raise
+        LLM_FALLBACKS.inc("served")
+        logger.warning(
+            f"生成 {theme}/{level} 失败（{e!r}），"
+            f"改用语料库中的 {fallback.theme}/{fallback.level}"
         )
+        return fallback
+    if not shared:
+        return model
+    logger.debug(
+        f"theme: {theme}, level: {level} joined in-flight generation "
+        f"(coalesced: {generation_flight.coalesced})"
+    )
+    if config.omikuji_generation_share_policy == "resample":
+        if config.omikuji_use_cache and (
+            cache := await _hit_cache_omikuji(theme, level)
+        ):
+            return cache
+        return _resample(model)
+    return model
+
+
+async def draw_omikuji(
+    event: MessageEvent,
+    theme: THEME_TYPE | None = None,
+    *,
+    on_generate: Callable[[], Awaitable[Any]] | None = None,
+    on_field: FieldListener | None = None,
+) -> OmikujiData:
+    """
+    抽取用户今日的御神签（命令与聊天工具共用）
+
+    Args:
+        theme: 主题，为 None 时随机选择
+        on_generate: 需要调用 LLM 生成时，在生成前调用（用于发送等待提示）
+        on_field: 以流式方式生成时，每完成一个字段调用一次（用于提前发送签头），
+            结果来自语料库或缓存时不会调用
+    """
+    is_group = isinstance(event, GroupMessageEvent)
+    group = str(event.group_id) if is_group else f"private:{event.user_id}"
+    with requesting(group, str(event.user_id)), listening(on_field):
+        if get_config().omikuji_deterministic:
+            return await _draw_deterministic(event, theme, is_group, on_generate)
+        if (data := await get_cached_omikuji(event)) is None:
+            if on_generate is not None:
+                await on_generate()
+            data = await generate_omikuji(
+                theme or typing.cast(THEME_TYPE, random.choice(OMIKUJI_THEMES)),
+                is_group,
+            )
+            data = await cache_omikuji(event, data)
+    return data
+
+
+async def _draw_deterministic(
+    event: MessageEvent,
+    theme: THEME_TYPE | None,
+    is_group: bool,
+    on_generate: Callable[[], Awaitable[Any]] | None,
+) -> OmikujiData:
+    """
+    确定性抽签：运势与语料均由 (user_id, 日期, 主题, 盐) 决定，
+    重复抽签时直接重新计算，只有调用 LLM 生成的结果需要保存
+    """
+    user_id = str(event.user_id)
+    theme = theme or daily_theme(user_id)
+    store = get_draw_store()
+    key = store_key(user_id, theme)
+    if (data := await store.fetch(key)) is not None:
+        DRAW_CACHE.inc("hit")
+        return data
+    level, data = await deterministic_sample(
+        user_id, theme, lambda c: not _cell_expired(c)
     )
-    assert isinstance(system_prompt.content, str)
-    system_prompt.content += "\n你现在需要结合你的角色设定生成御神签。"
+    if data is not None and get_config().omikuji_use_cache:
+        DRAW_CACHE.inc("computed")
+        CORPUS_LOOKUPS.inc(level, theme, "hit")
+        # 新语料进入索引后从次日的快照开始生效
+        if (cell := get_corpus_index().get(level, theme)) is not None:
+            get_refresh_scheduler().maybe_refresh(
+                cell, lambda: _regenerate(theme, level)
+            )
+        if get_config().omikuji_coordination == "database":
+            # 各进程的语料快照可能不同，以第一个写入的结果为准
+            data = await store.claim(key, data)
+        return data
+    DRAW_CACHE.inc("miss")
+    CORPUS_LOOKUPS.inc(level, theme, "miss")
+    if on_generate is not None:
+        await on_generate()
+    data = await generate_omikuji(theme, is_group, level, force=True)
+    return await store.claim(key, data)
+
+
+async def _call_tool(
+    messages: list[Message],
+    tool: ToolFunctionSchema,
+    parse: Callable[[Any], T],
+    stream_to: FieldListener | None = None,
+) -> T:
+    """
+    调用 LLM 并解析工具调用的参数，超时、失败或结果不可用时按配置重试
+
+    Args:
+        parse: 解析工具调用参数（已解析的 JSON），结果不可用时抛出 TypeError / ValueError
+        stream_to: 启用 omikuji_stream_generation 时以流式方式调用，边接收边传出完成的字段；
+            预设不支持流式调用时改用普通调用。已传出字段后失败时，重试改用普通调用，
+            避免把另一次生成的字段传给 stream_to
+    """
+    emitted = False
+
+    async def forward(key: str, value: Any) -> None:
+        nonlocal emitted
+        emitted = True
+        await typing.cast(FieldListener, stream_to)(key, value)
+
+    async def attempt() -> T:
+        start = time.perf_counter()
+        arguments = None
+        try:
+            if (
+                stream_to is not None
+                and not emitted
+                and get_config().omikuji_stream_generation
+            ):
+                arguments = await stream_tool_arguments(messages, tool, forward)
+            if arguments is None:
+                data = await tools_caller(
+                    messages=messages, tools=[tool], tool_choice="required"
+                )
+                if not data.tool_calls:
+                    raise InvalidResponseError("LLM 没有返回工具调用")
+                arguments = data.tool_calls[0].function.arguments
+        finally:
+            LLM_SECONDS.observe(time.perf_counter() - start)
+        try:
+            return parse(json.loads(arguments))
+        except (TypeError, ValueError) as e:
+            raise InvalidResponseError(f"工具调用的参数不可用：{e}") from e
+
+    return await call_with_retry(
+        attempt, config_manager.ins_config.preset, get_generation_limiter().slot
+    )
+
+
+async def _generate_omikuji(
+    theme: THEME_TYPE,
+    is_group: bool,
+    level: str,
+) -> OmikujiData:
+    config = get_config()
     user_prompt = Message(
         role="user",
         content=f"御神签的运势是：'{level}'\n现在生成一张主题为：'{theme}'的御神签",
     )
-    msg_input = [system_prompt, user_prompt]
-    data = await tools_caller(
-        messages=msg_input, tools=[OMIKUJI_SCHEMA_META], tool_choice="required"
+    if (listener := current_listener()) is not None:
+        # 运势与主题在生成前已确定，先于模型输出的字段传出
+        await listener("level", level)
+        await listener("theme", theme)
+    model = await _call_tool(
+        [*get_prompt_cache().messages(is_group), user_prompt],
+        OMIKUJI_SCHEMA_META,
+        lambda args: OmikujiData.model_validate(
+            {**args, "level": level, "theme": theme}
+        ),
+        stream_to=listener,
     )
-    assert data.tool_calls
-    args = json.loads(data.tool_calls[0].function.arguments)
-    args["level"] = level
-    args["theme"] = theme
-    model = OmikujiData.model_validate(args)
     if level:
         model.level = level
     if config.omikuji_use_cache:
-        await OmikujiCacheData.cache_omikuji(model)
+        await get_corpus_writer().put(model)
     return model
 
 
-def format_omikuji(data: OmikujiData, user_name: str = ""):
-    ln = "\n"
-    msg = f"""{data.intro}
-{(user_name + "，" if user_name else "")}你的签上刻了什么？
+def _batch_items(args: Any) -> list:
+    if not isinstance(args, dict) or not isinstance(items := args.get("omikuji"), list):
+        raise ValueError("批量生成的结果中没有 omikuji 数组")
+    return items
 
-＝＝＝ 御神签 第{data.sign_number} ＝＝＝
-✨ 天启：{data.divine_title}
-🌸 运势：{data.level} - {data.theme}
 
-{"".join(f"▫ {section.name}{ln}{section.content}{ln}" for section in data.sections)}
+def _assign_level(item: dict, positional: str | None, remaining: list[str]) -> str:
+    """为批量结果中的一项确定运势：优先使用模型标注的运势，其次按顺序对应"""
+    for level in (item.get("level"), positional):
+        if level in remaining:
+            remaining.remove(level)
+            return level
+    return remaining.pop(0)
 
-⚖ 真言偈：{data.maxim}
 
-{data.end}
-"""
-    return msg
+async def generate_omikuji_batch(
+    theme: THEME_TYPE,
+    levels: Sequence[str],
+    is_group: bool = False,
+) -> list[OmikujiData]:
+    """
+    在一次 LLM 调用中生成同一主题的多张御神签（每个运势一张，运势可以重复），
+    逐项校验，丢弃不合格的项，合格的结果直接写入语料库
+
+    Returns:
+        校验通过的御神签
+    """
+    levels = list(levels)
+    user_prompt = Message(
+        role="user",
+        content=(
+            f"现在一次生成{len(levels)}张主题为：'{theme}'的御神签，"
+            f"运势依次是：{'、'.join(f'{level!r}' for level in levels)}\n"
+            "每张签的内容互不相同，按顺序放入 omikuji 数组，并在 level 中注明对应的运势"
+        ),
+    )
+    items = await _call_tool(
+        [*get_prompt_cache().messages(is_group), user_prompt],
+        OMIKUJI_BATCH_SCHEMA_META,
+        _batch_items,
+    )
+    models: list[OmikujiData] = []
+    remaining = levels.copy()
+    for index, item in enumerate(items):
+        if not remaining:
+            break
+        if not isinstance(item, dict):
+            continue
+        level = _assign_level(
+            item, levels[index] if index < len(levels) else None, remaining
+        )
+        try:
+            model = OmikujiData.model_validate({**item, "level": level, "theme": theme})
+        except ValueError:
+            remaining.append(level)
+            continue
+        models.append(model)
+    if dropped := len(levels) - len(models):
+        LLM_FAILURES.inc("invalid_item", amount=dropped)
+        logger.debug(f"批量生成 {theme}：{len(models)}/{len(levels)} 张通过校验")
+    if get_config().omikuji_use_cache:
+        for model in models:
+            await get_corpus_writer().put(model)
+    return models
@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import itertools
+import time
+
+from nonebot import logger
+
+from .cache import OmikujiCacheData
+from .config import get_config
+from .corpus import get_corpus_index
+from .metrics import CORPUS_WRITES, REGISTRY, Gauge
+from .models import OmikujiData
+
+
+class CorpusWriteBuffer:
+    """
+    语料写入缓冲（write-behind）。
+
+    生成结果先放入缓冲并按 (level, theme) 分组，同时合并进进程内的语料索引以便立即命中；
+    缓冲数量达到 omikuji_corpus_flush_batch_size 或每隔 omikuji_corpus_flush_interval 秒，
+    在一个事务中批量写入数据库，用户无需等待数据库写入即可得到结果；关闭时写入剩余的全部内容。
+
+    缓冲数量达到 omikuji_corpus_max_pending 时按 omikuji_corpus_overflow_policy 处理：
+    block 为等待写入腾出空间（最多等待 omikuji_corpus_block_timeout 秒，超时后丢弃新内容），
+    drop_oldest 为丢弃最早的内容，drop_newest 为丢弃新内容。
+    """
+
+    def __init__(self) -> None:
+        self._pending: dict[tuple[str, str], list[OmikujiData]] = {}
+        self._size = 0
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._closing = False
+
+    def __len__(self) -> int:
+        return self._size
+
+    async def put(self, data: OmikujiData) -> None:
+        config = get_config()
+        if self._task is None:
+            # 未启动（或已关闭）时直接写入
+            await OmikujiCacheData.cache_omikuji(data)
+            CORPUS_WRITES.inc("written")
+            return
+        deadline = time.monotonic() + config.omikuji_corpus_block_timeout
+        while self._size >= config.omikuji_corpus_max_pending:
+            if config.omikuji_corpus_overflow_policy == "drop_newest":
+                CORPUS_WRITES.inc("dropped")
+                return
+            if config.omikuji_corpus_overflow_policy == "drop_oldest":
+                self._drop_oldest()
+                break
+            self._space.clear()
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(
+                    self._space.wait(), max(deadline - time.monotonic(), 0)
+                )
+            except asyncio.TimeoutError:
+                # 数据库持续写入失败时缓冲不会腾出空间，丢弃新内容而不是让抽签一直等待
+                logger.warning("语料写入缓冲已满且等待超时，丢弃本次生成的语料")
+                CORPUS_WRITES.inc("dropped")
+                return
+        self._pending.setdefault((data.level, data.theme), []).append(data)
+        self._size += 1
+        get_corpus_index().stage(data)
+        if self._size >= config.omikuji_corpus_flush_batch_size:
+            self._wakeup.set()
+
+    def _drop_oldest(self) -> None:
+        key = next(iter(self._pending))
+        items = self._pending[key]
+        items.pop(0)
+        if not items:
+            del self._pending[key]
+        self._size -= 1
+        CORPUS_WRITES.inc("dropped")
+
+    async def flush(self) -> int:
+        """
+        写入缓冲中的全部内容
+
+        Returns:
+            写入的数量
+        """
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+            size, self._size = self._size, 0
+            self._space.set()
+            try:
+                await OmikujiCacheData.cache_omikuji_many(
+                    itertools.chain.from_iterable(pending.values())
+                )
+            except Exception:
+                # 写入失败时放回缓冲（放在新内容之前），超出上限的部分丢弃最早的内容
+                CORPUS_WRITES.inc("failed", amount=size)
+                for key, items in self._pending.items():
+                    pending.setdefault(key, []).extend(items)
+                self._pending = pending
+                self._size += size
+                while self._size > get_config().omikuji_corpus_max_pending:
+                    self._drop_oldest()
+                raise
+            CORPUS_WRITES.inc("written", amount=size)
+            return size
+
+    async def _flush_loop(self) -> None:
+        interval = get_config().omikuji_corpus_flush_interval
+        while not self._closing:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), interval)
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning(f"语料写入数据库失败：{e}")
+                if not self._closing:
+                    await asyncio.sleep(interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            # 不取消写入循环，避免正在写入的批次被中断而丢失
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        if count := await self.flush():
+            logger.info(f"已写入缓冲中剩余的 {count} 条语料")
+
+
+_BUFFER = CorpusWriteBuffer()
+
+
+def get_corpus_writer() -> CorpusWriteBuffer:
+    return _BUFFER
+
+
+def _collect_pending() -> list[Gauge]:
+    pending = Gauge("omikuji_corpus_write_pending", "语料写入缓冲中等待写入的数量")
+    pending.set(len(_BUFFER))
+    return [pending]
+
+
+REGISTRY.add_collector(_collect_pending)